@@ -0,0 +1,304 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline analysis of capture files: `python3 -m autozlap analyze`.
+
+Capture files are split into chunks of whole connections, which are decoded in a process
+pool and replayed into a Session. Each chunk is reduced to a SessionSummary of sums, and the
+summaries of a file are merged into one CSV row per session. Frames are streamed, so
+captures need not fit in memory.
+"""
+
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+from . import capture
+from .constants import Mode
+from .decoder import DecodeError, InboundDecoder
+from .game_client import Session
+
+DEFAULT_CHUNK_MEGABYTES = 64
+
+COLUMNS = (
+    "session", "connections", "frames", "bytes", "decode_errors", "seconds", "kills", "deaths",
+    "kills_per_minute", "deaths_per_minute", "spawns", "mean_survival_seconds", "distance",
+    "club_collisions", "wall_collisions", "club_collisions_per_minute",
+    "wall_collisions_per_minute", "arena_collisions_per_minute", "sync_interval_ms_mean",
+    "sync_interval_ms_stdev", "sync_interval_ms_max", "arrival_jitter_ms"
+)
+
+def _per_minute(count, seconds):
+    return count * 60.0 / seconds if seconds else None
+
+class SessionSummary: #pylint: disable=too-many-instance-attributes
+    """
+    Sums over the connections of a capture file, which can be merged across chunks
+
+    Collisions are those of the current player, while arena_collisions counts every
+    collision received. Survival time runs from the first sync of the current player to its
+    death, or to the end of the connection. Sync intervals are in server milliseconds, and
+    arrival jitter is how much the capture timestamps deviate from them.
+    """
+    _SUMS = ("connections", "frames", "bytes", "decode_errors", "seconds", "kills", "deaths",
+             "spawns", "survival_seconds", "distance", "club_collisions", "wall_collisions",
+             "arena_collisions", "sync_intervals", "sync_interval_sum", "sync_interval_squares",
+             "jitter_squares")
+    __slots__ = _SUMS + ("sync_interval_max",)
+
+    def __init__(self):
+        self.connections = 0
+        self.frames = 0
+        self.bytes = 0
+        self.decode_errors = 0
+        self.seconds = 0.0
+        self.kills = 0
+        self.deaths = 0
+        self.spawns = 0
+        self.survival_seconds = 0.0
+        self.distance = 0.0
+        self.club_collisions = 0
+        self.wall_collisions = 0
+        self.arena_collisions = 0 # Of any player
+        self.sync_intervals = 0
+        self.sync_interval_sum = 0
+        self.sync_interval_squares = 0
+        self.jitter_squares = 0.0
+        self.sync_interval_max = None
+
+    def merge(self, other):
+        """Adds the sums of another summary of the same session"""
+        for name in self._SUMS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        if other.sync_interval_max is not None:
+            self.sync_interval_max = max(self.sync_interval_max or 0, other.sync_interval_max)
+
+    def row(self, session):
+        """Returns a dict of COLUMNS"""
+        intervals = self.sync_intervals
+        mean = self.sync_interval_sum / intervals if intervals else None
+        return dict(
+            session=session,
+            connections=self.connections,
+            frames=self.frames,
+            bytes=self.bytes,
+            decode_errors=self.decode_errors,
+            seconds=self.seconds,
+            kills=self.kills,
+            deaths=self.deaths,
+            kills_per_minute=_per_minute(self.kills, self.seconds),
+            deaths_per_minute=_per_minute(self.deaths, self.seconds),
+            spawns=self.spawns,
+            mean_survival_seconds=self.survival_seconds / self.spawns if self.spawns else None,
+            distance=self.distance,
+            club_collisions=self.club_collisions,
+            wall_collisions=self.wall_collisions,
+            club_collisions_per_minute=_per_minute(self.club_collisions, self.seconds),
+            wall_collisions_per_minute=_per_minute(self.wall_collisions, self.seconds),
+            arena_collisions_per_minute=_per_minute(self.arena_collisions, self.seconds),
+            sync_interval_ms_mean=mean,
+            sync_interval_ms_stdev=math.sqrt(max(
+                self.sync_interval_squares / intervals - mean * mean, 0.0)) if intervals else None,
+            sync_interval_ms_max=self.sync_interval_max,
+            arrival_jitter_ms=math.sqrt(self.jitter_squares / intervals) if intervals else None
+        )
+
+class _ConnectionAnalyzer: #pylint: disable=too-many-instance-attributes
+    """Replays the frames of one connection into a Session, adding to a SessionSummary"""
+    def __init__(self, summary):
+        self.summary = summary
+        self.session = Session(None, Mode.ffa)
+        self._decoder = InboundDecoder(Mode.ffa, self.session.arena.parsing_context)
+        self._first_time = None
+        self._last_time = None
+        self._spawn_time = None # Set while the current player is alive
+        self._last_position = None
+        self._last_sync = None # (capture time, server timestamp)
+        summary.connections += 1
+
+    def feed(self, timestamp, frame):
+        """Processes a frame received at timestamp"""
+        summary = self.summary
+        if self._first_time is None:
+            self._first_time = timestamp
+        self._last_time = timestamp
+        summary.frames += 1
+        summary.bytes += len(frame)
+        try:
+            packet = self._decoder.parse(frame)
+            if packet.extraneous:
+                raise DecodeError("Extraneous bytes in {} packet".format(packet.type))
+            self.session._received_packet_handler(packet) #pylint: disable=protected-access
+        # DecodeError, or KeyError and ValueError for packets inconsistent with the session
+        except (KeyError, ValueError):
+            summary.decode_errors += 1
+            return
+        handler = getattr(self, "_on_" + packet.type, None)
+        if handler is not None:
+            handler(timestamp, packet.payload)
+
+    def _current_id(self):
+        current_player = self.session.arena.current_player
+        return current_player.id if current_player is not None else None
+
+    def _end_life(self, timestamp):
+        if self._spawn_time is not None:
+            self.summary.survival_seconds += timestamp - self._spawn_time
+            self._spawn_time = None
+            self._last_position = None
+
+    def _on_killed(self, timestamp, payload): #pylint: disable=unused-argument
+        self._end_life(timestamp)
+
+    def _on_sync(self, timestamp, payload):
+        summary = self.summary
+        if self._last_sync is not None:
+            last_time, last_server_time = self._last_sync
+            interval = (payload.timestamp - last_server_time) & 0xFFFFFFFF
+            summary.sync_intervals += 1
+            summary.sync_interval_sum += interval
+            summary.sync_interval_squares += interval * interval
+            summary.sync_interval_max = max(summary.sync_interval_max or 0, interval)
+            jitter = (timestamp - last_time) * 1000 - interval
+            summary.jitter_squares += jitter * jitter
+        self._last_sync = (timestamp, payload.timestamp)
+        arena = self.session.arena
+        current_player = arena.current_player
+        if current_player is None or current_player.id not in arena.players:
+            return
+        if self._spawn_time is None:
+            self._spawn_time = timestamp
+            summary.spawns += 1
+        position = (current_player.position.x, current_player.position.y)
+        if self._last_position is not None:
+            summary.distance += math.hypot(position[0] - self._last_position[0],
+                                           position[1] - self._last_position[1])
+        self._last_position = position
+
+    def _on_club_collision(self, timestamp, payload): #pylint: disable=unused-argument
+        self.summary.arena_collisions += 1
+        if self._current_id() in (payload.first_id, payload.second_id):
+            self.summary.club_collisions += 1
+
+    def _on_wall_collision(self, timestamp, payload): #pylint: disable=unused-argument
+        self.summary.arena_collisions += 1
+        if payload.player_id == self._current_id():
+            self.summary.wall_collisions += 1
+
+    def close(self):
+        """Ends the connection"""
+        self.summary.kills += self.session.kills
+        self.summary.deaths += self.session.deaths
+        if self._last_time is not None:
+            self._end_life(self._last_time)
+            self.summary.seconds += self._last_time - self._first_time
+
+def analyze_chunk(task):
+    """Returns a tuple (path, SessionSummary) of a (path, start, end) chunk of a capture file"""
+    path, start, end = task
+    summary = SessionSummary()
+    connection = None
+    for timestamp, frame in capture.read_frames(path, start=start, end=end):
+        if not frame:
+            if connection is not None:
+                connection.close()
+            connection = _ConnectionAnalyzer(summary)
+        elif connection is not None:
+            connection.feed(timestamp, frame)
+    if connection is not None:
+        connection.close()
+    return path, summary
+
+def _capture_paths(paths):
+    """Yields the capture files among paths, expanding directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(capture.CAPTURE_EXTENSION):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def analyze(paths, workers=None, chunk_bytes=DEFAULT_CHUNK_MEGABYTES * 2**20):
+    """
+    Returns a dict of capture path -> SessionSummary
+
+    paths are capture files or directories of them. Chunks are analyzed in a pool of
+    workers processes (default: one per CPU), or in this process if workers is 1.
+    """
+    tasks = [(path, start, end) for path in _capture_paths(paths)
+             for start, end in capture.connection_chunks(path, chunk_bytes)]
+    summaries = dict()
+    for path, _, _ in tasks:
+        summaries.setdefault(path, SessionSummary())
+    if workers == 1 or len(tasks) <= 1:
+        results = map(analyze_chunk, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.get_context().Pool(min(workers or os.cpu_count(), len(tasks)))
+        results = pool.imap_unordered(analyze_chunk, tasks)
+    try:
+        for path, summary in results:
+            summaries[path].merge(summary)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return summaries
+
+def write_csv(summaries, output):
+    """Writes one row of COLUMNS per session to a file object"""
+    writer = csv.DictWriter(output, COLUMNS)
+    writer.writeheader()
+    for path, summary in summaries.items():
+        writer.writerow(summary.row(os.path.splitext(os.path.basename(path))[0]))
+
+def main(args):
+    """Entry-point"""
+    parser = argparse.ArgumentParser(
+        prog="autozlap analyze",
+        description="Summarize capture files (from --capture) into one CSV row per session")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="Capture files, or directories of them")
+    parser.add_argument("--output", "-o", metavar="FILE", default=None,
+                        help="CSV file to write (default: standard output)")
+    parser.add_argument("--workers", "-w", type=int, default=None,
+                        help="Number of processes to decode with (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_MEGABYTES,
+                        metavar="MB", help="Split capture files into chunks of whole "
+                        "connections of about this many megabytes (default: %(default)s)")
+    parsed_args = parser.parse_args(args)
+    start = time.perf_counter()
+    summaries = analyze(parsed_args.paths, parsed_args.workers, parsed_args.chunk_size * 2**20)
+    if parsed_args.output is None:
+        write_csv(summaries, sys.stdout)
+    else:
+        with open(parsed_args.output, "w", encoding="utf-8", newline="") as output:
+            write_csv(summaries, output)
+    elapsed = time.perf_counter() - start
+    total_bytes = sum(summary.bytes for summary in summaries.values())
+    print("Analyzed {} sessions, {} frames ({:.1f} MB) in {:.1f}s".format(
+        len(summaries), sum(summary.frames for summary in summaries.values()),
+        total_bytes / 1e6, elapsed), file=sys.stderr)
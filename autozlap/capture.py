@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Capture of received frames, and deterministic replay through Connection and Session.
+
+A capture file is CAPTURE_MAGIC followed by records of a little-endian float64 timestamp
+(seconds since the epoch), a uint32 length and the raw frame. A zero-length record marks the
+start of a new connection.
+"""
+
+import asyncio
+import collections
+import itertools
+import mmap
+import os
+import struct
+import time
+
+from .constants import Mode
+from .game_client import Session
+
+CAPTURE_MAGIC = b"AZCAP001"
+CAPTURE_EXTENSION = ".azcap"
+_RECORD_HEADER = struct.Struct("<dI")
+DEFAULT_FLUSH_FRAMES = 256
+
+class CaptureWriter:
+    """
+    Appends received frames to a capture file
+
+    Records are flushed to the file every flush_frames frames and at every connection
+    marker, so that little is lost if the process is killed.
+    """
+    def __init__(self, path, flush_frames=DEFAULT_FLUSH_FRAMES):
+        self.path = path
+        self.flush_frames = flush_frames
+        self._unflushed_frames = 0
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+
+    def write(self, frame, timestamp=None):
+        """Appends a frame, timestamped with the current time by default"""
+        if timestamp is None:
+            timestamp = time.time()
+        self._file.write(_RECORD_HEADER.pack(timestamp, len(frame)))
+        self._file.write(frame)
+        self._unflushed_frames += 1
+        if self._unflushed_frames >= self.flush_frames:
+            self.flush()
+
+    def mark_connection(self, timestamp=None):
+        """Marks the start of a new connection"""
+        self.write(b"", timestamp)
+        self.flush()
+
+    def flush(self):
+        """Flushes buffered records to the file"""
+        self._file.flush()
+        self._unflushed_frames = 0
+
+    def close(self):
+        """Flushes and closes the file"""
+        self._file.close()
+
+def session_capture_path(directory, index):
+    """Returns a capture file path in directory that is unique to this process and index"""
+    return os.path.join(directory, "session-{}-{}{}".format(os.getpid(), index,
+                                                           CAPTURE_EXTENSION))
+
+def _check_magic(magic, path):
+    if magic != CAPTURE_MAGIC:
+        raise ValueError("Not a capture file: " + str(path))
+
+def _iter_mmap(capture_file, path, start, end):
+    if os.fstat(capture_file.fileno()).st_size == 0:
+        raise ValueError("Not a capture file: " + str(path))
+    with mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        _check_magic(mapped[:len(CAPTURE_MAGIC)], path)
+        offset = max(start, len(CAPTURE_MAGIC))
+        size = len(mapped) if end is None else min(end, len(mapped))
+        while offset + _RECORD_HEADER.size <= size:
+            timestamp, length = _RECORD_HEADER.unpack_from(mapped, offset)
+            offset += _RECORD_HEADER.size
+            if offset + length > size:
+                break # Truncated by an interrupted write
+            yield timestamp, mapped[offset:offset + length]
+            offset += length
+
+def _iter_stream(capture_file, path, start, end):
+    _check_magic(capture_file.read(len(CAPTURE_MAGIC)), path)
+    if start > len(CAPTURE_MAGIC):
+        capture_file.seek(start)
+    while end is None or capture_file.tell() + _RECORD_HEADER.size <= end:
+        header = capture_file.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            break
+        timestamp, length = _RECORD_HEADER.unpack(header)
+        frame = capture_file.read(length)
+        if len(frame) < length:
+            break # Truncated by an interrupted write
+        yield timestamp, frame
+
+def read_frames(path, use_mmap=True, start=0, end=None):
+    """
+    Yields (timestamp, frame) for every record in a capture file, including connection markers
+
+    With use_mmap, the file is memory-mapped instead of read with buffered I/O.
+    Neither loads the whole file into memory. start and end restrict reading to the records
+    between these byte offsets, which must be record boundaries, e.g. from connection_chunks().
+    """
+    with open(path, "rb") as capture_file:
+        if use_mmap:
+            yield from _iter_mmap(capture_file, path, start, end)
+        else:
+            yield from _iter_stream(capture_file, path, start, end)
+
+def connection_chunks(path, chunk_bytes):
+    """
+    Returns a list of (start, end) byte offsets that split a capture file into chunks of
+    whole connections, of at least chunk_bytes each except for the last one
+
+    Only the record headers are read. Each chunk can be read with read_frames() and processed
+    independently, since state is reset at every connection.
+    """
+    chunks = list()
+    with open(path, "rb") as capture_file:
+        size = os.fstat(capture_file.fileno()).st_size
+        if size <= len(CAPTURE_MAGIC) + chunk_bytes:
+            return [(0, None)]
+        with mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            _check_magic(mapped[:len(CAPTURE_MAGIC)], path)
+            chunk_start = offset = len(CAPTURE_MAGIC)
+            while offset + _RECORD_HEADER.size <= size:
+                _, length = _RECORD_HEADER.unpack_from(mapped, offset)
+                if not length and offset - chunk_start >= chunk_bytes:
+                    chunks.append((chunk_start, offset))
+                    chunk_start = offset
+                offset += _RECORD_HEADER.size + length
+    chunks.append((chunk_start, None))
+    return chunks
+
+def split_connections(frames):
+    """
+    Yields an iterator of the (timestamp, frame) records of each connection, leaving out
+    connection markers and connections without frames
+
+    Records are streamed rather than collected, so each iterator must be consumed before
+    the next one is taken.
+    """
+    connection_number = 0
+    def _connection_number(record):
+        nonlocal connection_number
+        if not record[1]:
+            connection_number += 1
+        return connection_number
+    for _, records in itertools.groupby(frames, _connection_number):
+        records = (record for record in records if record[1])
+        first_record = next(records, None)
+        if first_record is not None:
+            yield itertools.chain((first_record,), records)
+
+_ReplayMessage = collections.namedtuple("_ReplayMessage", ("type", "data"))
+
+class ReplayWebsocket:
+    """
+    A stand-in for an aiohttp websocket that yields recorded frames
+
+    If paced, frames are delivered at their recorded intervals. Sent frames are discarded.
+    """
+    def __init__(self, loop, frames, paced=False):
+        self._loop = loop
+        self._frames = iter(frames)
+        self._paced = paced
+        self._first_timestamp = None
+        self._start_time = None
+        self.sent_frames = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            timestamp, frame = next(self._frames)
+        except StopIteration as exc:
+            raise StopAsyncIteration from exc
+        if self._paced:
+            if self._first_timestamp is None:
+                self._first_timestamp = timestamp
+                self._start_time = self._loop.time()
+            delay = (timestamp - self._first_timestamp) - (self._loop.time() - self._start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        from aiohttp import WSMsgType
+        return _ReplayMessage(WSMsgType.BINARY, frame)
+
+    def send_bytes(self, data): #pylint: disable=unused-argument
+        """Discards an outbound frame"""
+        self.sent_frames += 1
+
+async def replay(loop, path, session=None, paced=False, use_mmap=True):
+    """
+    Replays a capture file through Connection parsing and Session._received_packet_handler
+
+    session defaults to a new game_client.Session in FFA mode. The session is reset at
+    every connection marker, as it would be on reconnect. Frames are streamed from the file.
+    Returns a dict of stats: frames, bytes, seconds, frames_per_second.
+    """
+    if session is None:
+        session = Session(loop, Mode.ffa)
+    start_frames = session.stats.packets_received
+    start_bytes = session.stats.bytes_received
+    start_time = time.perf_counter()
+    for connection_number, frames in enumerate(split_connections(read_frames(path, use_mmap))):
+        if connection_number > 0:
+            session.reset()
+        await session.listen(ReplayWebsocket(loop, frames, paced))
+    elapsed = time.perf_counter() - start_time
+    frame_count = session.stats.packets_received - start_frames
+    return dict(
+        frames=frame_count,
+        bytes=session.stats.bytes_received - start_bytes,
+        seconds=elapsed,
+        frames_per_second=frame_count / elapsed if elapsed else 0.0
+    )
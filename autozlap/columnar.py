@@ -0,0 +1,227 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Columnar Arena backend.
+
+Player and mace states are kept in one contiguous float32 NumPy array, indexed by slot.
+Player, Mace and Vector objects are thin views into it. Requires NumPy.
+"""
+
+import numpy
+
+from .game_client import Arena, Player
+
+# Columns of PlayerStore.state, in the same order as a sync_array entry on the wire
+POSITION = 0
+VELOCITY = 2
+MACE_POSITION = 4
+MACE_VELOCITY = 6
+MACE_RADIUS = 8
+STATE_WIDTH = 9
+
+_INITIAL_CAPACITY = 64
+
+class SlotVector:
+    """A Vector view into a two-column section of a PlayerStore row"""
+    __slots__ = ("_store", "_slot", "_column")
+
+    def __init__(self, store, slot, column):
+        self._store = store
+        self._slot = slot
+        self._column = column
+
+    @property
+    def x(self): #pylint: disable=invalid-name
+        """The x component"""
+        return float(self._store.state[self._slot, self._column])
+
+    @property
+    def y(self): #pylint: disable=invalid-name
+        """The y component"""
+        return float(self._store.state[self._slot, self._column + 1])
+
+    def rebind(self, slot):
+        """Points the view at another slot"""
+        self._slot = slot
+
+    def update(self, vector2d_struct):
+        """Update the vector values based on a vector2d Struct"""
+        self._store.state[self._slot, self._column:self._column + 2] = (
+            vector2d_struct.x, vector2d_struct.y)
+
+class PlayerStore:
+    """
+    Slot-allocated float32 storage for player and mace states
+
+    state has one row of STATE_WIDTH columns per slot. ids maps slot -> player id,
+    with -1 for free slots. Freed slots are reused before the arrays are grown.
+    """
+    def __init__(self, capacity=_INITIAL_CAPACITY):
+        self.state = numpy.full((capacity, STATE_WIDTH), numpy.nan, dtype=numpy.float32)
+        self.ids = numpy.full(capacity, -1, dtype=numpy.int64)
+        self.index = dict() # id -> slot
+        self._free_slots = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _grow(self):
+        old_capacity = len(self.ids)
+        new_capacity = old_capacity * 2
+        state = numpy.full((new_capacity, STATE_WIDTH), numpy.nan, dtype=numpy.float32)
+        state[:old_capacity] = self.state
+        ids = numpy.full(new_capacity, -1, dtype=numpy.int64)
+        ids[:old_capacity] = self.ids
+        self.state = state
+        self.ids = ids
+        self._free_slots.extend(range(new_capacity - 1, old_capacity - 1, -1))
+
+    def allocate(self, player_id):
+        """Returns a slot for player_id, allocating one if needed"""
+        slot = self.index.get(player_id)
+        if slot is None:
+            if not self._free_slots:
+                self._grow()
+            slot = self._free_slots.pop()
+            self.index[player_id] = slot
+            self.ids[slot] = player_id
+        return slot
+
+    def free(self, player_id):
+        """Frees the slot of player_id"""
+        slot = self.index.pop(player_id)
+        self.ids[slot] = -1
+        self.state[slot] = numpy.nan
+        self._free_slots.append(slot)
+
+    def write(self, slots, rows):
+        """Writes state rows into the given slots in one batched operation"""
+        self.state[slots] = rows
+
+    def snapshot(self):
+        """Returns a tuple (ids, state) of copies for all occupied slots"""
+        occupied = self.ids >= 0
+        return self.ids[occupied], self.state[occupied]
+
+class ColumnarArena(Arena):
+    """
+    An Arena backed by a PlayerStore
+
+    Player objects in players are views that read from the store. A view must not be used
+    after its player is removed, since the slot may be reused by another player.
+    """
+    accepts_sync_arrays = True
+
+    def __init__(self):
+        super().__init__()
+        self.store = PlayerStore()
+
+    def reset(self):
+        """Forgets all state, e.g. before reconnecting. The spatial index stays enabled"""
+        super().reset()
+        self.store = PlayerStore()
+
+    def _create_player(self, player_id):
+        slot = self.store.allocate(player_id)
+        return Player(
+            player_id,
+            SlotVector(self.store, slot, POSITION),
+            SlotVector(self.store, slot, VELOCITY),
+            SlotVector(self.store, slot, MACE_POSITION),
+            SlotVector(self.store, slot, MACE_VELOCITY)
+        )
+
+    def set_current_player(self, player_id):
+        """Creates and registers the current player from a setup packet"""
+        # Like Arena, a previous current player that is still alive keeps its slot until
+        # it is removed
+        self.current_player = self._create_player(player_id)
+        self.players[player_id] = self.current_player
+        self._track_current_player(player_id)
+
+    def remove_player(self, player_id):
+        """Removes a player from the arena"""
+        super().remove_player(player_id)
+        self.store.free(player_id)
+
+    def _add_player(self, sync_struct):
+        player_id = sync_struct.player_id
+        if player_id == self.current_player.id:
+            # The slot was freed when the current player was killed
+            slot = self.store.allocate(player_id)
+            player_obj = self.current_player
+            for vector in (player_obj.position, player_obj.velocity, player_obj.mace.position,
+                           player_obj.mace.velocity):
+                vector.rebind(slot)
+        else:
+            player_obj = self._create_player(player_id)
+            if sync_struct.player_attributes.player_name:
+                player_obj.name = sync_struct.player_attributes.player_name
+        self._register_player(player_obj)
+
+    def apply_sync(self, sync_payload):
+        """
+        Applies the removals and player states of a sync packet payload
+
+        The payload may come from either decoder.InboundDecoder or sync_arrays.ArraySyncDecoder
+        """
+        for player_id in sync_payload.removal_array:
+            self.remove_player(player_id)
+        if "records" in sync_payload:
+            self._apply_sync_records(sync_payload.records, sync_payload.new_players)
+        elif sync_payload.sync_array:
+            self._apply_sync_array(sync_payload.sync_array)
+        if self.spatial_index is not None:
+            self.spatial_index.apply_sync(sync_payload)
+        if self.predictor is not None:
+            self.predictor.observe_sync(sync_payload)
+
+    def _apply_sync_array(self, sync_array):
+        slots = list()
+        rows = list()
+        index = self.store.index
+        for sync_struct in sync_array:
+            if sync_struct.is_new_player:
+                self._add_player(sync_struct)
+            slots.append(index[sync_struct.player_id])
+            player_state = sync_struct.player_state
+            mace_state = sync_struct.mace_state
+            rows.append((
+                player_state.position.x, player_state.position.y,
+                player_state.velocity.x, player_state.velocity.y,
+                mace_state.position.x, mace_state.position.y,
+                mace_state.velocity.x, mace_state.velocity.y,
+                sync_struct.mace_radius
+            ))
+        self.store.write(slots, rows)
+
+    def _apply_sync_records(self, records, new_players):
+        for sync_struct in new_players:
+            self._add_player(sync_struct)
+        if not len(records): #pylint: disable=len-as-condition
+            return
+        index = self.store.index
+        slots = [index[player_id] for player_id in records["player_id"].tolist()]
+        self.store.write(slots, records["state"])
+
+    def snapshot(self):
+        """Returns a tuple (ids, state) of NumPy arrays for all players. See PlayerStore"""
+        return self.store.snapshot()
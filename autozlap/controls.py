@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Coalescing of player inputs into outbound packets.
+
+Inputs only change the desired control state. Once per tick, the difference between the
+desired state and the state last sent to the server is sent, so superseded directions and
+move/stop pairs within a tick never reach the wire.
+"""
+
+import asyncio
+import logging
+import math
+
+from . import encoder
+
+DEFAULT_TICK_INTERVAL = 0.05 # seconds
+DEFAULT_DIRECTION_EPSILON = 1e-3 # radians
+
+_logger = logging.getLogger(__name__)
+
+def _angle_difference(first, second):
+    difference = (first - second) % (2 * math.pi)
+    return min(difference, 2 * math.pi - difference)
+
+class InputScheduler:
+    """
+    Merges the inputs of a Session within each tick and flushes them to its Connection
+
+    Direction changes smaller than direction_epsilon radians are not sent.
+    """
+    def __init__(self, loop, tick_interval=DEFAULT_TICK_INTERVAL,
+                 direction_epsilon=DEFAULT_DIRECTION_EPSILON):
+        self._loop = loop
+        self.tick_interval = tick_interval
+        self.direction_epsilon = direction_epsilon
+        self._connection = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.direction = None # Desired angle in radians, or None if never set
+        self.moving = dict.fromkeys(encoder.MOVE_DIRECTIONS, False) # Desired move keys
+        self._sent_direction = None
+        self._sent_moving = dict.fromkeys(encoder.MOVE_DIRECTIONS, False)
+        self.inputs = 0 # Calls to set_direction(), press() and release()
+
+    def set_direction(self, angle):
+        """Sets the desired direction in radians"""
+        self.direction = angle
+        self._input()
+
+    def press(self, direction):
+        """Starts moving in direction, one of encoder.MOVE_DIRECTIONS"""
+        self.moving[direction] = True
+        self._input()
+
+    def release(self, direction):
+        """Stops moving in direction, one of encoder.MOVE_DIRECTIONS"""
+        self.moving[direction] = False
+        self._input()
+
+    def _input(self):
+        self.inputs += 1
+        self._wakeup.set()
+
+    def pending_frames(self, mark_sent=False):
+        """
+        Returns the frames needed to bring the server up to date with the desired state
+
+        If mark_sent, the frames are assumed to be sent.
+        """
+        frames = list()
+        if self.direction is not None and (
+                self._sent_direction is None or _angle_difference(
+                    self.direction, self._sent_direction) >= self.direction_epsilon):
+            frames.append(encoder.encode_direction(self.direction))
+            if mark_sent:
+                self._sent_direction = self.direction
+        for direction in encoder.MOVE_DIRECTIONS:
+            moving = self.moving[direction]
+            if moving != self._sent_moving[direction]:
+                frames.append(encoder.encode_move(direction, moving))
+                if mark_sent:
+                    self._sent_moving[direction] = moving
+        return frames
+
+    async def flush(self):
+        """Sends any pending changes now"""
+        if self._connection is None:
+            return
+        frames = self.pending_frames(mark_sent=True)
+        if frames:
+            await self._connection.write_frames(frames)
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.flush()
+            # At most one flush per tick; inputs until then are merged
+            await asyncio.sleep(self.tick_interval)
+
+    def attach(self, connection):
+        """
+        Starts flushing to a new networking.Connection
+
+        The server starts with nothing pressed, so any held keys and the direction are
+        sent again on the first tick.
+        """
+        self._connection = connection
+        self._sent_direction = None
+        self._sent_moving = dict.fromkeys(encoder.MOVE_DIRECTIONS, False)
+        self._wakeup.set()
+        if self._task is None:
+            self._task = self._loop.create_task(self._flush_loop())
+
+    async def detach(self):
+        """Stops flushing to the current Connection"""
+        self._connection = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as exc: #pylint: disable=broad-except
+                _logger.warning("Input flush failed: %r", exc)
+            self._task = None
@@ -0,0 +1,319 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hand-rolled decoder for inbound packets.
+
+Produces the same logical objects as the construct schema in schema.INBOUND_PACKET,
+but uses fixed-layout struct.Struct unpackers that are compiled once at import time.
+"""
+
+import struct
+
+from .constants import CLIENT_VERSION, Mode
+
+# Fixed-layout unpackers (all little-endian, matching the construct schema)
+_UINT32 = struct.Struct("<I")
+_VECTOR2D = struct.Struct("<2f")
+_SETUP_TAIL = struct.Struct("<IBI4f")
+_KILL = struct.Struct("<II2fII")
+_REMOVE = struct.Struct("<II")
+_SYNC_HEADER = struct.Struct("<II")
+_SYNC_ATTRIBUTES = struct.Struct("<fB")
+_SYNC_STATE = struct.Struct("<9f")
+_CLUB_COLLISION = struct.Struct("<I2ffI4fI4f")
+_WALL_COLLISION = struct.Struct("<I2ffI4ff")
+_LEADERBOARD_HEADER = struct.Struct("<II")
+_LEADERBOARD_FFA_HEADER = struct.Struct("<BI")
+_LEADERBOARD_FFA_TAIL = struct.Struct("<III")
+_LEADERBOARD_TDM_TEAM = struct.Struct("<BII")
+
+PACKET_TYPES = (
+    "setup",
+    "killed",
+    "kill",
+    "remove",
+    "sync",
+    "club_collision",
+    "wall_collision",
+    "set_leaderboard",
+    "set_target_dim"
+)
+
+_GAME_MODES = {
+    0: Mode.ffa,
+    1: Mode.tdm
+}
+
+class DecodeError(ValueError):
+    """Raised when a packet cannot be decoded"""
+
+class Record(dict):
+    """A dict with attribute access, equivalent to construct's Container"""
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+def _vector2d(x, y): #pylint: disable=invalid-name
+    return Record(x=x, y=y)
+
+def _physical_state(pos_x, pos_y, vel_x, vel_y):
+    return Record(position=Record(x=pos_x, y=pos_y), velocity=Record(x=vel_x, y=vel_y))
+
+class ParsingContext:
+    """
+    The arena state that sync packets are parsed against
+
+    Entries of players in known_ids carry only a state. Other entries also carry attributes,
+    with a name unless they are of the current player. Only the state layer
+    (game_client.Arena) updates it, as it applies packets; decoders only read it.
+    """
+    __slots__ = ("known_ids", "current_player_id")
+
+    def __init__(self, known_ids=(), current_player_id=None):
+        self.known_ids = set(known_ids)
+        self.current_player_id = current_player_id
+
+    def reset(self):
+        """Forgets every player, e.g. before reconnecting"""
+        self.known_ids.clear()
+        self.current_player_id = None
+
+    def is_new_player(self, player_id):
+        """Whether the sync entry of player_id carries attributes"""
+        return player_id not in self.known_ids
+
+    def is_current_player(self, player_id):
+        """Whether player_id is the current player, whose attributes carry no name"""
+        return player_id == self.current_player_id
+
+def _read_cstring(data, offset):
+    """Returns a tuple (string, new offset) for the null-terminated string at offset"""
+    end = data.index(b"\0", offset)
+    return bytes(data[offset:end]).decode("utf8"), end + 1
+
+class InboundDecoder:
+    """
+    Decodes inbound packets into Records
+
+    context is the ParsingContext that sync entries are classified with.
+    """
+
+    def __init__(self, mode, context):
+        self._mode = mode
+        self._context = context
+        self._payload_decoders = (
+            self._decode_setup,
+            self._decode_killed,
+            self._decode_kill,
+            self._decode_remove,
+            self._decode_sync,
+            self._decode_club_collision,
+            self._decode_wall_collision,
+            self._decode_set_leaderboard,
+            self._decode_set_target_dim
+        )
+
+    def parse(self, data):
+        """Decodes a raw packet. Mirrors construct's Struct.parse()"""
+        if not data:
+            raise DecodeError("Empty packet")
+        type_num = data[0]
+        if type_num >= len(PACKET_TYPES):
+            raise DecodeError("Unknown packet type: {}".format(type_num))
+        try:
+            payload, offset = self._payload_decoders[type_num](data, 1)
+        except (struct.error, ValueError) as exc:
+            raise DecodeError("Malformed {} packet: {}".format(PACKET_TYPES[type_num],
+                                                               exc)) from exc
+        return Record(
+            type=PACKET_TYPES[type_num],
+            payload=payload,
+            extraneous=bytes(data[offset:])
+        )
+
+    def _decode_setup(self, data, offset): #pylint: disable=no-self-use
+        server_version, offset = _read_cstring(data, offset)
+        if server_version != CLIENT_VERSION:
+            raise DecodeError("Unsupported server version: " + server_version)
+        (initial_time, game_mode, current_player_id, dim_x, dim_y, target_x,
+         target_y) = _SETUP_TAIL.unpack_from(data, offset)
+        if game_mode not in _GAME_MODES:
+            raise DecodeError("Unknown game mode: {}".format(game_mode))
+        return Record(
+            server_version=server_version,
+            initial_time=initial_time,
+            game_mode=_GAME_MODES[game_mode],
+            current_player_id=current_player_id,
+            dimensions=_vector2d(dim_x, dim_y),
+            target_dimensions=_vector2d(target_x, target_y)
+        ), offset + _SETUP_TAIL.size
+
+    def _decode_killed(self, data, offset): #pylint: disable=no-self-use,unused-argument
+        return None, offset
+
+    def _decode_kill(self, data, offset): #pylint: disable=no-self-use
+        (timestamp, killed_id, death_x, death_y, killer_id,
+         point_orb_count) = _KILL.unpack_from(data, offset)
+        return Record(
+            timestamp=timestamp,
+            killed_id=killed_id,
+            death_position=_vector2d(death_x, death_y),
+            killer_id=killer_id,
+            point_orb_count=point_orb_count
+        ), offset + _KILL.size
+
+    def _decode_remove(self, data, offset): #pylint: disable=no-self-use
+        timestamp, player_id = _REMOVE.unpack_from(data, offset)
+        return Record(timestamp=timestamp, player_id=player_id), offset + _REMOVE.size
+
+    @staticmethod
+    def _decode_sync_header(data, offset):
+        """Returns a tuple (timestamp, removal_array, sync_count, new offset)"""
+        timestamp, remove_count = _SYNC_HEADER.unpack_from(data, offset)
+        offset += _SYNC_HEADER.size
+        removal_array = list(struct.unpack_from("<{}I".format(remove_count), data, offset))
+        offset += 4 * remove_count
+        sync_count, = _UINT32.unpack_from(data, offset)
+        return timestamp, removal_array, sync_count, offset + 4
+
+    def _decode_player_attributes(self, data, offset, player_id):
+        """Decodes the attributes that precede the state of a new player"""
+        if player_id != self._context.current_player_id:
+            player_name, offset = _read_cstring(data, offset)
+        else:
+            player_name = None
+        shield, team_or_skin = _SYNC_ATTRIBUTES.unpack_from(data, offset)
+        return Record(
+            player_name=player_name,
+            shield=shield,
+            team_or_skin=team_or_skin
+        ), offset + _SYNC_ATTRIBUTES.size
+
+    def _decode_sync(self, data, offset):
+        timestamp, removal_array, sync_count, offset = self._decode_sync_header(data, offset)
+        sync_array = list()
+        unpack_id = _UINT32.unpack_from
+        unpack_state = _SYNC_STATE.unpack_from
+        known_ids = self._context.known_ids
+        for _ in range(sync_count):
+            player_id, = unpack_id(data, offset)
+            offset += 4
+            is_new_player = player_id not in known_ids
+            if is_new_player:
+                player_attributes, offset = self._decode_player_attributes(data, offset,
+                                                                           player_id)
+            else:
+                player_attributes = None
+            (pos_x, pos_y, vel_x, vel_y, mace_pos_x, mace_pos_y, mace_vel_x, mace_vel_y,
+             mace_radius) = unpack_state(data, offset)
+            offset += _SYNC_STATE.size
+            sync_array.append(Record(
+                player_id=player_id,
+                is_new_player=is_new_player,
+                player_attributes=player_attributes,
+                player_state=_physical_state(pos_x, pos_y, vel_x, vel_y),
+                mace_state=_physical_state(mace_pos_x, mace_pos_y, mace_vel_x, mace_vel_y),
+                mace_radius=mace_radius
+            ))
+        return Record(
+            timestamp=timestamp,
+            remove_count=len(removal_array),
+            removal_array=removal_array,
+            sync_count=sync_count,
+            sync_array=sync_array
+        ), offset
+
+    def _decode_club_collision(self, data, offset): #pylint: disable=no-self-use
+        values = _CLUB_COLLISION.unpack_from(data, offset)
+        return Record(
+            timestamp=values[0],
+            p=_vector2d(values[1], values[2]),
+            i=values[3],
+            first_id=values[4],
+            first_state=_physical_state(*values[5:9]),
+            second_id=values[9],
+            second_state=_physical_state(*values[10:14])
+        ), offset + _CLUB_COLLISION.size
+
+    def _decode_wall_collision(self, data, offset): #pylint: disable=no-self-use
+        values = _WALL_COLLISION.unpack_from(data, offset)
+        return Record(
+            timestamp=values[0],
+            p=_vector2d(values[1], values[2]),
+            i=values[3],
+            player_id=values[4],
+            player_state=_physical_state(*values[5:9]),
+            mace_radius=values[9]
+        ), offset + _WALL_COLLISION.size
+
+    def _decode_set_leaderboard(self, data, offset): #pylint: disable=no-self-use
+        player_count, total = _LEADERBOARD_HEADER.unpack_from(data, offset)
+        offset += _LEADERBOARD_HEADER.size
+        # The body is only decoded on demand, by decode_leaderboard_body()
+        return Record(player_count=player_count, total=total,
+                      body=bytes(data[offset:])), len(data)
+
+    def _decode_set_target_dim(self, data, offset): #pylint: disable=no-self-use
+        target_x, target_y = _VECTOR2D.unpack_from(data, offset)
+        return Record(target_dimensions=_vector2d(target_x, target_y)), offset + _VECTOR2D.size
+
+def decode_leaderboard_body(mode, body):
+    """
+    Decodes the body of a set_leaderboard payload for a Mode. Mirrors schema.LEADERBOARD_BODY
+
+    Returns a Record with first_entry_id, entries (Records with name and score), king (a
+    Record with name and score), place and score in FFA mode, or with teams (Records with
+    id, score and count) in TDM mode. Both have extraneous, the bytes after the body.
+    """
+    if not isinstance(mode, Mode):
+        raise DecodeError("Unknown mode: {}".format(mode))
+    try:
+        if mode == Mode.ffa:
+            count, first_entry_id = _LEADERBOARD_FFA_HEADER.unpack_from(body, 0)
+            offset = _LEADERBOARD_FFA_HEADER.size
+            entries = list()
+            for _ in range(count):
+                name, offset = _read_cstring(body, offset)
+                score, = _UINT32.unpack_from(body, offset)
+                offset += _UINT32.size
+                entries.append(Record(name=name, score=score))
+            king_name, offset = _read_cstring(body, offset)
+            king_score, place, score = _LEADERBOARD_FFA_TAIL.unpack_from(body, offset)
+            offset += _LEADERBOARD_FFA_TAIL.size
+            result = Record(first_entry_id=first_entry_id, entries=entries,
+                            king=Record(name=king_name, score=king_score), place=place,
+                            score=score)
+        else:
+            teams = list()
+            for index in range(3):
+                team_id, score, count = _LEADERBOARD_TDM_TEAM.unpack_from(
+                    body, index * _LEADERBOARD_TDM_TEAM.size)
+                teams.append(Record(id=team_id, score=score, count=count))
+            offset = 3 * _LEADERBOARD_TDM_TEAM.size
+            result = Record(teams=teams)
+    except (struct.error, ValueError) as exc:
+        raise DecodeError("Malformed set_leaderboard body: {}".format(exc)) from exc
+    result["extraneous"] = bytes(body[offset:])
+    return result
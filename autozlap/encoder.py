@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Encoder for outbound packets.
+
+Produces the same bytes as the construct schema in schema.OUTBOUND_PACKET. Packets without
+a payload are precomputed byte templates.
+"""
+
+import struct
+
+OUTBOUND_TYPES = (
+    "play",
+    "direction",
+    "move_up",
+    "move_down",
+    "move_left",
+    "move_right",
+    "stop_move_up",
+    "stop_move_down",
+    "stop_move_left",
+    "stop_move_right"
+)
+MOVE_DIRECTIONS = ("up", "down", "left", "right")
+
+_DIRECTION = struct.Struct("<Bf")
+_DIRECTION_TYPE = OUTBOUND_TYPES.index("direction")
+
+# Frames of the packets without a payload
+_TEMPLATES = {packet_type: bytes((index,)) for index, packet_type in enumerate(OUTBOUND_TYPES)
+              if packet_type != "direction"}
+PLAY = _TEMPLATES["play"]
+MOVE_FRAMES = {direction: _TEMPLATES["move_" + direction] for direction in MOVE_DIRECTIONS}
+STOP_MOVE_FRAMES = {direction: _TEMPLATES["stop_move_" + direction]
+                    for direction in MOVE_DIRECTIONS}
+
+def encode_direction(angle):
+    """Returns a direction packet for angle in radians"""
+    return _DIRECTION.pack(_DIRECTION_TYPE, angle)
+
+def encode_move(direction, moving=True):
+    """Returns a move_* packet, or a stop_move_* packet if not moving"""
+    return MOVE_FRAMES[direction] if moving else STOP_MOVE_FRAMES[direction]
+
+def encode(packet):
+    """Returns the frame for a packet given as dict(type=..., payload=...)"""
+    packet_type = packet["type"]
+    template = _TEMPLATES.get(packet_type)
+    if template is not None:
+        return template
+    if packet_type == "direction":
+        return encode_direction(packet["payload"]["angle"])
+    raise ValueError("Unknown outbound packet type: {!r}".format(packet_type))
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Streams of game events for consumers outside of the receive loop.
+
+Each subscriber gets its own bounded queue. When a queue is full, its oldest event is
+dropped, so a slow consumer never stalls packet handling. Events are only built for streams
+with subscribers.
+"""
+
+import asyncio
+import collections
+
+DEFAULT_QUEUE_SIZE = 256
+STREAMS = ("kills", "collisions", "leaderboard")
+
+KillEvent = collections.namedtuple("KillEvent", (
+    "timestamp", "killed_id", "killer_id", "position", "point_orb_count"))
+KillEvent.__doc__ = "A player was killed. position is the (x, y) of the death"
+
+ClubCollisionEvent = collections.namedtuple("ClubCollisionEvent", (
+    "timestamp", "first_id", "second_id", "position"))
+ClubCollisionEvent.__doc__ = "The maces of two players collided. position is the (x, y) of p"
+
+WallCollisionEvent = collections.namedtuple("WallCollisionEvent", (
+    "timestamp", "player_id", "position"))
+WallCollisionEvent.__doc__ = "A player hit the arena border. position is the (x, y) of p"
+
+LeaderboardEvent = collections.namedtuple("LeaderboardEvent", (
+    "player_count", "entries", "king", "place", "score", "teams"))
+LeaderboardEvent.__doc__ = """
+The leaderboard changed
+
+entries is a tuple of (name, score), king a (name, score) tuple, and place and score are
+the current player's, in FFA mode. teams is a tuple of (id, score, count) in TDM mode.
+Fields of the other mode are None.
+"""
+
+class DropOldestQueue(asyncio.Queue):
+    """An asyncio.Queue whose put_nowait() drops the oldest item instead of raising when full"""
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, **kwargs):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        super().__init__(maxsize, **kwargs)
+        self.dropped = 0
+
+    def put_nowait(self, item):
+        if self.full():
+            self.get_nowait()
+            self.dropped += 1
+        super().put_nowait(item)
+
+class EventStreams:
+    """The event streams of a Session, one of STREAMS each"""
+    def __init__(self):
+        self._subscribers = {stream: list() for stream in STREAMS}
+        self.published = collections.Counter() # stream -> events published
+        self._dropped = collections.Counter() # stream -> events dropped by removed queues
+
+    def subscribe(self, stream, maxsize=DEFAULT_QUEUE_SIZE):
+        """Returns a new DropOldestQueue receiving the events of stream"""
+        queue = DropOldestQueue(maxsize)
+        self._subscribers[stream].append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        """Stops delivering events to a queue returned by subscribe()"""
+        for stream, queues in self._subscribers.items():
+            if queue in queues:
+                queues.remove(queue)
+                self._dropped[stream] += queue.dropped
+
+    def has_subscribers(self, stream):
+        """Whether any queue receives the events of stream"""
+        return bool(self._subscribers[stream])
+
+    def publish(self, stream, event):
+        """Delivers event to every subscriber of stream"""
+        self.published[stream] += 1
+        for queue in self._subscribers[stream]:
+            queue.put_nowait(event)
+
+    def dropped(self):
+        """Returns a dict of stream -> events dropped from full queues"""
+        return {stream: self._dropped[stream] + sum(queue.dropped for queue in queues)
+                for stream, queues in self._subscribers.items()}
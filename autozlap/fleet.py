@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs a set of Sessions on one event loop, along with their policies, capture files and
+metrics exporters. Used by main for a single process, and by sharding in each worker.
+"""
+
+import asyncio
+import logging
+
+from .constants import Mode
+from . import capture, game_client, instrumentation, policy, supervisor
+
+_logger = logging.getLogger(__name__)
+
+async def run_sessions(loop, placements, arena_class=game_client.Arena, directory=None,
+                       reconnect_policy=None, capture_directory=None, metrics_options=None,
+                       policy_options=None, dashboard_options=None, receive_queue=0,
+                       monitor=None):
+    """
+    Runs a Session for each (address, port) in placements until they stop
+
+    directory is the server_selector.ServerDirectory for reconnect_policy.repick_server, or
+    None. If capture_directory is given, each Session records its received frames to a
+    capture file in it. metrics_options are passed to instrumentation.start_exporters(),
+    policy_options to policy.attach_policies(), dashboard_options to
+    supervisor.create_supervisor(), and receive_queue to each game_client.Session.
+
+    monitor is a coroutine function called with the list of Sessions and the list of their
+    tasks; the Sessions are stopped once it returns. By default, they run until they all
+    finish. Returns the result of monitor, or None.
+    """
+    writers = list()
+    sessions = list()
+    for index in range(len(placements)):
+        writer = None
+        if capture_directory is not None:
+            writer = capture.CaptureWriter(capture.session_capture_path(capture_directory, index))
+            writers.append(writer)
+        sessions.append(game_client.Session(loop, Mode.ffa, arena_class, writer, receive_queue))
+    tasks = [loop.create_task(session.run(address, port, directory, reconnect_policy))
+             for session, (address, port) in zip(sessions, placements)]
+    executor = None
+    if policy_options:
+        executor = policy.attach_policies(sessions, **policy_options)
+    exporters = await instrumentation.start_exporters(loop, sessions, **(metrics_options or dict()))
+    fleet_supervisor = supervisor.create_supervisor(loop, sessions, **(dashboard_options or dict()))
+    try:
+        if monitor is None:
+            await asyncio.wait(tasks)
+            result = None
+        else:
+            result = await monitor(sessions, tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for index, task_result in enumerate(results):
+            if isinstance(task_result, Exception):
+                _logger.error("Session %d failed: %r", index, task_result)
+        if fleet_supervisor is not None:
+            await fleet_supervisor.stop()
+        await instrumentation.stop_exporters(exporters)
+        if executor is not None:
+            executor.shutdown(wait=False)
+        for writer in writers:
+            writer.close()
+    return result
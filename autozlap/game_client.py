@@ -20,9 +20,20 @@
 
 """Game client component"""
 
-import aiohttp
+import asyncio
+import logging
+import random
 
-from .networking import Connection
+from .controls import InputScheduler
+from .decoder import ParsingContext, decode_leaderboard_body
+from .events import (EventStreams, KillEvent, ClubCollisionEvent, WallCollisionEvent,
+                     LeaderboardEvent)
+from .networking import Connection, ConnectionStats
+from .policy import PolicyRunner
+from . import transport
+from .spatial import ArenaIndex
+
+_logger = logging.getLogger(__name__)
 
 class Vector:
     """Represents a 2D vector in cartesian coordinates"""
@@ -57,126 +68,461 @@ class Player:
 
 class Arena:
     """Represents an arena"""
+    # Whether apply_sync() accepts sync payloads from sync_arrays.ArraySyncDecoder
+    accepts_sync_arrays = False
+
     def __init__(self):
         self.current_player = None
         self.players = dict() # id -> Player
         self.dimensions = None
         self.target_dimensions = None # TODO: Implement dimension transitions
+        self.spatial_index = None # spatial.ArenaIndex, if enabled
+        self.predictor = None # prediction.Predictor, if enabled
+        # What sync packets are parsed against. Kept in step with players
+        self.parsing_context = ParsingContext()
+
+    def reset(self):
+        """Forgets all state, e.g. before reconnecting. The spatial index stays enabled"""
+        self.current_player = None
+        self.players.clear()
+        self.parsing_context.reset()
+        self.dimensions = None
+        self.target_dimensions = None
+        if self.spatial_index is not None:
+            self.spatial_index = ArenaIndex(cells_per_side=self.spatial_index.cells_per_side)
+        if self.predictor is not None:
+            self.predictor.reset()
+
+    def enable_spatial_index(self, **kwargs):
+        """
+        Starts maintaining a spatial.ArenaIndex of players and maces in spatial_index
+
+        kwargs are passed to ArenaIndex. Players are indexed as they are synced.
+        """
+        self.spatial_index = ArenaIndex(self.target_dimensions, **kwargs)
+
+    def enable_prediction(self, **kwargs):
+        """
+        Starts maintaining a prediction.Predictor of player and mace states in predictor
+
+        kwargs are passed to Predictor. Requires NumPy.
+        """
+        from .prediction import Predictor
+        self.predictor = Predictor(**kwargs)
+
+    def set_dimensions(self, dimensions, target_dimensions):
+        """Sets the dimensions from a setup packet"""
+        self.dimensions = dimensions
+        self.set_target_dimensions(target_dimensions)
+
+    def set_target_dimensions(self, target_dimensions):
+        """Sets the target dimensions the arena is transitioning to"""
+        self.target_dimensions = target_dimensions
+        if self.spatial_index is not None:
+            self.spatial_index.resize(target_dimensions)
+
+    def set_current_player(self, player_id):
+        """Creates and registers the current player from a setup packet"""
+        initial_vectorstruct = (None, None)
+        self.current_player = Player(
+            player_id,
+            Vector(coordinates=initial_vectorstruct),
+            Vector(coordinates=initial_vectorstruct),
+            Vector(coordinates=initial_vectorstruct),
+            Vector(coordinates=initial_vectorstruct)
+        )
+        self.players[player_id] = self.current_player
+        self._track_current_player(player_id)
+
+    def _track_current_player(self, player_id):
+        """Updates parsing_context for a new current player"""
+        # The current player is only known once a sync packet adds it
+        self.parsing_context.current_player_id = player_id
+        self.parsing_context.known_ids.discard(player_id)
+
+    def _register_player(self, player_obj):
+        """Adds a player created from a sync_array entry to players"""
+        self.players[player_obj.id] = player_obj
+        self.parsing_context.known_ids.add(player_obj.id)
+        if player_obj is self.current_player:
+            player_obj.name = True # The current player has no name in sync packets
+
+    def remove_player(self, player_id):
+        """Removes a player from the arena"""
+        self.parsing_context.known_ids.discard(player_id)
+        del self.players[player_id]
+        if self.spatial_index is not None:
+            self.spatial_index.remove(player_id)
+        if self.predictor is not None:
+            self.predictor.remove(player_id)
+
+    def _add_player(self, sync_struct):
+        """Creates and registers a new player from a sync_array entry"""
+        if sync_struct.player_id == self.current_player.id:
+            # Keep the same object so that current_player stays in sync with the arena
+            player_obj = self.current_player
+            self._update_player(player_obj, sync_struct)
+        else:
+            player_obj = Player(
+                sync_struct.player_id,
+                Vector(vector_struct=sync_struct.player_state.position),
+                Vector(vector_struct=sync_struct.player_state.velocity),
+                Vector(vector_struct=sync_struct.mace_state.position),
+                Vector(vector_struct=sync_struct.mace_state.velocity)
+            )
+            if sync_struct.player_attributes.player_name:
+                player_obj.name = sync_struct.player_attributes.player_name
+        self._register_player(player_obj)
+
+    @staticmethod
+    def _update_player(player, sync_struct):
+        player.position.update(sync_struct.player_state.position)
+        player.velocity.update(sync_struct.player_state.velocity)
+        player.mace.position.update(sync_struct.mace_state.position)
+        player.mace.velocity.update(sync_struct.mace_state.velocity)
+
+    def apply_sync(self, sync_payload):
+        """Applies the removals and player states of a sync packet payload"""
+        for player_id in sync_payload.removal_array:
+            self.remove_player(player_id)
+        for sync_struct in sync_payload.sync_array:
+            if sync_struct.is_new_player:
+                self._add_player(sync_struct)
+            else:
+                self._update_player(self.players[sync_struct.player_id], sync_struct)
+        if self.spatial_index is not None:
+            self.spatial_index.apply_sync(sync_payload)
+        if self.predictor is not None:
+            self.predictor.observe_sync(sync_payload)
+
+    def apply_club_collision(self, payload):
+        """Corrects predicted mace states from a club_collision packet payload"""
+        if self.predictor is not None:
+            self.predictor.observe_club_collision(payload)
+
+    def apply_wall_collision(self, payload):
+        """Corrects predicted player states from a wall_collision packet payload"""
+        if self.predictor is not None:
+            self.predictor.observe_wall_collision(payload)
 
 class Leaderboard:
-    """Represents a leaderboard"""
-    def __init__(self):
-        self.king = None
+    """
+    Represents a leaderboard
+
+    The body of the latest set_leaderboard payload is only decoded once an attribute that
+    needs it is read, and an unchanged body is not decoded again.
+    """
+    def __init__(self, mode):
+        self.mode = mode
+        self.player_count = None
+        self.total = None
+        self._body = None
+        self._decoded = None
+
+    def update(self, payload):
+        """Applies a set_leaderboard payload. Returns whether the leaderboard changed"""
+        body = payload.body
+        player_count = payload.player_count
+        changed = player_count != self.player_count
+        self.player_count = player_count
+        self.total = payload.total
+        if body != self._body:
+            self._body = body
+            self._decoded = None
+            changed = True
+        return changed
+
+    def _decode(self):
+        if self._decoded is None and self._body is not None:
+            self._decoded = decode_leaderboard_body(self.mode, self._body)
+            if self._decoded.extraneous:
+                _logger.warning("Extraneous bytes in leaderboard body: %r", self._body)
+        return self._decoded
+
+    def _get(self, name):
+        decoded = self._decode()
+        return decoded.get(name) if decoded is not None else None
+
+    @property
+    def entries(self):
+        """A tuple of (name, score) of the top players in FFA mode, or None"""
+        entries = self._get("entries")
+        return tuple((entry.name, entry.score) for entry in entries) if entries else entries
+
+    @property
+    def king(self):
+        """A tuple (name, score) of the king in FFA mode, or None"""
+        king = self._get("king")
+        return (king.name, king.score) if king is not None else None
+
+    @property
+    def place(self):
+        """The place of the current player in FFA mode, or None"""
+        return self._get("place")
+
+    @property
+    def score(self):
+        """The score of the current player in FFA mode, or None"""
+        return self._get("score")
+
+    @property
+    def teams(self):
+        """A tuple of (id, score, count) of each team in TDM mode, or None"""
+        teams = self._get("teams")
+        return tuple((team.id, team.score, team.count) for team in teams) if teams else teams
+
+    def event(self):
+        """Returns the leaderboard as an events.LeaderboardEvent"""
+        return LeaderboardEvent(self.player_count, self.entries, self.king, self.place,
+                                self.score, self.teams)
+
+class ReconnectPolicy: #pylint: disable=too-few-public-methods
+    """
+    Jittered exponential backoff for Session.run()
+
+    max_reconnects is None to reconnect forever. If repick_server is True, a new server is
+    placed with the ServerDirectory given to Session.run() before each reconnect.
+    """
+    def __init__(self, initial_delay=0.5, max_delay=30.0, multiplier=2.0, max_reconnects=None,
+                 repick_server=False):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.max_reconnects = max_reconnects
+        self.repick_server = repick_server
+
+    def delay(self, attempt):
+        """Returns the delay in seconds before the given consecutive reconnect attempt"""
+        ceiling = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
 
 class Session:
-    """Represents a session"""
-    def __init__(self, loop, mode):
+    """
+    Represents a session
+
+    arena_class is the Arena implementation to use, e.g. columnar.ColumnarArena
+    capture is a capture.CaptureWriter to record received frames to, or None
+    receive_queue is the size of the receive queue of each networking.Connection, or 0 to
+    handle frames as they are read
+    """
+    def __init__(self, loop, mode, arena_class=Arena, capture=None, receive_queue=0):
         self._loop = loop
         self._connection = None
+        self._capture = capture
+        self._receive_queue = receive_queue
         self.mode = mode
-        self.arena = Arena()
+        self.arena = arena_class()
+        self.stats = ConnectionStats()
+        self.inputs = InputScheduler(loop) # Steering and movement, flushed once per tick
+        self.policy_runner = None # policy.PolicyRunner, if a Policy is attached
+        self.history = None # history.ArenaHistory, if enabled
+        self.leaderboard = Leaderboard(mode)
+        self.events = EventStreams() # Kills, collisions and leaderboard changes
+        self.reconnects = 0
+        self.kills = 0 # Kills by the current player
+        self.deaths = 0
+        self.downtime_seconds = 0.0
+        self.in_game = False # Whether a setup packet was received on the current connection
+        self._disconnect_time = None
 
     def _send_play_packet(self):
-        self._connection.send(dict(type="play"))
+        if self._connection is not None: # None when packets are replayed offline, e.g. by analysis
+            self._connection.send(dict(type="play"))
 
-    def _received_packet_handler(self, packet):
+    def _received_packet_handler(self, packet): #pylint: disable=too-many-branches
+        payload = packet.payload
         if packet.type == "setup":
-            print("setup", packet.payload.current_player_id)
-            if not packet.payload.game_mode is self.mode:
+            _logger.info("setup current_player_id=%d", payload.current_player_id)
+            if not payload.game_mode is self.mode:
                 raise ValueError(
                     "Server-reported mode {} does not match current mode {}".format(
-                        packet.payload.mode.value, self.mode.value
+                        payload.game_mode.value, self.mode.value
                     )
                 )
-            self.arena.dimensions = packet.payload.dimensions
-            self.arena.target_dimensions = packet.payload.target_dimensions
-            initial_vectorstruct = (None, None)
-            self.arena.current_player = Player(
-                packet.payload.current_player_id,
-                Vector(coordinates=initial_vectorstruct),
-                Vector(coordinates=initial_vectorstruct),
-                Vector(coordinates=initial_vectorstruct),
-                Vector(coordinates=initial_vectorstruct)
-            )
-            self.arena.players[packet.payload.current_player_id] = self.arena.current_player
+            self.arena.set_dimensions(payload.dimensions, payload.target_dimensions)
+            self.arena.set_current_player(payload.current_player_id)
+            self.in_game = True
+            if self._disconnect_time is not None:
+                self.downtime_seconds += self._loop.time() - self._disconnect_time
+                self._disconnect_time = None
         elif packet.type == "killed":
-            print("Got killed. Respawning...")
+            _logger.info("Got killed. Respawning...")
+            self.deaths += 1
             self._send_play_packet()
         elif packet.type == "kill":
-            print("kill", "-", "killed_id", packet.payload.killed_id, "killer_id",
-                  packet.payload.killer_id)
-            del self.arena.players[packet.payload.killed_id]
-            if packet.payload.killed_id == self.arena.current_player.id:
+            _logger.debug("kill killed_id=%d killer_id=%d", payload.killed_id, payload.killer_id)
+            self.arena.remove_player(payload.killed_id)
+            if self.history is not None:
+                self.history.remove(payload.killed_id)
+            if payload.killed_id == self.arena.current_player.id:
                 self.arena.current_player.name = None
+            elif payload.killer_id == self.arena.current_player.id:
+                self.kills += 1
+            if self.events.has_subscribers("kills"):
+                self.events.publish("kills", KillEvent(
+                    payload.timestamp, payload.killed_id, payload.killer_id,
+                    (payload.death_position.x, payload.death_position.y),
+                    payload.point_orb_count))
         elif packet.type == "remove":
-            print("remove", "-", packet.payload.player_id)
-            del self.arena.players[packet.payload.player_id]
+            _logger.debug("remove player_id=%d", payload.player_id)
+            self.arena.remove_player(payload.player_id)
+            if self.history is not None:
+                self.history.remove(payload.player_id)
         elif packet.type == "sync":
-            print("sync -", end="")
-            for player_id in packet.payload.removal_array:
-                print(" delete", player_id)
-                del self.arena.players[player_id]
-            for sync_struct in packet.payload.sync_array:
-                if sync_struct.is_new_player:
-                    player_obj = Player(
-                        sync_struct.player_id,
-                        Vector(vector_struct=sync_struct.player_state.position),
-                        Vector(vector_struct=sync_struct.player_state.velocity),
-                        Vector(vector_struct=sync_struct.mace_state.position),
-                        Vector(vector_struct=sync_struct.mace_state.velocity)
-                    )
-                    if sync_struct.player_attributes.player_name:
-                        print("New name: " + sync_struct.player_attributes.player_name)
-                        player_obj.name = sync_struct.player_attributes.player_name
-                    self.arena.players[sync_struct.player_id] = player_obj
-                    print(" new", sync_struct.player_id, end="")
+            if _logger.isEnabledFor(logging.DEBUG):
+                self._log_sync(payload)
+            self.arena.apply_sync(payload)
+            if self.history is not None:
+                if payload.get("coalesced"):
+                    # Its states are recorded at its timestamp along with the next sync
+                    for player_id in payload.removal_array:
+                        self.history.remove(player_id)
                 else:
-                    player = self.arena.players[sync_struct.player_id]
-                    player.position.update(sync_struct.player_state.position)
-                    player.velocity.update(sync_struct.player_state.velocity)
-                    player.mace.position.update(sync_struct.mace_state.position)
-                    player.mace.velocity.update(sync_struct.mace_state.velocity)
-                    print(" update", sync_struct.player_id, end="")
-            print()
+                    self.history.record_sync(payload)
         elif packet.type == "club_collision":
-            print("club_collision", "-", "first", packet.payload.first_id,
-                  "second", packet.payload.second_id)
+            _logger.debug("club_collision first_id=%d second_id=%d", payload.first_id,
+                          payload.second_id)
+            self.arena.apply_club_collision(payload)
+            if self.events.has_subscribers("collisions"):
+                self.events.publish("collisions", ClubCollisionEvent(
+                    payload.timestamp, payload.first_id, payload.second_id,
+                    (payload.p.x, payload.p.y)))
         elif packet.type == "wall_collision":
-            print("wall_collision", "-", packet.payload.player_id)
+            _logger.debug("wall_collision player_id=%d", payload.player_id)
+            self.arena.apply_wall_collision(payload)
+            if self.events.has_subscribers("collisions"):
+                self.events.publish("collisions", WallCollisionEvent(
+                    payload.timestamp, payload.player_id, (payload.p.x, payload.p.y)))
         elif packet.type == "set_leaderboard":
-            print("set_leaderboard")
+            _logger.debug("set_leaderboard")
+            if self.leaderboard.update(payload) and self.events.has_subscribers("leaderboard"):
+                self.events.publish("leaderboard", self.leaderboard.event())
         elif packet.type == "set_target_dim":
-            print("set_target_dim", "-", packet.payload.target_dimensions)
-            self.arena.target_dimensions = packet.payload.target_dimensions
+            _logger.debug("set_target_dim target_dimensions=%s", payload.target_dimensions)
+            self.arena.set_target_dimensions(payload.target_dimensions)
         # Debugging purposes
         if len(packet.extraneous) > 0:
-            print("EXTRANEOUS", "-", packet.type, "-", len(packet.extraneous))
+            _logger.critical("EXTRANEOUS - %s - %d", packet.type, len(packet.extraneous))
             exit()
 
-    def _is_new_player(self, player_id):
-        print("checking is new player: {}".format(player_id))
-        if player_id == self.arena.current_player.id:
-            print("Current player lacks name?: {}".format(not bool(self.arena.current_player.name)))
-            if not self.arena.current_player.name:
-                self.arena.current_player.name = True
-                return True
-            return False
-        print("Is unknown player?: {}".format(player_id not in self.arena.players))
-        return player_id not in self.arena.players
-
-    def _is_current_player(self, player_id):
-        print("check: {}, known: {}".format(player_id, self.arena.current_player.id))
-        return player_id == self.arena.current_player.id
+    @staticmethod
+    def _log_sync(payload):
+        if "records" in payload:
+            new_players = payload.new_players
+            updated_count = len(payload.records) - len(new_players)
+        else:
+            new_players = [sync_struct for sync_struct in payload.sync_array
+                           if sync_struct.is_new_player]
+            updated_count = len(payload.sync_array) - len(new_players)
+        _logger.debug("sync removed=%s new=%s updated=%d", list(payload.removal_array),
+                      [sync_struct.player_id for sync_struct in new_players], updated_count)
+        for sync_struct in new_players:
+            if sync_struct.player_attributes.player_name:
+                _logger.debug("new name player_id=%d name=%r", sync_struct.player_id,
+                              sync_struct.player_attributes.player_name)
+
+    def reset(self):
+        """Forgets the arena, history and leaderboard of the previous connection"""
+        self.arena.reset()
+        if self.history is not None:
+            self.history.reset()
+        self.leaderboard = Leaderboard(self.mode)
+
+    def enable_history(self, **kwargs):
+        """
+        Starts recording a history.ArenaHistory of every sync packet in history
+
+        kwargs are passed to ArenaHistory. The history is cleared on reconnect. Requires NumPy.
+        """
+        from .history import ArenaHistory
+        self.history = ArenaHistory(**kwargs)
+
+    def attach_policy(self, policy, rate, executor=None):
+        """
+        Runs a policy.Policy at rate decisions per second while connected
+
+        executor is a concurrent.futures.Executor to run decisions in, or None to run them
+        on the event loop.
+        """
+        self.policy_runner = PolicyRunner(self._loop, self, policy, rate, executor)
+
+    async def listen(self, websocket):
+        """Plays on an open websocket. Returns when it closes"""
+        self.in_game = False
+        if self._capture is not None:
+            self._capture.mark_connection()
+        self._connection = Connection(
+            websocket,
+            self.mode,
+            self.arena.parsing_context,
+            sync_arrays=self.arena.accepts_sync_arrays,
+            stats=self.stats,
+            capture=self._capture,
+            receive_queue=self._receive_queue
+        )
+        self._send_play_packet()
+        self.inputs.attach(self._connection)
+        if self.policy_runner is not None:
+            self.policy_runner.start()
+        try:
+            await self._connection.listen_loop(self._received_packet_handler)
+        finally:
+            if self.policy_runner is not None:
+                await self.policy_runner.stop()
+            await self.inputs.detach()
 
     async def start(self, address, port):
-        """Start the session"""
-        async with aiohttp.ClientSession(loop=self._loop) as session:
-            async with session.ws_connect("ws://" + address + ":" + str(port)) as websocket:
-                self._connection = Connection(
-                    websocket,
-                    self.mode,
-                    self._is_new_player,
-                    self._is_current_player
-                )
-                self._send_play_packet()
-                await self._connection.listen_loop(self._received_packet_handler)
+        """Start the session. Returns when the connection closes"""
+        websocket = await transport.get_shared(self._loop).ws_connect(
+            "ws://" + address + ":" + str(port))
+        async with websocket:
+            await self.listen(websocket)
+
+    async def run(self, address, port, directory=None, policy=None):
+        """
+        Runs the session, reconnecting after disconnects and errors
+
+        policy is a ReconnectPolicy, or None for the defaults. directory is the
+        server_selector.ServerDirectory that placed this session, for policy.repick_server.
+        Returns once policy.max_reconnects are used up, re-raising the last error if any.
+        """
+        if policy is None:
+            policy = ReconnectPolicy()
+        attempt = 0
+        while True:
+            # Set once a setup packet is received, which resets the backoff
+            self.in_game = False
+            try:
+                await self.start(address, port)
+                error = None
+            except asyncio.CancelledError: #pylint: disable=try-except-raise
+                raise
+            except Exception as exc: #pylint: disable=broad-except
+                error = exc
+            if self._disconnect_time is None:
+                # Downtime counts from the first of consecutive failed attempts
+                self._disconnect_time = self._loop.time()
+            self._connection = None
+            if self.in_game:
+                attempt = 0
+            if policy.max_reconnects is not None and self.reconnects >= policy.max_reconnects:
+                if error is not None:
+                    raise error
+                return
+            delay = policy.delay(attempt)
+            attempt += 1
+            _logger.warning("Disconnected from %s:%s (%r). Reconnecting in %.1fs", address, port,
+                            error, delay)
+            await asyncio.sleep(delay)
+            if policy.repick_server and directory is not None:
+                try:
+                    (new_address, new_port), = await directory.place(self.mode)
+                except Exception as exc: #pylint: disable=broad-except
+                    _logger.warning("Could not pick a new server (%r). Keeping %s:%s", exc,
+                                    address, port)
+                else:
+                    # Only stop counting the old server once this session has left it
+                    directory.release(address, port)
+                    address, port = new_address, new_port
+            self.reset()
+            self.reconnects += 1
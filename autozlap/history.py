@@ -0,0 +1,225 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A bounded history of arena states, one per sync packet.
+
+Every keyframe_interval ticks, the full state of every player is stored as a keyframe.
+Other ticks only store the players whose state changed since their keyframe, and the ids of
+the keyframe players that are gone. The state at any tick is thus its keyframe overlaid
+with its delta, whichever tick it is. Only the last capacity ticks are kept. Requires NumPy.
+"""
+
+import collections
+
+import numpy
+
+from .columnar import PlayerStore, POSITION, STATE_WIDTH
+from .prediction import sync_state_groups
+
+DEFAULT_CAPACITY = 256 # ticks
+DEFAULT_KEYFRAME_INTERVAL = 32 # ticks
+
+_ID_DTYPE = numpy.uint32
+_NO_IDS = numpy.zeros(0, dtype=_ID_DTYPE)
+_NO_ROWS = numpy.zeros((0, STATE_WIDTH), dtype=numpy.float32)
+
+_Keyframe = collections.namedtuple("_Keyframe", ("ids", "rows"))
+# keyframe is shared by the ticks until the next keyframe. changed_ids are sorted
+_Tick = collections.namedtuple("_Tick", ("timestamp", "keyframe", "removed_ids", "changed_ids",
+                                         "changed_rows"))
+
+def _sorted_state(store):
+    ids, rows = store.snapshot()
+    order = numpy.argsort(ids, kind="stable")
+    return ids[order].astype(_ID_DTYPE), rows[order]
+
+def _find(sorted_ids, player_id):
+    """Returns the index of player_id in sorted_ids, or None"""
+    index = int(numpy.searchsorted(sorted_ids, player_id))
+    if index < len(sorted_ids) and sorted_ids[index] == player_id:
+        return index
+    return None
+
+class ArenaHistory:
+    """
+    The last capacity ticks of arena states
+
+    Ticks are numbered from 0 in the order they are recorded, and every recorded sync
+    packet is one tick. Rows are STATE_WIDTH float32 columns, as in columnar.PlayerStore.
+    Maintained by game_client.Session once enabled with Session.enable_history().
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        if keyframe_interval < 1 or capacity < 1:
+            raise ValueError("capacity and keyframe_interval must be positive")
+        self.capacity = capacity
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self):
+        """Forgets every tick and player, e.g. before reconnecting"""
+        self._store = PlayerStore() # The current state
+        self._ticks = [None] * self.capacity
+        self._timestamps = numpy.zeros(self.capacity, dtype=numpy.float64)
+        self._next_tick = 0
+        self._keyframe = None
+        self._keyframe_tick = None
+
+    def __len__(self):
+        return min(self._next_tick, self.capacity)
+
+    @property
+    def first_tick(self):
+        """The oldest tick still stored, or None if empty"""
+        return self._next_tick - len(self) if self._next_tick else None
+
+    @property
+    def last_tick(self):
+        """The latest tick, or None if empty"""
+        return self._next_tick - 1 if self._next_tick else None
+
+    def remove(self, player_id):
+        """Removes a player from the current state, e.g. on a kill or remove packet"""
+        if player_id in self._store.index:
+            self._store.free(player_id)
+
+    def record_sync(self, sync_payload):
+        """
+        Records a sync packet payload of any decoder as the next tick
+
+        The states that pipeline.SyncCoalescer carried from coalesced sync packets are first
+        recorded as ticks of their own, at the timestamps of those packets.
+        """
+        for player_id in sync_payload.removal_array:
+            self.remove(player_id)
+        for timestamp, ids, rows in sync_state_groups(sync_payload):
+            self.record(timestamp, ids, rows)
+
+    def record(self, timestamp, ids, rows):
+        """Updates the state rows of players ids, and records the state as the next tick"""
+        store = self._store
+        if len(ids):
+            slots = [store.allocate(player_id) for player_id in ids.tolist()]
+            store.write(slots, rows)
+        ids, rows = _sorted_state(store)
+        tick = self._next_tick
+        if self._keyframe is None or tick - self._keyframe_tick >= self.keyframe_interval:
+            self._keyframe = _Keyframe(ids, rows)
+            self._keyframe_tick = tick
+            entry = _Tick(timestamp, self._keyframe, _NO_IDS, _NO_IDS, _NO_ROWS)
+        else:
+            entry = self._delta(timestamp, ids, rows)
+        self._ticks[tick % self.capacity] = entry
+        self._timestamps[tick % self.capacity] = timestamp
+        self._next_tick += 1
+
+    def _delta(self, timestamp, ids, rows):
+        keyframe = self._keyframe
+        indices = numpy.searchsorted(keyframe.ids, ids)
+        in_keyframe = indices < len(keyframe.ids)
+        in_keyframe[in_keyframe] = keyframe.ids[indices[in_keyframe]] == ids[in_keyframe]
+        changed = ~in_keyframe
+        changed[in_keyframe] = (keyframe.rows[indices[in_keyframe]]
+                                != rows[in_keyframe]).any(axis=1)
+        removed_ids = numpy.setdiff1d(keyframe.ids, ids, assume_unique=True)
+        return _Tick(timestamp, keyframe, removed_ids, ids[changed], rows[changed])
+
+    def _entry(self, tick):
+        if self.first_tick is None or not self.first_tick <= tick <= self.last_tick:
+            raise KeyError("Tick {} is not in the history".format(tick))
+        return self._ticks[tick % self.capacity]
+
+    def timestamp(self, tick):
+        """Returns the server timestamp of a tick"""
+        return self._entry(tick).timestamp
+
+    def tick_at(self, timestamp):
+        """Returns the latest tick at or before a server timestamp, or None"""
+        if not self._next_tick:
+            return None
+        first_tick = self.first_tick
+        order = numpy.arange(first_tick, self._next_tick) % self.capacity
+        index = int(numpy.searchsorted(self._timestamps[order], timestamp, side="right"))
+        return first_tick + index - 1 if index else None
+
+    def state_at(self, tick):
+        """
+        Returns a tuple (ids, rows) of NumPy arrays with the state of every player at tick,
+        sorted by id. Raises KeyError if the tick is not stored.
+        """
+        entry = self._entry(tick)
+        keyframe = entry.keyframe
+        if not len(entry.removed_ids) and not len(entry.changed_ids):
+            return keyframe.ids.copy(), keyframe.rows.copy()
+        unchanged = ~numpy.isin(keyframe.ids, entry.removed_ids) & ~numpy.isin(
+            keyframe.ids, entry.changed_ids)
+        ids = numpy.concatenate((keyframe.ids[unchanged], entry.changed_ids))
+        rows = numpy.concatenate((keyframe.rows[unchanged], entry.changed_rows))
+        order = numpy.argsort(ids, kind="stable")
+        return ids[order], rows[order]
+
+    def _row_at(self, entry, player_id):
+        index = _find(entry.changed_ids, player_id)
+        if index is not None:
+            return entry.changed_rows[index]
+        index = _find(entry.keyframe.ids, player_id)
+        if index is None or _find(entry.removed_ids, player_id) is not None:
+            return None
+        return entry.keyframe.rows[index]
+
+    def trajectory(self, player_id, start_tick=None, end_tick=None):
+        """
+        Returns a tuple (ticks, timestamps, rows) of NumPy arrays with the state of a player
+        at every tick from start_tick to end_tick inclusive where it was present. The window
+        defaults to, and is clipped to, the stored ticks.
+        """
+        ticks = list()
+        rows = list()
+        if self._next_tick:
+            start_tick = self.first_tick if start_tick is None else max(start_tick,
+                                                                        self.first_tick)
+            end_tick = self.last_tick if end_tick is None else min(end_tick, self.last_tick)
+            for tick in range(start_tick, end_tick + 1):
+                row = self._row_at(self._ticks[tick % self.capacity], player_id)
+                if row is not None:
+                    ticks.append(tick)
+                    rows.append(row)
+        ticks = numpy.array(ticks, dtype=numpy.int64)
+        return (ticks, self._timestamps[ticks % self.capacity],
+                numpy.array(rows, dtype=numpy.float32).reshape(-1, STATE_WIDTH))
+
+    def positions(self, player_id, start_tick=None, end_tick=None, column=POSITION):
+        """Returns a tuple (ticks, (n, 2) positions) from trajectory(), e.g. of MACE_POSITION"""
+        ticks, _, rows = self.trajectory(player_id, start_tick, end_tick)
+        return ticks, rows[:, column:column + 2]
+
+    @property
+    def nbytes(self):
+        """Bytes used by the stored arrays"""
+        keyframes = dict()
+        total = self._timestamps.nbytes
+        for entry in self._ticks:
+            if entry is None:
+                continue
+            keyframes[id(entry.keyframe)] = entry.keyframe
+            total += entry.removed_ids.nbytes + entry.changed_ids.nbytes
+            total += entry.changed_rows.nbytes
+        return total + sum(keyframe.ids.nbytes + keyframe.rows.nbytes
+                           for keyframe in keyframes.values())
@@ -0,0 +1,316 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logging configuration and metrics for Sessions.
+
+Metrics are kept per Session in its networking.ConnectionStats, and exported in the
+Prometheus text format by MetricsServer, or as JSON by JsonMetricsDumper.
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 1e-2, 2.5e-2, 5e-2, 0.1)
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_DUMP_INTERVAL = 10.0 # seconds
+
+def configure_logging(level):
+    """Configures the root logger. level is a logging level name or number"""
+    if isinstance(level, str):
+        level = level.upper()
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+
+class Histogram:
+    """A histogram of observations with fixed bucket upper bounds"""
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last bucket is unbounded
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Records an observation"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Returns a list of (upper bound, count of observations <= bound)"""
+        result = list()
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        """Returns the histogram as a JSON-serializable dict"""
+        return dict(
+            buckets=[[bound if bound != float("inf") else "+Inf", count]
+                     for bound, count in self.cumulative_counts()],
+            count=self.count,
+            sum=self.sum
+        )
+
+def percentile(buckets, counts, fraction):
+    """
+    Estimates a percentile (fraction, e.g. 0.99) from the counts of Histogram buckets,
+    interpolating linearly within a bucket. Returns None without observations, and the last
+    bound for observations in the unbounded bucket.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = fraction * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets, counts):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return lower
+
+def session_metrics(session):
+    """
+    Returns a JSON-serializable dict of the metrics of a game_client.Session
+
+    policy is None unless a policy.Policy is attached.
+    """
+    stats = session.stats
+    return dict(
+        packets_received=stats.packets_received,
+        packets_by_type=dict(stats.packets_by_type),
+        bytes_received=stats.bytes_received,
+        packets_sent=stats.packets_sent,
+        bytes_sent=stats.bytes_sent,
+        parse_seconds=stats.parse_latency.as_dict(),
+        handler_seconds=stats.handler_latency.as_dict(),
+        receive_queue_depth=stats.queue_depth,
+        max_receive_queue_depth=stats.max_queue_depth,
+        frames_coalesced=stats.frames_coalesced,
+        players_tracked=len(session.arena.players),
+        reconnects=session.reconnects,
+        kills=session.kills,
+        deaths=session.deaths,
+        downtime_seconds=session.downtime_seconds,
+        in_game=session.in_game,
+        events_published=dict(session.events.published),
+        events_dropped=session.events.dropped(),
+        policy=_policy_metrics(session.policy_runner)
+    )
+
+def _policy_metrics(runner):
+    if runner is None:
+        return None
+    return dict(
+        ticks=runner.ticks,
+        deadline_misses=runner.deadline_misses,
+        decide_seconds=runner.decide_latency.as_dict()
+    )
+
+def _format_labels(labels):
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+def render_prometheus(sessions, labels=()):
+    """
+    Returns the metrics of sessions in the Prometheus text exposition format
+
+    Sessions are labelled by their index as instance. labels is a sequence of
+    (name, value) added to every sample, e.g. to identify a worker process.
+    """
+    labels = tuple(labels)
+    families = (
+        ("packets_received_total", "counter", "Packets received by type"),
+        ("bytes_received_total", "counter", "Bytes received"),
+        ("packets_sent_total", "counter", "Packets sent"),
+        ("bytes_sent_total", "counter", "Bytes sent"),
+        ("parse_seconds", "histogram", "Time spent parsing a packet"),
+        ("handler_seconds", "histogram", "Time spent handling a parsed packet"),
+        ("receive_queue_depth", "gauge", "Frames queued when the receive queue was last drained"),
+        ("frames_coalesced_total", "counter", "Sync packets coalesced with a newer one"),
+        ("players_tracked", "gauge", "Players in the arena"),
+        ("reconnects_total", "counter", "Reconnects"),
+        ("kills_total", "counter", "Kills by the current player"),
+        ("deaths_total", "counter", "Deaths of the current player"),
+        ("downtime_seconds_total", "counter", "Time spent disconnected"),
+        ("in_game", "gauge", "Whether the session received a setup packet"),
+        ("events_published_total", "counter", "Events published to subscribers by stream"),
+        ("events_dropped_total", "counter", "Events dropped from full subscriber queues"),
+        ("policy_ticks_total", "counter", "Policy decisions"),
+        ("policy_deadline_misses_total", "counter", "Policy ticks started after their deadline"),
+        ("policy_decide_seconds", "histogram", "Time spent deciding, including executor wait"),
+    )
+    samples = {name: list() for name, _, _ in families}
+    for index, session in enumerate(sessions):
+        instance_labels = labels + (("instance", index),)
+        stats = session.stats
+        for packet_type, count in sorted(stats.packets_by_type.items()):
+            samples["packets_received_total"].append(
+                (_format_labels(instance_labels + (("type", packet_type),)), count))
+        instance = _format_labels(instance_labels)
+        samples["bytes_received_total"].append((instance, stats.bytes_received))
+        samples["packets_sent_total"].append((instance, stats.packets_sent))
+        samples["bytes_sent_total"].append((instance, stats.bytes_sent))
+        samples["receive_queue_depth"].append((instance, stats.queue_depth))
+        samples["frames_coalesced_total"].append((instance, stats.frames_coalesced))
+        samples["players_tracked"].append((instance, len(session.arena.players)))
+        samples["reconnects_total"].append((instance, session.reconnects))
+        samples["kills_total"].append((instance, session.kills))
+        samples["deaths_total"].append((instance, session.deaths))
+        samples["downtime_seconds_total"].append((instance, session.downtime_seconds))
+        samples["in_game"].append((instance, int(session.in_game)))
+        published = session.events.published
+        for stream, dropped in sorted(session.events.dropped().items()):
+            stream_labels = _format_labels(instance_labels + (("stream", stream),))
+            samples["events_published_total"].append((stream_labels, published[stream]))
+            samples["events_dropped_total"].append((stream_labels, dropped))
+        histograms = [("parse_seconds", stats.parse_latency),
+                      ("handler_seconds", stats.handler_latency)]
+        runner = session.policy_runner
+        if runner is not None:
+            samples["policy_ticks_total"].append((instance, runner.ticks))
+            samples["policy_deadline_misses_total"].append((instance, runner.deadline_misses))
+            histograms.append(("policy_decide_seconds", runner.decide_latency))
+        for name, histogram in histograms:
+            for bound, count in histogram.cumulative_counts():
+                samples[name].append(("_bucket" + _format_labels(
+                    instance_labels + (("le", _format_bound(bound)),)), count))
+            samples[name].append(("_sum" + instance, histogram.sum))
+            samples[name].append(("_count" + instance, histogram.count))
+    lines = list()
+    for name, metric_type, help_text in families:
+        full_name = "autozlap_" + name
+        lines.append("# HELP {} {}".format(full_name, help_text))
+        lines.append("# TYPE {} {}".format(full_name, metric_type))
+        for suffix, value in samples[name]:
+            lines.append("{}{} {}".format(full_name, suffix, value))
+    return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    """
+    Serves the metrics of sessions over HTTP
+
+    GET /metrics returns the Prometheus text format, and GET /metrics.json returns JSON.
+    sessions may be any iterable, and is iterated on every request.
+    """
+    def __init__(self, sessions, host=DEFAULT_METRICS_HOST, port=9100, labels=()):
+        self._sessions = sessions
+        self._labels = tuple(labels)
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle_text(self, request): #pylint: disable=unused-argument
+        from aiohttp import web
+        return web.Response(text=render_prometheus(self._sessions, self._labels),
+                            content_type="text/plain", charset="utf-8")
+
+    async def _handle_json(self, request): #pylint: disable=unused-argument
+        from aiohttp import web
+        return web.json_response([session_metrics(session) for session in self._sessions])
+
+    async def start(self):
+        """Starts listening"""
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_text)
+        app.router.add_get("/metrics.json", self._handle_json)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        """Stops listening"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+class JsonMetricsDumper:
+    """Periodically writes the metrics of sessions as JSON to a file, replacing it atomically"""
+    def __init__(self, loop, sessions, path, interval=DEFAULT_DUMP_INTERVAL):
+        self._loop = loop
+        self._sessions = sessions
+        self.path = path
+        self.interval = interval
+        self._task = None
+
+    def dump(self):
+        """Writes the metrics now"""
+        temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temporary_path, "w", encoding="utf-8") as metrics_file:
+            json.dump([session_metrics(session) for session in self._sessions], metrics_file)
+        os.replace(temporary_path, self.path)
+
+    async def _dump_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.dump()
+
+    def start(self):
+        """Starts dumping every interval seconds"""
+        if self._task is None:
+            self._task = self._loop.create_task(self._dump_loop())
+
+    async def stop(self):
+        """Stops dumping, and writes the final metrics"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.dump()
+
+async def start_exporters(loop, sessions, port=None, json_path=None,
+                          interval=DEFAULT_DUMP_INTERVAL, host=DEFAULT_METRICS_HOST, labels=()):
+    """
+    Starts a MetricsServer on port and a JsonMetricsDumper to json_path, for those given.
+    Returns a list of the started exporters, to pass to stop_exporters()
+    """
+    exporters = list()
+    if port is not None:
+        server = MetricsServer(sessions, host, port, labels)
+        await server.start()
+        exporters.append(server)
+    if json_path is not None:
+        dumper = JsonMetricsDumper(loop, sessions, json_path, interval)
+        dumper.start()
+        exporters.append(dumper)
+    return exporters
+
+async def stop_exporters(exporters):
+    """Stops exporters started by start_exporters()"""
+    for exporter in exporters:
+        await exporter.stop()
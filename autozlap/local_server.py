@@ -0,0 +1,582 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A headless stand-in for a zlap.io server, for load testing many client instances.
+
+Simulates an arena of bots and serves it over a websocket with the same binary protocol
+networking.Connection parses, plus a servers.json listing itself for server_selector.
+Every connected client plays in the same arena. Positions are in arena units and
+velocities in units per timestamp unit (milliseconds), as prediction.Predictor assumes.
+
+Run with python3 -m autozlap.local_server, then point the client at it with
+--servers-url, or with --address and --port.
+"""
+
+import argparse
+import asyncio
+import collections
+import logging
+import math
+import random
+import struct
+import sys
+
+from aiohttp import web, WSMsgType
+
+from .constants import CLIENT_VERSION, Mode
+from . import encoder, instrumentation, packet_builder
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9001
+DEFAULT_PLAYERS = 100
+DEFAULT_TICK_RATE = 20.0 # syncs per second
+DEFAULT_DIMENSIONS = (2000.0, 2000.0)
+DEFAULT_MIN_DIMENSIONS = (500.0, 500.0)
+DEFAULT_SHRINK_FACTOR = 0.8
+DEFAULT_STATS_INTERVAL = 10.0 # seconds
+
+PLAYER_SPEED = 0.2 # units per millisecond
+MACE_DISTANCE = 40.0 # units from the player
+MACE_RADIUS = 10.0
+MACE_ANGULAR_SPEED = 0.004 # radians per millisecond
+BORDER_APPROACH_RATE = 0.0005 # fraction of the distance to the target dimensions per millisecond
+
+_logger = logging.getLogger(__name__)
+
+_MOVE_VECTORS = {"up": (0, -1), "down": (0, 1), "left": (-1, 0), "right": (1, 0)}
+_DIRECTION = struct.Struct("<f")
+
+EventIntervals = collections.namedtuple("EventIntervals", (
+    "kill", "churn", "collision", "leaderboard", "shrink"))
+EventIntervals.__new__.__defaults__ = (2.0, 5.0, 0.5, 1.0, 10.0)
+EventIntervals.__doc__ = "Seconds between simulated events of each kind, or 0 to disable them"
+
+class SimulatedPlayer:
+    """A player in a World, either a bot or controlled by a client"""
+    __slots__ = ("id", "name", "team", "position", "velocity", "mace_angle", "score", "client")
+
+    def __init__(self, player_id, name, team, position, velocity, client=None):
+        self.id = player_id #pylint: disable=invalid-name
+        self.name = name
+        self.team = team
+        self.position = position
+        self.velocity = velocity
+        self.mace_angle = 0.0
+        self.score = 0
+        self.client = client
+
+    def state(self):
+        """Returns the 9 floats of the player's sync entry state"""
+        cos, sin = math.cos(self.mace_angle), math.sin(self.mace_angle)
+        return (self.position[0], self.position[1], self.velocity[0], self.velocity[1],
+                self.position[0] + MACE_DISTANCE * cos, self.position[1] + MACE_DISTANCE * sin,
+                self.velocity[0] - MACE_DISTANCE * MACE_ANGULAR_SPEED * sin,
+                self.velocity[1] + MACE_DISTANCE * MACE_ANGULAR_SPEED * cos,
+                MACE_RADIUS)
+
+    def physical_state(self):
+        """Returns the player's (pos_x, pos_y, vel_x, vel_y)"""
+        return self.state()[:4]
+
+    def mace_state(self):
+        """Returns the mace's (pos_x, pos_y, vel_x, vel_y)"""
+        return self.state()[4:8]
+
+class World:
+    """The simulated arena. players only holds the players currently alive"""
+    def __init__(self, dimensions=DEFAULT_DIMENSIONS, mode=Mode.ffa, rng=random):
+        self.mode = mode
+        self.dimensions = tuple(dimensions)
+        self.target_dimensions = tuple(dimensions)
+        self.players = dict() # id -> SimulatedPlayer
+        self._rng = rng
+        self._next_id = 1
+
+    def new_player(self, name, client=None):
+        """Creates a player at a random position, without adding it to players"""
+        player_id = self._next_id
+        self._next_id += 1
+        position = (self._rng.uniform(0, self.target_dimensions[0]),
+                    self._rng.uniform(0, self.target_dimensions[1]))
+        velocity = (0.0, 0.0) if client is not None else self._random_velocity()
+        return SimulatedPlayer(player_id, name, player_id % 3, position, velocity, client)
+
+    def spawn(self, player):
+        """Adds a player to the arena"""
+        self.players[player.id] = player
+
+    def spawn_bot(self):
+        """Adds a new bot to the arena and returns it"""
+        player = self.new_player(None)
+        player.name = "bot{}".format(player.id)
+        self.spawn(player)
+        return player
+
+    def _random_velocity(self):
+        angle = self._rng.uniform(0, 2 * math.pi)
+        return (PLAYER_SPEED * math.cos(angle), PLAYER_SPEED * math.sin(angle))
+
+    def step(self, elapsed):
+        """Advances the arena by elapsed milliseconds. Returns the players that hit a wall"""
+        self.dimensions = tuple(
+            current + (target - current) * min(1.0, BORDER_APPROACH_RATE * elapsed)
+            for current, target in zip(self.dimensions, self.target_dimensions))
+        wall_hits = list()
+        for player in self.players.values():
+            position = list(player.position)
+            velocity = list(player.velocity)
+            hit = False
+            for axis in (0, 1):
+                position[axis] += velocity[axis] * elapsed
+                if position[axis] < 0 or position[axis] > self.dimensions[axis]:
+                    position[axis] = min(max(position[axis], 0.0), self.dimensions[axis])
+                    # Only moving into a wall counts as a hit, not being pushed by the border
+                    if (velocity[axis] < 0) == (position[axis] == 0.0) and velocity[axis]:
+                        # Bots bounce, and clients stop until their next input
+                        velocity[axis] = -velocity[axis] if player.client is None else 0.0
+                        hit = True
+            player.position = tuple(position)
+            player.velocity = tuple(velocity)
+            player.mace_angle = (player.mace_angle + MACE_ANGULAR_SPEED * elapsed) % (2 * math.pi)
+            if hit:
+                wall_hits.append(player)
+        return wall_hits
+
+class _Client:
+    """A connected websocket and the view of the arena it was sent"""
+    __slots__ = ("websocket", "player", "known", "moving", "direction", "outbox", "frames_sent")
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.player = None
+        self.known = set() # Ids of the players the client has in its arena
+        self.moving = dict.fromkeys(encoder.MOVE_DIRECTIONS, False)
+        self.direction = None
+        self.outbox = list() # Frames to send at the end of the tick
+        self.frames_sent = 0
+
+    def update_velocity(self):
+        """Sets the player's velocity from the held move keys"""
+        delta_x = sum(_MOVE_VECTORS[key][0] for key, held in self.moving.items() if held)
+        delta_y = sum(_MOVE_VECTORS[key][1] for key, held in self.moving.items() if held)
+        norm = math.hypot(delta_x, delta_y)
+        if norm:
+            self.player.velocity = (PLAYER_SPEED * delta_x / norm, PLAYER_SPEED * delta_y / norm)
+        else:
+            self.player.velocity = (0.0, 0.0)
+
+    def forget(self, player_id, frame):
+        """Queues frame and forgets player_id if the client knows it"""
+        if player_id in self.known:
+            self.known.discard(player_id)
+            self.outbox.append(frame)
+
+class ServerStats: #pylint: disable=too-few-public-methods
+    """Counters of a LocalServer"""
+    __slots__ = ("ticks", "late_ticks", "frames_sent", "bytes_sent", "inputs_received",
+                 "connections", "drops", "tick_latency")
+
+    def __init__(self):
+        self.ticks = 0
+        self.late_ticks = 0 # Ticks whose work took longer than the tick interval
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.inputs_received = 0
+        self.connections = 0
+        self.drops = 0 # Connections closed by drop_after
+        self.tick_latency = instrumentation.Histogram()
+
+class LocalServer: #pylint: disable=too-many-instance-attributes
+    """
+    Serves a simulated World to any number of clients
+
+    GET / upgrades to the game websocket, and GET /servers.json lists this server in the
+    format server_selector expects. Clients are sent setup after their first play packet,
+    then everything that happens in the arena once per tick. player_count bots are kept in
+    the arena, and events happen every intervals (an EventIntervals) seconds. If drop_after
+    is given, each connection is closed once it was sent that many frames after setup, to
+    test reconnects.
+    """
+    def __init__(self, loop, host=DEFAULT_HOST, port=DEFAULT_PORT, player_count=DEFAULT_PLAYERS,
+                 tick_rate=DEFAULT_TICK_RATE, mode=Mode.ffa, dimensions=DEFAULT_DIMENSIONS,
+                 min_dimensions=DEFAULT_MIN_DIMENSIONS, shrink_factor=DEFAULT_SHRINK_FACTOR,
+                 intervals=EventIntervals(), seed=None, drop_after=None):
+        self._loop = loop
+        self.drop_after = drop_after
+        self.host = host
+        self.port = port
+        self.tick_interval = 1.0 / tick_rate
+        self.initial_dimensions = tuple(dimensions)
+        self.min_dimensions = tuple(min_dimensions)
+        self.shrink_factor = shrink_factor
+        self.intervals = intervals
+        self._rng = random.Random(seed)
+        self.world = World(dimensions, mode, self._rng)
+        for _ in range(player_count):
+            self.world.spawn_bot()
+        self.clients = list() # _Clients that were sent setup
+        self._departed = list() # Ids of the players of disconnected clients
+        self._next_events = dict()
+        self._start_time = None
+        self._runner = None
+        self._tick_task = None
+        self.stats = ServerStats()
+
+    @property
+    def url(self):
+        """Returns the URL of servers.json, as server_selector.ServerDirectory expects"""
+        return "http://{}:{}/servers.json?_={{time}}".format(self.host, self.port)
+
+    def timestamp(self):
+        """Returns the current server timestamp in milliseconds"""
+        return int((self._loop.time() - self._start_time) * 1000) & 0xFFFFFFFF
+
+    async def _handle_servers(self, request): #pylint: disable=unused-argument
+        return web.json_response([[dict(
+            mode=self.world.mode.value,
+            address="{}:{}".format(self.host, self.port),
+            version=CLIENT_VERSION,
+            players=len(self.world.players)
+        )]])
+
+    async def _handle_websocket(self, request):
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.stats.connections += 1
+        client = None
+        try:
+            async for message in websocket:
+                if message.type != WSMsgType.BINARY or not message.data:
+                    continue
+                self.stats.inputs_received += 1
+                client = await self._handle_input(websocket, client, message.data)
+        finally:
+            if client is not None:
+                if client in self.clients:
+                    self.clients.remove(client)
+                if self.world.players.pop(client.player.id, None) is not None:
+                    self._departed.append(client.player.id)
+        return websocket
+
+    async def _handle_input(self, websocket, client, data):
+        """Applies an outbound client packet. Returns the client, created on the first play"""
+        try:
+            packet_type = encoder.OUTBOUND_TYPES[data[0]]
+        except IndexError:
+            _logger.warning("Unknown packet type %d", data[0])
+            return client
+        if packet_type == "play":
+            if client is None:
+                client = _Client(websocket)
+                client.player = player = self.world.new_player(None, client)
+                player.name = "player{}".format(player.id)
+                await websocket.send_bytes(packet_builder.build_setup(
+                    player.id, self.world.dimensions, self.world.target_dimensions,
+                    self.world.mode, self.timestamp()))
+                self.clients.append(client)
+            if client.player.id not in self.world.players:
+                self.world.spawn(client.player)
+        elif client is None:
+            pass
+        elif packet_type == "direction":
+            if len(data) >= 1 + _DIRECTION.size:
+                client.direction, = _DIRECTION.unpack_from(data, 1)
+        else:
+            stopping = packet_type.startswith("stop_")
+            client.moving[packet_type.rpartition("_")[2]] = not stopping
+            client.update_velocity()
+        return client
+
+    def _due(self, kind, now):
+        """Returns whether an event of kind is due, scheduling the next one if so"""
+        interval = getattr(self.intervals, kind)
+        if not interval:
+            return False
+        next_time = self._next_events.setdefault(kind, now + interval)
+        if now < next_time:
+            return False
+        self._next_events[kind] = next_time + interval
+        return True
+
+    def _broadcast(self, frame):
+        for client in self.clients:
+            client.outbox.append(frame)
+
+    def _kill(self, timestamp):
+        world = self.world
+        if len(world.players) < 2:
+            return
+        victim, killer = self._rng.sample(list(world.players.values()), 2)
+        del world.players[victim.id]
+        killer.score += 10 + victim.score // 2
+        frame = packet_builder.build_kill(timestamp, victim.id, victim.position, killer.id,
+                                          victim.score // 2)
+        for client in self.clients:
+            client.forget(victim.id, frame)
+        if victim.client is not None:
+            victim.score = 0
+            victim.client.outbox.append(packet_builder.build_killed())
+        else:
+            world.spawn_bot()
+
+    def _churn(self):
+        """A bot leaves and another joins. Returns the id of the bot that left, or None"""
+        bots = [player for player in self.world.players.values() if player.client is None]
+        if not bots:
+            return None
+        leaving = self._rng.choice(bots)
+        del self.world.players[leaving.id]
+        self.world.spawn_bot()
+        return leaving.id
+
+    def _club_collision(self, timestamp):
+        if len(self.world.players) < 2:
+            return
+        first, second = self._rng.sample(list(self.world.players.values()), 2)
+        self._broadcast(packet_builder.build_club_collision(
+            timestamp, first.mace_state()[:2], self._rng.uniform(0, 1), first.id,
+            first.mace_state(), second.id, second.mace_state()))
+
+    def _leaderboard(self):
+        players = sorted(self.world.players.values(), key=lambda player: -player.score)
+        if self.world.mode is Mode.tdm:
+            teams = [[team, 0, 0] for team in range(3)]
+            for player in players:
+                teams[player.team][1] += player.score
+                teams[player.team][2] += 1
+            self._broadcast(packet_builder.build_set_leaderboard_tdm(
+                len(players), len(players), [tuple(team) for team in teams]))
+            return
+        if not players:
+            return
+        entries = [(player.name, player.score) for player in players[:10]]
+        places = {player.id: place for place, player in enumerate(players, 1)}
+        for client in self.clients:
+            place = places.get(client.player.id, len(players) + 1)
+            client.outbox.append(packet_builder.build_set_leaderboard_ffa(
+                len(players), len(players), players[0].id, entries, entries[0], place,
+                client.player.score))
+
+    def _shrink(self):
+        world = self.world
+        target = tuple(dimension * self.shrink_factor for dimension in world.target_dimensions)
+        if any(size < minimum for size, minimum in zip(target, self.min_dimensions)):
+            target = self.initial_dimensions
+        world.target_dimensions = target
+        self._broadcast(packet_builder.build_set_target_dim(target))
+
+    def _sync_frames(self, timestamp, removals):
+        """Appends a sync packet to each client's outbox"""
+        players = self.world.players
+        entries = {player_id: packet_builder.build_sync_entry(player_id, None, player.state())
+                   for player_id, player in players.items()}
+        all_entries = list(entries.values())
+        # Clients that know every player share a frame per removal array
+        shared_frames = dict()
+        for client in self.clients:
+            removal_array = tuple(player_id for player_id in removals
+                                  if player_id in client.known)
+            client.known.difference_update(removal_array)
+            if len(client.known) == len(players):
+                frame = shared_frames.get(removal_array)
+                if frame is None:
+                    frame = packet_builder.build_sync_from_entries(timestamp, removal_array,
+                                                                   all_entries)
+                    shared_frames[removal_array] = frame
+            else:
+                client_entries = list()
+                for player_id, player in players.items():
+                    if player_id in client.known:
+                        client_entries.append(entries[player_id])
+                    else:
+                        name = None if player is client.player else player.name
+                        client_entries.append(packet_builder.build_sync_entry(
+                            player_id, (name, 1.0, player.team), player.state()))
+                        client.known.add(player_id)
+                frame = packet_builder.build_sync_from_entries(timestamp, removal_array,
+                                                               client_entries)
+            client.outbox.append(frame)
+
+    def tick(self, elapsed):
+        """Advances the arena by elapsed seconds and queues the frames for every client"""
+        now = self._loop.time()
+        timestamp = self.timestamp()
+        for player_id in self._departed:
+            frame = packet_builder.build_remove(timestamp, player_id)
+            for client in self.clients:
+                client.forget(player_id, frame)
+        del self._departed[:]
+        for player in self.world.step(elapsed * 1000):
+            self._broadcast(packet_builder.build_wall_collision(
+                timestamp, player.position, self._rng.uniform(0, 1), player.id,
+                player.physical_state(), MACE_RADIUS))
+        removals = list()
+        if self._due("kill", now):
+            self._kill(timestamp)
+        if self._due("churn", now):
+            left_id = self._churn()
+            if left_id is not None:
+                removals.append(left_id)
+        if self._due("collision", now):
+            self._club_collision(timestamp)
+        if self._due("shrink", now):
+            self._shrink()
+        if self._due("leaderboard", now):
+            self._leaderboard()
+        self._sync_frames(timestamp, removals)
+
+    async def _send_outbox(self, client):
+        frames = client.outbox
+        client.outbox = list()
+        try:
+            for frame in frames:
+                await client.websocket.send_bytes(frame)
+        except (ConnectionError, RuntimeError) as exc:
+            _logger.debug("Dropped frames to a closing client: %r", exc)
+            return
+        self.stats.frames_sent += len(frames)
+        self.stats.bytes_sent += sum(len(frame) for frame in frames)
+        client.frames_sent += len(frames)
+        if self.drop_after is not None and client.frames_sent >= self.drop_after:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.stats.drops += 1
+            await client.websocket.close()
+
+    async def _tick_loop(self):
+        previous_tick = self._loop.time()
+        next_tick = previous_tick + self.tick_interval
+        while True:
+            await asyncio.sleep(max(next_tick - self._loop.time(), 0))
+            tick_start = self._loop.time()
+            self.tick(tick_start - previous_tick)
+            previous_tick = tick_start
+            await asyncio.gather(*(self._send_outbox(client) for client in list(self.clients)))
+            work_seconds = self._loop.time() - tick_start
+            self.stats.ticks += 1
+            self.stats.tick_latency.observe(work_seconds)
+            if work_seconds > self.tick_interval:
+                self.stats.late_ticks += 1
+            next_tick += self.tick_interval
+            if next_tick < self._loop.time():
+                # Skip missed ticks rather than running them in a burst
+                next_tick = self._loop.time()
+
+    async def start(self):
+        """Starts listening and simulating"""
+        self._start_time = self._loop.time()
+        app = web.Application()
+        app.router.add_get("/", self._handle_websocket)
+        app.router.add_get("/servers.json", self._handle_servers)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tick_task = self._loop.create_task(self._tick_loop())
+
+    async def stop(self):
+        """Stops simulating and closes every connection"""
+        if self._tick_task is not None:
+            self._tick_task.cancel()
+            try:
+                await self._tick_task
+            except asyncio.CancelledError:
+                pass
+            self._tick_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats_summary(self):
+        """Returns a dict of the counters and the current arena size"""
+        stats = self.stats
+        return dict(
+            clients=len(self.clients),
+            players=len(self.world.players),
+            ticks=stats.ticks,
+            late_ticks=stats.late_ticks,
+            tick_ms=(stats.tick_latency.sum / stats.tick_latency.count * 1e3
+                     if stats.tick_latency.count else 0.0),
+            frames_sent=stats.frames_sent,
+            bytes_sent=stats.bytes_sent,
+            inputs_received=stats.inputs_received,
+            connections=stats.connections,
+            drops=stats.drops
+        )
+
+async def _report_stats(server, interval):
+    previous = server.stats_summary()
+    while True:
+        await asyncio.sleep(interval)
+        current = server.stats_summary()
+        _logger.info(
+            "%d clients, %d players, %.1f frames/s, %.1f KiB/s, %.1f inputs/s, "
+            "%.2fms/tick, %d late ticks", current["clients"], current["players"],
+            (current["frames_sent"] - previous["frames_sent"]) / interval,
+            (current["bytes_sent"] - previous["bytes_sent"]) / interval / 1024,
+            (current["inputs_received"] - previous["inputs_received"]) / interval,
+            current["tick_ms"], current["late_ticks"])
+        previous = current
+
+def main(args):
+    """Entry-point"""
+    parser = argparse.ArgumentParser(
+        description="A headless local stand-in for a zlap.io server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", "-p", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--players", type=int, default=DEFAULT_PLAYERS,
+                        help="Number of simulated bots in the arena")
+    parser.add_argument("--tick-rate", type=float, default=DEFAULT_TICK_RATE,
+                        help="Sync packets per second")
+    parser.add_argument("--mode", choices=[mode.value for mode in Mode], default=Mode.ffa.value)
+    parser.add_argument("--seed", type=int, default=None)
+    defaults = EventIntervals()
+    for kind in EventIntervals._fields:
+        parser.add_argument("--{}-interval".format(kind), type=float,
+                            default=getattr(defaults, kind),
+                            help="Seconds between {} events, or 0 to disable them".format(kind))
+    parser.add_argument("--stats-interval", type=float, default=DEFAULT_STATS_INTERVAL,
+                        help="Seconds between stats reports")
+    parser.add_argument("--drop-after", type=int, default=None, metavar="FRAMES",
+                        help="Close each connection after sending it this many frames, to test "
+                        "reconnects")
+    parser.add_argument("--log-level", default="INFO")
+    parsed_args = parser.parse_args(args)
+    instrumentation.configure_logging(parsed_args.log_level)
+    intervals = EventIntervals(*(getattr(parsed_args, kind + "_interval")
+                                 for kind in EventIntervals._fields))
+    loop = asyncio.get_event_loop()
+    server = LocalServer(loop, parsed_args.host, parsed_args.port, parsed_args.players,
+                         parsed_args.tick_rate, Mode(parsed_args.mode), intervals=intervals,
+                         seed=parsed_args.seed, drop_after=parsed_args.drop_after)
+    loop.run_until_complete(server.start())
+    _logger.info("Serving %d players at %.1f ticks/s. Connect with --servers-url '%s'",
+                 parsed_args.players, parsed_args.tick_rate, server.url)
+    report_task = loop.create_task(_report_stats(server, parsed_args.stats_interval))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        report_task.cancel()
+        loop.run_until_complete(server.stop())
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
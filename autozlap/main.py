@@ -21,32 +21,164 @@
 """The main application"""
 
 import asyncio
+import collections
+import os
 import signal
 import argparse
 
 from .constants import Mode
-from . import server_selector, game_client
+from . import (capture, fleet, instrumentation, policy, server_selector, game_client, sharding,
+               supervisor, transport)
 
-async def main_routine(loop, address, port, instance_count):
-    """Main application routine"""
-    if not address or not port:
-        print("No address and port combination specified. Finding server...")
-        address, port = await server_selector.select_server(loop)
-    print(address + ":" + str(port))
-    tasks = list()
-    for _ in range(instance_count):
-        tasks.append(game_client.Session(loop, Mode.ffa).start(address, port))
-    await asyncio.wait(tasks)
+async def main_routine(loop, address, port, instance_count, arena_class=game_client.Arena,
+                       transport_options=None, reconnect_policy=None, capture_directory=None,
+                       metrics_options=None, policy_options=None,
+                       servers_url=server_selector.SERVERS_URL, dashboard_options=None,
+                       receive_queue=0):
+    """
+    Main application routine
+
+    transport_options are passed to transport.Transport, and reconnect_policy is the
+    game_client.ReconnectPolicy for every Session. If capture_directory is given, each
+    Session records its received frames to a capture file in it. metrics_options are passed
+    to instrumentation.start_exporters(), and policy_options to policy.attach_policies().
+    Without address and port, instances are placed on the servers listed at servers_url.
+    dashboard_options are passed to supervisor.create_supervisor(), and receive_queue to
+    each game_client.Session.
+    """
+    transport.get_shared(loop, **(transport_options or dict()))
+    placements, directory = await server_selector.place_instances(loop, address, port,
+                                                                  instance_count, servers_url)
+    for (server_address, server_port), count in collections.Counter(placements).items():
+        print(server_address + ":" + str(server_port), "-", count, "instance(s)")
+    if directory is not None:
+        directory.start_background_refresh()
+    try:
+        await fleet.run_sessions(loop, placements, arena_class, directory, reconnect_policy,
+                                 capture_directory, metrics_options, policy_options,
+                                 dashboard_options, receive_queue)
+    finally:
+        if directory is not None:
+            await directory.stop_background_refresh()
+        await transport.close_shared(loop)
 
 def main(args):
     """Entry-point"""
+    if args and args[0] == "analyze":
+        from . import analysis
+        analysis.main(args[1:])
+        return
     parser = argparse.ArgumentParser(
-        description="An experimental autonomous zlap.io client")
+        description="An experimental autonomous zlap.io client",
+        epilog="Run `python3 -m autozlap analyze --help` to summarize capture files instead")
     parser.add_argument("--address", "-a", default=None)
     parser.add_argument("--port", "-p", type=int, default=None)
     parser.add_argument("--instances", "-i", type=int, default=1)
+    parser.add_argument("--servers-url", default=server_selector.SERVERS_URL,
+                        help="URL of the servers.json to pick servers from, with {time} "
+                        "replaced by a cache buster, e.g. the one printed by "
+                        "autozlap.local_server")
+    parser.add_argument("--columnar", action="store_true",
+                        help="Store player states in NumPy arrays (requires NumPy)")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of processes to split the instances across")
+    parser.add_argument("--stats-interval", type=float, default=sharding.DEFAULT_STATS_INTERVAL,
+                        help="Seconds between worker stats reports when using --workers")
+    parser.add_argument("--max-handshakes", type=int, default=transport.DEFAULT_MAX_HANDSHAKES,
+                        help="Maximum number of concurrent websocket handshakes per process")
+    parser.add_argument("--handshake-rate", type=float, default=transport.DEFAULT_HANDSHAKE_RATE,
+                        help="Maximum websocket handshakes started per second per process "
+                        "(0 for no limit)")
+    parser.add_argument("--connection-limit", type=int, default=transport.DEFAULT_CONNECTION_LIMIT,
+                        help="Maximum number of pooled connections per process (0 for no limit)")
+    parser.add_argument("--max-reconnects", type=int, default=None,
+                        help="Maximum reconnects per instance (default: unlimited)")
+    parser.add_argument("--repick-server", action="store_true",
+                        help="Place reconnecting instances on the least loaded server again")
+    parser.add_argument("--receive-queue", type=int, default=0, metavar="FRAMES",
+                        help="Read frames in a separate task into a queue of this size, and "
+                        "coalesce the sync packets that back up in it (default: 0, disabled)")
+    parser.add_argument("--capture", metavar="DIR", default=None,
+                        help="Record the frames received by each instance to a file in DIR")
+    parser.add_argument("--replay", metavar="FILE", default=None,
+                        help="Replay a capture file through the client instead of connecting")
+    parser.add_argument("--replay-paced", action="store_true",
+                        help="With --replay, deliver frames at their recorded intervals")
+    parser.add_argument("--log-level", default="INFO",
+                        help="Logging level, e.g. DEBUG to log every packet (default: INFO)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port of {} (with --workers, "
+                        "worker N uses this port + N)".format(
+                            instrumentation.DEFAULT_METRICS_HOST))
+    parser.add_argument("--metrics-json", metavar="FILE", default=None,
+                        help="Periodically write metrics as JSON to FILE (with --workers, "
+                        "one file per worker)")
+    parser.add_argument("--metrics-interval", type=float,
+                        default=instrumentation.DEFAULT_DUMP_INTERVAL,
+                        help="Seconds between writes of --metrics-json")
+    parser.add_argument("--dashboard", action="store_true",
+                        help="Print a live summary of all instances (without --workers)")
+    parser.add_argument("--dashboard-json", metavar="FILE", default=None,
+                        help="Periodically write the summary of all instances as JSON to FILE "
+                        "(without --workers)")
+    parser.add_argument("--dashboard-interval", type=float, default=supervisor.DEFAULT_INTERVAL,
+                        help="Seconds between summaries of --dashboard and --dashboard-json")
+    parser.add_argument("--policy", metavar="[MODULE:]CLASS", default=None,
+                        help="Policy class to control each instance with, e.g. "
+                        "ChaseNearestPolicy from autozlap.policy")
+    parser.add_argument("--policy-rate", type=float, default=policy.DEFAULT_RATE,
+                        help="Policy decisions per second per instance")
+    parser.add_argument("--policy-executor", choices=policy.EXECUTOR_KINDS, default="inline",
+                        help="Where to run policy decisions: on the event loop, or in a shared "
+                        "thread or process pool (default: inline)")
     parsed_args = parser.parse_args(args)
+    instrumentation.configure_logging(parsed_args.log_level)
+    policy_options = None
+    if parsed_args.policy:
+        policy_options = dict(policy=parsed_args.policy, rate=parsed_args.policy_rate,
+                              executor=parsed_args.policy_executor)
+    dashboard_options = dict(terminal=parsed_args.dashboard, json_path=parsed_args.dashboard_json,
+                             interval=parsed_args.dashboard_interval)
+    metrics_options = dict(port=parsed_args.metrics_port, json_path=parsed_args.metrics_json,
+                           interval=parsed_args.metrics_interval)
+    reconnect_policy = game_client.ReconnectPolicy(max_reconnects=parsed_args.max_reconnects,
+                                                   repick_server=parsed_args.repick_server)
+    transport_options = dict(
+        max_handshakes=parsed_args.max_handshakes,
+        handshake_rate=parsed_args.handshake_rate,
+        connection_limit=parsed_args.connection_limit
+    )
+    arena_class = game_client.Arena
+    if parsed_args.columnar:
+        from .columnar import ColumnarArena
+        arena_class = ColumnarArena
+    if parsed_args.replay:
+        loop = asyncio.get_event_loop()
+        session = game_client.Session(loop, Mode.ffa, arena_class)
+        print("Replayed {frames} frames ({bytes} bytes) in {seconds:.3f}s, "
+              "{frames_per_second:.1f} frames/s".format(**loop.run_until_complete(
+                  capture.replay(loop, parsed_args.replay, session, parsed_args.replay_paced))))
+        return
+    if parsed_args.capture:
+        os.makedirs(parsed_args.capture, exist_ok=True)
+    if parsed_args.workers > 1:
+        sharding.run_sharded(parsed_args.address, parsed_args.port, parsed_args.instances,
+                             parsed_args.workers, arena_class, parsed_args.stats_interval,
+                             transport_options, reconnect_policy, parsed_args.capture,
+                             parsed_args.log_level, metrics_options, policy_options,
+                             parsed_args.servers_url, parsed_args.receive_queue)
+        return
     loop = asyncio.get_event_loop()
-    loop.add_signal_handler(signal.SIGINT, loop.stop)
-    loop.run_until_complete(main_routine(loop, parsed_args.address,
-                                         parsed_args.port, parsed_args.instances))
+    main_task = loop.create_task(main_routine(loop, parsed_args.address,
+                                              parsed_args.port, parsed_args.instances,
+                                              arena_class, transport_options,
+                                              reconnect_policy, parsed_args.capture,
+                                              metrics_options, policy_options,
+                                              parsed_args.servers_url, dashboard_options,
+                                              parsed_args.receive_queue))
+    # Cancelling lets the sessions, capture files and exporters shut down cleanly
+    loop.add_signal_handler(signal.SIGINT, main_task.cancel)
+    try:
+        loop.run_until_complete(main_task)
+    except asyncio.CancelledError:
+        pass
@@ -22,195 +22,212 @@
 Networking component. Implements packet parsing
 """
 
-import construct
-import aiohttp
+import asyncio
+import collections
+import functools
+import inspect
+import logging
+import time
 
-from .constants import CLIENT_VERSION, Mode
+from . import encoder
+from .decoder import InboundDecoder
+from .instrumentation import Histogram
 
-vector2d = construct.Struct( #pylint: disable=invalid-name
-    "x" / construct.Float32l,
-    "y" / construct.Float32l
-)
+_logger = logging.getLogger(__name__)
 
-physical_state = construct.Struct( #pylint: disable=invalid-name
-    "position" / vector2d,
-    "velocity" / vector2d
-)
+def _log_send_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        _logger.warning("Failed to send packet: %r", future.exception())
+
+class ConnectionStats:
+    """
+    Counters and latency histograms for inbound and outbound traffic.
+    May be shared by successive Connections
+    """
+    __slots__ = ("packets_received", "bytes_received", "packets_sent", "bytes_sent",
+                 "packets_by_type", "parse_latency", "handler_latency", "queue_depth",
+                 "max_queue_depth", "frames_coalesced")
+
+    def __init__(self):
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_by_type = collections.Counter()
+        self.parse_latency = Histogram()
+        self.handler_latency = Histogram()
+        # Frames waiting in the receive queue when last drained, with receive_queue only
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.frames_coalesced = 0 # Sync frames reduced by pipeline.SyncCoalescer
+
+    @property
+    def parse_seconds(self):
+        """Total time spent parsing packets"""
+        return self.parse_latency.sum
+
+    @property
+    def handler_seconds(self):
+        """Total time spent handling parsed packets"""
+        return self.handler_latency.sum
+
+    def as_dict(self):
+        """Returns the scalar counters as a dict"""
+        return dict(
+            packets_received=self.packets_received,
+            bytes_received=self.bytes_received,
+            packets_sent=self.packets_sent,
+            bytes_sent=self.bytes_sent,
+            parse_seconds=self.parse_seconds,
+            handler_seconds=self.handler_seconds,
+            frames_coalesced=self.frames_coalesced
+        )
 
 class Connection:
-    """Represents the stateful networking connection"""
+    """
+    Represents the stateful networking connection
+
+    If fast_decoding is True, inbound packets are decoded by decoder.InboundDecoder instead of
+    the construct schema in schema.INBOUND_PACKET. Both produce the same logical objects.
+    If sync_arrays is True, sync payloads are decoded into NumPy structured arrays
+    by sync_arrays.ArraySyncDecoder instead.
+    stats is the ConnectionStats to update, or None to create one.
+    capture is a capture.CaptureWriter to record received frames to, or None.
+    If receive_queue is positive, frames are read by a separate task into a queue of that
+    size, and a backlog of sync frames is coalesced by pipeline.SyncCoalescer.
+    """
 
-    def __init__(self, websocket, mode, new_player_checker, current_player_checker):
+    def __init__(self, websocket, mode, parsing_context, fast_decoding=True, sync_arrays=False,
+                 stats=None, capture=None, receive_queue=0):
         self._websocket = websocket
+        self._receive_queue = receive_queue
+        self.stats = stats if stats is not None else ConnectionStats()
+        self._capture = capture
         self._mode = mode
-        self._is_new_player = new_player_checker
-        self._is_current_player = current_player_checker
-        self._inbound_packet = construct.Struct(
-            "type" / construct.Enum(
-                construct.Int8ul,
-                setup=0,
-                killed=1,
-                kill=2,
-                remove=3,
-                sync=4,
-                club_collision=5,
-                wall_collision=6,
-                set_leaderboard=7,
-                set_target_dim=8
-            ),
-            "payload" / construct.Switch(
-                construct.this.type, {
-                    "setup": construct.Struct(
-                        "server_version" / construct.CString(encoding="utf8"),
-                        construct.Check(construct.this.server_version == CLIENT_VERSION),
-                        "initial_time" / construct.Int32ul,
-                        "game_mode" / construct.Mapping(
-                            construct.Int8ul, {
-                                0: Mode.ffa,
-                                1: Mode.tdm
-                            },
-                            dict() # This packet is only received
-                        ),
-                        "current_player_id" / construct.Int32ul,
-                        "dimensions" / vector2d,
-                        "target_dimensions" / vector2d
-                    ),
-                    "killed": construct.Pass,
-                    "kill": construct.Struct(
-                        "timestamp" / construct.Int32ul,
-                        "killed_id" / construct.Int32ul,
-                        "death_position" / vector2d,
-                        "killer_id" / construct.Int32ul,
-                        "point_orb_count" / construct.Int32ul
-                    ),
-                    "remove": construct.Struct(
-                        "timestamp" / construct.Int32ul,
-                        "player_id" / construct.Int32ul
-                    ),
-                    "sync": construct.Struct(
-                        "timestamp" / construct.Int32ul,
-                        "remove_count" / construct.Int32ul,
-                        "removal_array" / construct.Array(
-                            construct.this.remove_count,
-                            construct.Int32ul
-                        ),
-                        "sync_count" / construct.Int32ul,
-                        "sync_array" / construct.Array(
-                            construct.this.sync_count,
-                            construct.Struct(
-                                "player_id" / construct.Int32ul,
-                                "is_new_player" / construct.Computed(
-                                    lambda ctx: self._is_new_player(ctx.player_id)
-                                ),
-                                "player_attributes" / construct.If(
-                                    construct.this.is_new_player,
-                                    construct.Embedded(
-                                        construct.Struct(
-                                            "player_name" / construct.IfThenElse(
-                                                lambda ctx: not self._is_current_player(
-                                                    ctx._.player_id
-                                                ),
-                                                construct.CString(encoding="utf8"),
-                                                construct.Pass
-                                            ),
-                                            "shield" / construct.Float32l,
-                                            "team_or_skin" / construct.Int8ul
-                                        )
-                                    )
-                                ),
-                                "player_state" / physical_state,
-                                "mace_state" / physical_state,
-                                "mace_radius" / construct.Float32l
-                            )
-                        )
-                    ),
-                    "club_collision": construct.Struct(
-                        "timestamp" / construct.Int32ul,
-                        "p" / vector2d, # TODO: Figure out purpose
-                        "i" / construct.Float32l, # TODO: Figure out purpose
-                        "first_id" / construct.Int32ul,
-                        "first_state" / physical_state,
-                        "second_id" / construct.Int32ul,
-                        "second_state" / physical_state
-                    ),
-                    "wall_collision": construct.Struct(
-                        "timestamp" / construct.Int32ul,
-                        "p" / vector2d, # TODO: Figure out purpose
-                        "i" / construct.Float32l, # TODO: Figure out purpose
-                        "player_id" / construct.Int32ul,
-                        "player_state" / physical_state,
-                        "mace_radius" / construct.Float32l
-                    ),
-                    "set_leaderboard": construct.Struct(
-                        "player_count" / construct.Int32ul,
-                        "total" / construct.Int32ul, # TODO: Figure out purpose,
-                        construct.Check(lambda ctx: self._mode in Mode),
-                        construct.IfThenElse(
-                            lambda ctx: self._mode == Mode.ffa,
-                            construct.Struct( # FFA
-                                "count" / construct.Int8ul,
-                                "first_entry_id" / construct.Int32ul,
-                                "leaderboard" / construct.Array(
-                                    construct.this.count,
-                                    construct.Struct(
-                                        "name" / construct.CString(encoding="utf8"),
-                                        "score" / construct.Int32ul,
-                                        )
-                                    ),
-                                "king_name" / construct.CString(encoding="utf8"),
-                                "king_score" / construct.Int32ul,
-                                "place" / construct.Int32ul,
-                                "score" / construct.Int32ul
-                            ),
-                            construct.Array(
-                                3,
-                                construct.Struct(
-                                    "id" / construct.Int8ul,
-                                    "score" / construct.Int32ul,
-                                    "count" / construct.Int32ul
-                                )
-                            )
-                        )
-                    ),
-                    "set_target_dim": construct.Struct("target_dimensions" / vector2d)
-                }
-            ),
-            "extraneous" / construct.GreedyBytes # For debugging
-        )
-        self._outbound_packet = construct.Struct(
-            "type" / construct.Enum(
-                construct.Int8ul,
-                play=0,
-                direction=1,
-                move_up=2,
-                move_down=3,
-                move_left=4,
-                move_right=5,
-                stop_move_up=6,
-                stop_move_down=7,
-                stop_move_left=8,
-                stop_move_right=9
-            ),
-            "payload" / construct.Switch(
-                construct.this.type, {
-                    "play": construct.Pass
-                            # TODO: Implement the rest of the packets
-                }
-            )
-        )
+        self.parsing_context = parsing_context
+        if sync_arrays:
+            from .sync_arrays import ArraySyncDecoder
+            self._parse = ArraySyncDecoder(mode, parsing_context).parse
+        elif fast_decoding:
+            self._parse = InboundDecoder(mode, parsing_context).parse
+        else:
+            from .schema import INBOUND_PACKET
+            self._parse = functools.partial(INBOUND_PACKET.parse,
+                                            parsing_context=parsing_context)
 
     async def listen_loop(self, parsed_callback):
         """Async listening loop"""
+        if self._receive_queue > 0:
+            await self._pipelined_listen_loop(parsed_callback)
+            return
+        from aiohttp import WSMsgType
+        stats = self.stats
+        capture = self._capture
+        perf_counter = time.perf_counter
         async for msg in self._websocket:
-            if msg.type == aiohttp.WSMsgType.BINARY:
-                parsed_packet = self._inbound_packet.parse(msg.data)
+            if msg.type == WSMsgType.BINARY:
+                if capture is not None:
+                    capture.write(msg.data)
+                parse_start = perf_counter()
+                parsed_packet = self._parse(msg.data)
+                handler_start = perf_counter()
+                stats.parse_latency.observe(handler_start - parse_start)
+                stats.packets_received += 1
+                stats.bytes_received += len(msg.data)
+                stats.packets_by_type[parsed_packet.type] += 1
                 if parsed_packet.extraneous: # For debugging
-                    print("Entire packet with extraneous: " + str(msg.data))
-                    print("Packet: " + str(parsed_packet))
+                    _logger.warning("Extraneous bytes in %s packet: %r", parsed_packet.type,
+                                    msg.data)
                 parsed_callback(parsed_packet)
+                stats.handler_latency.observe(perf_counter() - handler_start)
             else:
                 raise ValueError("Unexpected data type: " + msg.type.name)
 
+    async def _read_frames(self, queue):
+        """Puts received frames in queue, then None, or the exception that stopped reading"""
+        from aiohttp import WSMsgType
+        capture = self._capture
+        try:
+            async for msg in self._websocket:
+                if msg.type != WSMsgType.BINARY:
+                    raise ValueError("Unexpected data type: " + msg.type.name)
+                if capture is not None:
+                    capture.write(msg.data)
+                await queue.put(msg.data)
+        except asyncio.CancelledError: #pylint: disable=try-except-raise
+            raise
+        except Exception as exc: #pylint: disable=broad-except
+            await queue.put(exc)
+        else:
+            await queue.put(None)
+
+    async def _pipelined_listen_loop(self, parsed_callback): #pylint: disable=too-many-branches
+        """Processes the frames that a reader task queues, coalescing backlogs of sync frames"""
+        from .pipeline import SYNC_TYPE, SyncCoalescer
+        stats = self.stats
+        perf_counter = time.perf_counter
+        coalescer = SyncCoalescer()
+        queue = asyncio.Queue(self._receive_queue)
+        reader = asyncio.ensure_future(self._read_frames(queue))
+        try:
+            while True:
+                backlog = [await queue.get()]
+                while not queue.empty():
+                    backlog.append(queue.get_nowait())
+                stats.queue_depth = len(backlog)
+                stats.max_queue_depth = max(stats.max_queue_depth, len(backlog))
+                last_sync = max((index for index, frame in enumerate(backlog)
+                                 if isinstance(frame, bytes) and frame and frame[0] == SYNC_TYPE),
+                                default=None)
+                for index, frame in enumerate(backlog):
+                    if frame is None:
+                        return
+                    if isinstance(frame, Exception):
+                        raise frame
+                    parse_start = perf_counter()
+                    parsed_packet = self._parse(frame)
+                    if parsed_packet.type == "sync":
+                        if index < last_sync:
+                            parsed_packet = coalescer.reduce(parsed_packet)
+                            stats.frames_coalesced += 1
+                        else:
+                            parsed_packet = coalescer.merge(parsed_packet)
+                    elif parsed_packet.type == "kill":
+                        coalescer.forget(parsed_packet.payload.killed_id)
+                    elif parsed_packet.type == "remove":
+                        coalescer.forget(parsed_packet.payload.player_id)
+                    handler_start = perf_counter()
+                    stats.parse_latency.observe(handler_start - parse_start)
+                    stats.packets_received += 1
+                    stats.bytes_received += len(frame)
+                    stats.packets_by_type[parsed_packet.type] += 1
+                    if parsed_packet.extraneous: # For debugging
+                        _logger.warning("Extraneous bytes in %s packet: %r", parsed_packet.type,
+                                        frame)
+                    parsed_callback(parsed_packet)
+                    stats.handler_latency.observe(perf_counter() - handler_start)
+        finally:
+            reader.cancel()
+            try:
+                await reader
+            except asyncio.CancelledError:
+                pass
+
+    def _write_frame(self, frame):
+        self.stats.packets_sent += 1
+        self.stats.bytes_sent += len(frame)
+        # aiohttp 3 returns a coroutine, while older versions write immediately
+        return self._websocket.send_bytes(frame)
+
     def send(self, packet):
-        """Builds and sends a packet"""
-        self._websocket.send_bytes(self._outbound_packet.build(packet))
+        """Encodes and sends a packet without waiting for it to be written"""
+        result = self._write_frame(encoder.encode(packet))
+        if inspect.isawaitable(result):
+            asyncio.ensure_future(result).add_done_callback(_log_send_error)
+
+    async def write_frames(self, frames):
+        """Sends already encoded packets in order"""
+        for frame in frames:
+            result = self._write_frame(frame)
+            if inspect.isawaitable(result):
+                await result
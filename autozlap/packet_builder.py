@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Builds inbound (server to client) packets.
+
+Used to generate synthetic frames for decoder checks and benchmarks, and by local_server.
+Vectors are (x, y) tuples and physical states are (pos_x, pos_y, vel_x, vel_y) tuples.
+"""
+
+import struct
+
+from .constants import CLIENT_VERSION, Mode
+
+_GAME_MODE_NUMS = {
+    Mode.ffa: 0,
+    Mode.tdm: 1
+}
+
+def _cstring(string):
+    return string.encode("utf8") + b"\0"
+
+def build_setup(current_player_id, dimensions, target_dimensions, mode=Mode.ffa,
+                initial_time=0, server_version=CLIENT_VERSION):
+    """Builds a setup packet"""
+    return b"".join((
+        b"\x00",
+        _cstring(server_version),
+        struct.pack("<IBI", initial_time, _GAME_MODE_NUMS[mode], current_player_id),
+        struct.pack("<4f", dimensions[0], dimensions[1], target_dimensions[0],
+                    target_dimensions[1])
+    ))
+
+def build_killed():
+    """Builds a killed packet"""
+    return b"\x01"
+
+def build_kill(timestamp, killed_id, death_position, killer_id, point_orb_count=0):
+    """Builds a kill packet"""
+    return b"\x02" + struct.pack("<II2fII", timestamp, killed_id, death_position[0],
+                                 death_position[1], killer_id, point_orb_count)
+
+def build_remove(timestamp, player_id):
+    """Builds a remove packet"""
+    return b"\x03" + struct.pack("<II", timestamp, player_id)
+
+def build_sync_entry(player_id, attributes, state):
+    """Builds one sync_array entry of a sync packet. Arguments are as in build_sync()"""
+    parts = [struct.pack("<I", player_id)]
+    if attributes is not None:
+        player_name, shield, team_or_skin = attributes
+        if player_name is not None:
+            parts.append(_cstring(player_name))
+        parts.append(struct.pack("<fB", shield, team_or_skin))
+    parts.append(struct.pack("<9f", *state))
+    return b"".join(parts)
+
+def build_sync_from_entries(timestamp, removal_array, entry_frames):
+    """Builds a sync packet from a sequence of entries built by build_sync_entry()"""
+    return b"".join((
+        b"\x04",
+        struct.pack("<II", timestamp, len(removal_array)),
+        struct.pack("<{}I".format(len(removal_array)), *removal_array),
+        struct.pack("<I", len(entry_frames)),
+        b"".join(entry_frames)
+    ))
+
+def build_sync(timestamp, removal_array, sync_entries):
+    """
+    Builds a sync packet
+
+    sync_entries is an iterable of tuples (player_id, attributes, state):
+    * attributes is None for known players, or a tuple (player_name, shield, team_or_skin)
+      for new players. player_name must be None for the current player.
+    * state is a tuple of 9 floats in wire order: player position and velocity,
+      mace position and velocity, then mace radius.
+    """
+    return build_sync_from_entries(timestamp, removal_array, [
+        build_sync_entry(player_id, attributes, state)
+        for player_id, attributes, state in sync_entries])
+
+def build_club_collision(timestamp, p, i, first_id, first_state, second_id,
+                         second_state): #pylint: disable=invalid-name
+    """Builds a club_collision packet"""
+    return b"\x05" + struct.pack("<I2ffI4fI4f", timestamp, p[0], p[1], i, first_id,
+                                 *first_state, second_id, *second_state)
+
+def build_wall_collision(timestamp, p, i, player_id, player_state,
+                         mace_radius): #pylint: disable=invalid-name
+    """Builds a wall_collision packet"""
+    return b"\x06" + struct.pack("<I2ffI4ff", timestamp, p[0], p[1], i, player_id,
+                                 *player_state, mace_radius)
+
+def build_set_leaderboard_ffa(player_count, total, first_entry_id, entries, king, place,
+                              score):
+    """
+    Builds a set_leaderboard packet for FFA mode
+
+    entries is a list of (name, score) tuples, and king is a (name, score) tuple
+    """
+    parts = [
+        b"\x07",
+        struct.pack("<IIBI", player_count, total, len(entries), first_entry_id)
+    ]
+    for name, entry_score in entries:
+        parts.append(_cstring(name))
+        parts.append(struct.pack("<I", entry_score))
+    parts.append(_cstring(king[0]))
+    parts.append(struct.pack("<III", king[1], place, score))
+    return b"".join(parts)
+
+def build_set_leaderboard_tdm(player_count, total, teams):
+    """
+    Builds a set_leaderboard packet for TDM mode
+
+    teams is a list of three (id, score, count) tuples
+    """
+    parts = [b"\x07", struct.pack("<II", player_count, total)]
+    for team in teams:
+        parts.append(struct.pack("<BII", *team))
+    return b"".join(parts)
+
+def build_set_target_dim(target_dimensions):
+    """Builds a set_target_dim packet"""
+    return b"\x08" + struct.pack("<2f", target_dimensions[0], target_dimensions[1])
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Coalescing of sync packets that queue up behind a slow packet handler.
+
+When networking.Connection runs its two-stage receive pipeline, every queued frame is still
+parsed in order, since the layout of a sync packet depends on the players already known.
+But a sync packet with a newer one queued behind it is reduced to its structural changes,
+its removals and new players, and the player states it carried are applied along with the
+newest sync packet instead. Handling a backlog thus costs one full sync, whatever its length.
+The carried states keep the timestamps of the packets they came from, in the
+carried_timestamps of the merged payload (see prediction.sync_state_groups()).
+"""
+
+SYNC_TYPE = 4 # Type byte of sync packets
+
+def _copy(record, **changes):
+    """Returns a copy of a decoder Record or construct Container with changes"""
+    copied = type(record)(record)
+    for name, value in changes.items():
+        copied[name] = value
+    return copied
+
+def _timestamp(pending_state):
+    return pending_state[0]
+
+class SyncCoalescer:
+    """
+    Reduces stale sync packets, and carries their player states to the next full one
+
+    Accepts sync payloads of any decoder, including sync_arrays.ArraySyncDecoder.
+    Reduced payloads have coalesced set to True. Merged payloads start with the carried
+    states, oldest first, and have carried_timestamps with the timestamp of each.
+    """
+    def __init__(self):
+        # player id -> (timestamp, state) to apply with the next full sync
+        self._pending = dict()
+
+    def forget(self, player_id):
+        """Drops the pending state of a player that left, e.g. on a kill or remove packet"""
+        self._pending.pop(player_id, None)
+
+    def reduce(self, packet):
+        """Returns a sync packet with only the removals and new players of packet"""
+        payload = packet.payload
+        for player_id in payload.removal_array:
+            self._pending.pop(player_id, None)
+        pending = self._pending
+        timestamp = payload.timestamp
+        if "records" in payload:
+            records = payload.records
+            new_ids = set(sync_struct.player_id for sync_struct in payload.new_players)
+            new_indices = list()
+            for index, player_id in enumerate(records["player_id"].tolist()):
+                pending[player_id] = (timestamp, records[index])
+                if player_id in new_ids:
+                    new_indices.append(index)
+            reduced = _copy(payload, records=records[new_indices], sync_count=len(new_indices),
+                            coalesced=True)
+        else:
+            sync_array = list()
+            for sync_struct in payload.sync_array:
+                if sync_struct.is_new_player:
+                    sync_array.append(sync_struct)
+                    # Its state is carried as that of a known player
+                    sync_struct = _copy(sync_struct, is_new_player=False, player_attributes=None)
+                pending[sync_struct.player_id] = (timestamp, sync_struct)
+            reduced = _copy(payload, sync_array=sync_array, sync_count=len(sync_array),
+                            coalesced=True)
+        return _copy(packet, payload=reduced)
+
+    def merge(self, packet):
+        """Returns a sync packet that also carries the pending states of earlier ones"""
+        pending = self._pending
+        if not pending:
+            return packet
+        self._pending = dict()
+        payload = packet.payload
+        for player_id in payload.removal_array:
+            pending.pop(player_id, None)
+        if "records" in payload:
+            updated_ids = payload.records["player_id"].tolist()
+        else:
+            updated_ids = [sync_struct.player_id for sync_struct in payload.sync_array]
+        for player_id in updated_ids:
+            pending.pop(player_id, None)
+        if not pending:
+            return packet
+        carried = sorted(pending.values(), key=_timestamp)
+        states = [state for _, state in carried]
+        if "records" in payload:
+            import numpy
+            records = payload.records
+            merged = _copy(payload, records=numpy.concatenate((
+                numpy.array(states, dtype=records.dtype), records)))
+        else:
+            merged = _copy(payload, sync_array=states + payload.sync_array)
+        merged["sync_count"] = len(carried) + len(updated_ids)
+        merged["carried_timestamps"] = [timestamp for timestamp, _ in carried]
+        return _copy(packet, payload=merged)
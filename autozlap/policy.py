@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bot decision loop.
+
+A Policy turns read-only ArenaSnapshots into Intents. A PolicyRunner calls it at a fixed
+rate on the event loop, or in an executor, independently of packet arrival, and applies the
+Intents to the Session's controls.InputScheduler.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import importlib
+import logging
+import math
+import time
+
+from .encoder import MOVE_DIRECTIONS
+from .instrumentation import Histogram
+
+DEFAULT_RATE = 10.0 # decisions per second
+EXECUTOR_KINDS = ("inline", "thread", "process")
+
+_logger = logging.getLogger(__name__)
+
+PlayerSnapshot = collections.namedtuple("PlayerSnapshot", (
+    "id", "name", "position", "velocity", "mace_position", "mace_velocity"))
+PlayerSnapshot.__doc__ = "A player's state. Vectors are (x, y) tuples"
+
+ArenaSnapshot = collections.namedtuple("ArenaSnapshot", (
+    "time", "current_player", "players", "dimensions"))
+ArenaSnapshot.__doc__ = """
+A read-only copy of an Arena
+
+time is the loop time of the snapshot, current_player is a PlayerSnapshot or None,
+players is a tuple of PlayerSnapshots of everyone else, and dimensions is an (x, y) tuple
+or None.
+"""
+
+Intent = collections.namedtuple("Intent", ("direction", "moving"))
+Intent.__new__.__defaults__ = (None, None)
+Intent.__doc__ = """
+Inputs decided by a Policy
+
+direction is an angle in radians, and moving is a collection of the MOVE_DIRECTIONS to hold.
+Either may be None to leave it unchanged.
+"""
+
+def _vector(vector):
+    return (vector.x, vector.y)
+
+def _snapshot_player(player):
+    return PlayerSnapshot(player.id, player.name if isinstance(player.name, str) else None,
+                          _vector(player.position), _vector(player.velocity),
+                          _vector(player.mace.position), _vector(player.mace.velocity))
+
+def _is_synced(player):
+    x = player.position.x #pylint: disable=invalid-name
+    return x is not None and not math.isnan(x) # NaN in a columnar.ColumnarArena
+
+def snapshot_arena(arena, now):
+    """
+    Returns an ArenaSnapshot of a game_client.Arena at loop time now
+
+    Players without a synced position are left out.
+    """
+    current_player = arena.current_player
+    current_id = current_player.id if current_player is not None else None
+    dimensions = arena.dimensions
+    return ArenaSnapshot(
+        now,
+        (_snapshot_player(current_player)
+         if current_id in arena.players and _is_synced(current_player) else None),
+        tuple(_snapshot_player(player) for player_id, player in arena.players.items()
+              if player_id != current_id and _is_synced(player)),
+        (dimensions.x, dimensions.y) if dimensions is not None else None
+    )
+
+class Policy:
+    """
+    Decides inputs from Arena snapshots
+
+    With a process executor, the policy is pickled for every decision, so any state it
+    changes in decide() is lost.
+    """
+    def decide(self, snapshot): #pylint: disable=no-self-use,unused-argument
+        """Returns an Intent for an ArenaSnapshot, or None for no change"""
+        return None
+
+class ChaseNearestPolicy(Policy):
+    """Steers towards the nearest other player"""
+    def decide(self, snapshot):
+        me = snapshot.current_player #pylint: disable=invalid-name
+        if me is None or not snapshot.players:
+            return Intent(moving=())
+        nearest = min(snapshot.players, key=lambda player: math.hypot(
+            player.position[0] - me.position[0], player.position[1] - me.position[1]))
+        delta_x = nearest.position[0] - me.position[0]
+        delta_y = nearest.position[1] - me.position[1]
+        moving = list()
+        if abs(delta_x) > 1.0:
+            moving.append("right" if delta_x > 0 else "left")
+        if abs(delta_y) > 1.0:
+            moving.append("down" if delta_y > 0 else "up")
+        return Intent(math.atan2(delta_y, delta_x), moving)
+
+def apply_intent(inputs, intent):
+    """Applies an Intent to a controls.InputScheduler"""
+    if intent.direction is not None:
+        inputs.set_direction(intent.direction)
+    if intent.moving is not None:
+        for direction in MOVE_DIRECTIONS:
+            if direction in intent.moving:
+                inputs.press(direction)
+            else:
+                inputs.release(direction)
+
+class PolicyRunner:
+    """
+    Runs a Policy for a Session at a fixed rate while it is in game
+
+    If executor is None, decisions run inline on the event loop. Otherwise they run in the
+    concurrent.futures.Executor, and packets keep being handled meanwhile. A tick that
+    starts after its deadline (the start of the next tick) counts as a deadline miss, and
+    missed ticks are skipped rather than run in a burst.
+    """
+    def __init__(self, loop, session, policy, rate=DEFAULT_RATE, executor=None):
+        self._loop = loop
+        self._session = session
+        self.policy = policy
+        self.interval = 1.0 / rate
+        self.executor = executor
+        self._task = None
+        self.ticks = 0
+        self.deadline_misses = 0
+        self.decide_latency = Histogram()
+
+    async def _decide(self, snapshot):
+        if self.executor is None:
+            return self.policy.decide(snapshot)
+        return await self._loop.run_in_executor(self.executor, self.policy.decide, snapshot)
+
+    async def _run(self):
+        next_tick = self._loop.time()
+        while True:
+            lateness = self._loop.time() - next_tick
+            if lateness >= self.interval:
+                missed = int(lateness / self.interval)
+                self.deadline_misses += missed
+                next_tick += missed * self.interval
+            # Always yield, so that a late or inline policy cannot starve packet handling
+            await asyncio.sleep(max(-lateness, 0))
+            next_tick += self.interval
+            session = self._session
+            if not session.in_game or session.arena.current_player is None:
+                continue
+            snapshot = snapshot_arena(session.arena, self._loop.time())
+            decide_start = time.perf_counter()
+            try:
+                intent = await self._decide(snapshot)
+            except Exception: #pylint: disable=broad-except
+                _logger.exception("Policy %r failed", self.policy)
+                intent = None
+            self.decide_latency.observe(time.perf_counter() - decide_start)
+            self.ticks += 1
+            if intent is not None:
+                apply_intent(session.inputs, intent)
+
+    def start(self):
+        """Starts running the policy"""
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        """Stops running the policy"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+def load_policy(spec):
+    """Returns a new Policy from a "module:ClassName" spec, or a class name in this module"""
+    module_name, _, class_name = spec.rpartition(":")
+    return getattr(importlib.import_module(module_name or __name__), class_name)()
+
+def create_executor(kind, max_workers=None):
+    """Returns a concurrent.futures.Executor for one of EXECUTOR_KINDS, or None for inline"""
+    if kind == "inline":
+        return None
+    if kind == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers)
+    if kind == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers)
+    raise ValueError("Unknown executor kind: {!r}".format(kind))
+
+def attach_policies(sessions, policy, rate=DEFAULT_RATE, executor="inline"):
+    """
+    Attaches a new Policy from the spec policy to each game_client.Session, sharing one
+    executor of the given kind. Returns the executor, to be shut down by the caller, or None.
+    """
+    shared_executor = create_executor(executor)
+    for session in sessions:
+        session.attach_policy(load_policy(policy), rate, shared_executor)
+    return shared_executor
@@ -0,0 +1,296 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Dead reckoning of player and mace states between sync packets.
+
+States are extrapolated linearly from the last known position and velocity, in server
+timestamp units. The server clock is estimated from the timestamps of sync packets and
+their local arrival times. Requires NumPy.
+"""
+
+import collections
+import itertools
+import time
+
+import numpy
+
+from .columnar import PlayerStore, POSITION, MACE_POSITION, MACE_RADIUS, STATE_WIDTH
+
+DEFAULT_VELOCITY_SCALE = 1.0 # position units per velocity unit per timestamp unit
+DEFAULT_TIME_SCALE = 1e-3 # seconds per timestamp unit
+DEFAULT_CLOCK_WINDOW = 64 # samples
+
+class ServerClock:
+    """
+    Maps local time to server timestamps
+
+    The offset is the smallest seen in the last window samples, since network delay
+    only ever makes packets late.
+    """
+    def __init__(self, time_scale=DEFAULT_TIME_SCALE, window=DEFAULT_CLOCK_WINDOW):
+        self.time_scale = time_scale
+        self._offsets = collections.deque(maxlen=window)
+
+    def observe(self, timestamp, local_time):
+        """Records that a packet with timestamp arrived at local_time"""
+        self._offsets.append(local_time - timestamp * self.time_scale)
+
+    def server_time(self, local_time):
+        """Returns the estimated server timestamp at local_time, or None before any sample"""
+        if not self._offsets:
+            return None
+        return (local_time - min(self._offsets)) / self.time_scale
+
+class PredictionError:
+    """Accumulated distances between predicted and later observed positions"""
+    __slots__ = ("count", "total", "total_squared", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squared = 0.0
+        self.maximum = 0.0
+
+    def add(self, errors):
+        """Adds an array of error distances"""
+        if not len(errors): #pylint: disable=len-as-condition
+            return
+        self.count += len(errors)
+        self.total += float(errors.sum())
+        self.total_squared += float(numpy.square(errors).sum())
+        self.maximum = max(self.maximum, float(errors.max()))
+
+    def as_dict(self):
+        """Returns the count, mean, root mean square and maximum error"""
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else 0.0,
+            rms=(self.total_squared / self.count) ** 0.5 if self.count else 0.0,
+            maximum=self.maximum
+        )
+
+class _TimedPlayerStore(PlayerStore):
+    """A PlayerStore that also keeps the timestamp of each state, and the previous state"""
+    def __init__(self):
+        super().__init__()
+        self.timestamps = numpy.zeros(len(self.ids), dtype=numpy.float64)
+        self.previous_state = numpy.full_like(self.state, numpy.nan)
+        self.previous_timestamps = numpy.zeros(len(self.ids), dtype=numpy.float64)
+
+    def _grow(self):
+        old_capacity = len(self.ids)
+        super()._grow()
+        extra = len(self.ids) - old_capacity
+        self.timestamps = numpy.concatenate((self.timestamps, numpy.zeros(extra)))
+        self.previous_timestamps = numpy.concatenate((self.previous_timestamps,
+                                                      numpy.zeros(extra)))
+        self.previous_state = numpy.concatenate((
+            self.previous_state,
+            numpy.full((extra, STATE_WIDTH), numpy.nan, dtype=numpy.float32)))
+
+    def free(self, player_id):
+        slot = self.index[player_id]
+        super().free(player_id)
+        self.previous_state[slot] = numpy.nan
+
+def sync_states(sync_payload):
+    """Returns a tuple (ids, state rows) of NumPy arrays from a sync payload of any decoder"""
+    if "records" in sync_payload:
+        records = sync_payload.records
+        return records["player_id"].astype(numpy.int64), records["state"]
+    ids = numpy.fromiter((entry.player_id for entry in sync_payload.sync_array),
+                         dtype=numpy.int64, count=len(sync_payload.sync_array))
+    rows = numpy.array([(
+        entry.player_state.position.x, entry.player_state.position.y,
+        entry.player_state.velocity.x, entry.player_state.velocity.y,
+        entry.mace_state.position.x, entry.mace_state.position.y,
+        entry.mace_state.velocity.x, entry.mace_state.velocity.y,
+        entry.mace_radius
+    ) for entry in sync_payload.sync_array], dtype=numpy.float32).reshape(-1, STATE_WIDTH)
+    return ids, rows
+
+def sync_state_groups(sync_payload):
+    """
+    Returns a list of (timestamp, ids, state rows) from a sync payload of any decoder
+
+    The states that pipeline.SyncCoalescer carried from coalesced sync packets come first,
+    grouped by the timestamp of the packet they were in, oldest first. The states of the
+    payload itself come last, with its timestamp.
+    """
+    ids, rows = sync_states(sync_payload)
+    groups = list()
+    start = 0
+    for timestamp, run in itertools.groupby(sync_payload.get("carried_timestamps", ())):
+        end = start + sum(1 for _ in run)
+        groups.append((timestamp, ids[start:end], rows[start:end]))
+        start = end
+    groups.append((sync_payload.timestamp, ids[start:], rows[start:]))
+    return groups
+
+def _physical_row(physical_state):
+    return (physical_state.position.x, physical_state.position.y,
+            physical_state.velocity.x, physical_state.velocity.y)
+
+class Predictor:
+    """
+    Extrapolates and interpolates the states of every tracked player at once
+
+    Maintained by game_client.Arena once enabled with Arena.enable_prediction().
+    Prediction errors are measured against every sync for players that were already tracked.
+    clock returns the local time in seconds, and is used to estimate the server time.
+    """
+    def __init__(self, velocity_scale=DEFAULT_VELOCITY_SCALE, time_scale=DEFAULT_TIME_SCALE,
+                 clock=time.monotonic):
+        self.velocity_scale = velocity_scale
+        self.server_clock = ServerClock(time_scale)
+        self._clock = clock
+        self.store = _TimedPlayerStore()
+        self.player_error = PredictionError()
+        self.mace_error = PredictionError()
+        self.latest_timestamp = None
+
+    def __len__(self):
+        return len(self.store)
+
+    def reset(self):
+        """Forgets all players and the server clock, e.g. before reconnecting"""
+        self.server_clock = ServerClock(self.server_clock.time_scale)
+        self.store = _TimedPlayerStore()
+        self.latest_timestamp = None
+
+    def remove(self, player_id):
+        """Stops tracking a player, if tracked"""
+        if player_id in self.store.index:
+            self.store.free(player_id)
+
+    def _extrapolate(self, slots, timestamp, column):
+        """Returns the positions at column of slots, advanced to timestamp"""
+        store = self.store
+        elapsed = (timestamp - store.timestamps[slots]) * self.velocity_scale
+        positions = store.state[slots, column:column + 2].astype(numpy.float64)
+        velocities = store.state[slots, column + 2:column + 4]
+        return positions + velocities * elapsed[:, numpy.newaxis]
+
+    def _measure_error(self, slots, rows, timestamp):
+        tracked = ~numpy.isnan(self.store.state[slots, POSITION])
+        if not tracked.any():
+            return
+        tracked_slots = slots[tracked]
+        for error, column in ((self.player_error, POSITION), (self.mace_error, MACE_POSITION)):
+            difference = (self._extrapolate(tracked_slots, timestamp, column)
+                          - rows[tracked, column:column + 2])
+            error.add(numpy.hypot(difference[:, 0], difference[:, 1]))
+
+    def observe(self, timestamp, ids, rows, measure_error=True):
+        """Records the state rows of players ids at timestamp, as in columnar.PlayerStore"""
+        store = self.store
+        slots = numpy.fromiter((store.allocate(player_id) for player_id in ids.tolist()),
+                               dtype=numpy.int64, count=len(ids))
+        if measure_error:
+            self._measure_error(slots, rows, timestamp)
+        store.previous_state[slots] = store.state[slots]
+        store.previous_timestamps[slots] = store.timestamps[slots]
+        store.state[slots] = rows
+        store.timestamps[slots] = timestamp
+
+    def observe_sync(self, sync_payload):
+        """Applies the removals and states of a sync packet payload of any decoder"""
+        for player_id in sync_payload.removal_array:
+            self.remove(player_id)
+        # States carried from coalesced sync packets are observed at their own timestamps
+        for timestamp, ids, rows in sync_state_groups(sync_payload):
+            self.observe(timestamp, ids, rows)
+        self.latest_timestamp = sync_payload.timestamp
+        self.server_clock.observe(sync_payload.timestamp, self._clock())
+
+    def _correct(self, timestamp, player_id, column, physical_state):
+        slot = self.store.index.get(player_id)
+        if slot is None:
+            return
+        # Advance the rest of the row, so that it shares the corrected timestamp
+        row = self.store.state[slot].copy()
+        for other_column in (POSITION, MACE_POSITION):
+            row[other_column:other_column + 2] = self._extrapolate(
+                numpy.array([slot]), timestamp, other_column)[0]
+        row[column:column + 4] = _physical_row(physical_state)
+        self.store.state[slot] = row
+        self.store.timestamps[slot] = timestamp
+
+    def observe_club_collision(self, payload):
+        """Corrects the mace states of both players in a club_collision packet payload"""
+        self._correct(payload.timestamp, payload.first_id, MACE_POSITION, payload.first_state)
+        self._correct(payload.timestamp, payload.second_id, MACE_POSITION, payload.second_state)
+
+    def observe_wall_collision(self, payload):
+        """Corrects the player state and mace radius in a wall_collision packet payload"""
+        self._correct(payload.timestamp, payload.player_id, POSITION, payload.player_state)
+        slot = self.store.index.get(payload.player_id)
+        if slot is not None:
+            self.store.state[slot, MACE_RADIUS] = payload.mace_radius
+
+    def now(self):
+        """Returns the estimated current server timestamp, or None before any sync"""
+        return self.server_clock.server_time(self._clock())
+
+    def _occupied_slots(self):
+        return numpy.flatnonzero((self.store.ids >= 0) & ~numpy.isnan(
+            self.store.state[:, POSITION]))
+
+    def predict(self, timestamp=None):
+        """
+        Returns a tuple (ids, positions, mace positions) of NumPy arrays with every tracked
+        player extrapolated to timestamp. Positions are (n, 2) float64 arrays.
+        timestamp defaults to now()
+        """
+        if timestamp is None:
+            timestamp = self.now()
+        slots = self._occupied_slots()
+        if timestamp is None:
+            timestamp = self.store.timestamps[slots]
+        return (self.store.ids[slots], self._extrapolate(slots, timestamp, POSITION),
+                self._extrapolate(slots, timestamp, MACE_POSITION))
+
+    def interpolate(self, timestamp):
+        """
+        Returns a tuple (ids, positions, mace positions) like predict(), with positions
+        interpolated between the previous and latest states of each player. Times outside
+        of that interval are clamped, and players seen once are at their latest state.
+        """
+        store = self.store
+        slots = self._occupied_slots()
+        start = store.previous_timestamps[slots]
+        end = store.timestamps[slots]
+        span = end - start
+        has_previous = ~numpy.isnan(store.previous_state[slots, POSITION]) & (span > 0)
+        fraction = numpy.ones(len(slots))
+        fraction[has_previous] = numpy.clip(
+            (timestamp - start[has_previous]) / span[has_previous], 0.0, 1.0)
+        fraction = fraction[:, numpy.newaxis]
+        previous = numpy.where(has_previous[:, numpy.newaxis], store.previous_state[slots],
+                               store.state[slots]).astype(numpy.float64)
+        latest = store.state[slots].astype(numpy.float64)
+        blended = previous + (latest - previous) * fraction
+        return (store.ids[slots], blended[:, POSITION:POSITION + 2],
+                blended[:, MACE_POSITION:MACE_POSITION + 2])
+
+    def errors(self):
+        """Returns a dict of the prediction error stats of players and maces"""
+        return dict(player=self.player_error.as_dict(), mace=self.mace_error.as_dict())
@@ -20,30 +20,148 @@
 
 """Pre-game client component for selecting servers"""
 
+import asyncio
+import collections
+import logging
 import time
 
-import aiohttp
-
 from .constants import Mode, CLIENT_VERSION
+from . import transport
+
+_logger = logging.getLogger(__name__)
+
+SERVERS_URL = "http://zlap.io/servers.json?_={time}"
+DEFAULT_TTL = 30.0 # seconds
+
+ServerInfo = collections.namedtuple("ServerInfo", ("address", "port", "mode", "version",
+                                                   "players"))
+
+def _parse_server(server):
+    """Returns a ServerInfo from a servers.json entry, or None if the mode is unknown"""
+    try:
+        mode = Mode(server["mode"])
+    except ValueError:
+        return None
+    address, port = server["address"].rsplit(":", 1)
+    return ServerInfo(address, int(port), mode, server["version"], server.get("players", 0))
+
+class ServerDirectory:
+    """
+    A cached view of servers.json
+
+    The server list is fetched at most once per ttl seconds, or refreshed in the background
+    with start_background_refresh(). Instances placed with place() or counted with
+    count_placed() are counted towards the load of their server until release() is called.
+    """
+    def __init__(self, loop, ttl=DEFAULT_TTL, url=SERVERS_URL):
+        self._loop = loop
+        self.ttl = ttl
+        self._url = url
+        self._servers = dict() # (mode, version) -> list of ServerInfo
+        self._fetch_time = None
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task = None
+        self._placed = collections.Counter() # (address, port) -> instances placed by us
+        self.fetch_count = 0
+
+    @property
+    def is_stale(self):
+        """Whether the cached server list is older than ttl"""
+        return self._fetch_time is None or self._loop.time() - self._fetch_time >= self.ttl
+
+    async def refresh(self):
+        """Fetches servers.json and rebuilds the index"""
+        async with self._refresh_lock:
+            current_time = int(time.time()*1000)
+            server_list = await transport.get_shared(self._loop).get_json(
+                self._url.format(time=current_time))
+            servers = dict()
+            for server_sub_list in server_list:
+                for server in server_sub_list:
+                    server_info = _parse_server(server)
+                    if server_info is not None:
+                        servers.setdefault((server_info.mode, server_info.version),
+                                           list()).append(server_info)
+            self._servers = servers
+            self._fetch_time = self._loop.time()
+            self.fetch_count += 1
 
-_SERVERS_URL = "http://zlap.io/servers.json?_={time}"
+    async def servers(self, mode=Mode.ffa, version=CLIENT_VERSION):
+        """Returns the list of ServerInfo for a mode and version, refreshing if stale"""
+        if self.is_stale:
+            await self.refresh()
+        return self._servers.get((mode, version), list())
 
-async def _fetch_servers_json(loop):
-    """Fetches the list of servers in JSON format"""
-    async with aiohttp.ClientSession(loop=loop) as session:
-        current_time = int(time.time()*1000)
-        async with session.get(_SERVERS_URL + str(current_time)) as response:
-            return await response.json()
+    def load(self, server_info):
+        """Returns the reported player count plus the instances placed by us"""
+        return server_info.players + self._placed[(server_info.address, server_info.port)]
 
-async def select_server(loop, mode=Mode.ffa, ignore_empty_servers=True):
+    async def place(self, mode=Mode.ffa, count=1, ignore_empty_servers=True):
+        """
+        Assigns count instances to the least loaded compatible servers
+
+        Returns a list of (address, port) with one entry per instance.
+        Raises LookupError if no server matches.
+        """
+        candidates = [server_info for server_info in await self.servers(mode)
+                      if not ignore_empty_servers or server_info.players > 0]
+        if not candidates:
+            raise LookupError("No {} server with version {} available".format(
+                mode.value, CLIENT_VERSION))
+        placements = list()
+        for _ in range(count):
+            server_info = min(candidates, key=self.load)
+            self._placed[(server_info.address, server_info.port)] += 1
+            placements.append((server_info.address, server_info.port))
+        return placements
+
+    def count_placed(self, placements):
+        """Counts instances placed by another directory, given a list of (address, port)"""
+        self._placed.update(placements)
+
+    def release(self, address, port):
+        """Stops counting an instance placed on (address, port)"""
+        key = (address, port)
+        if self._placed[key] > 0:
+            self._placed[key] -= 1
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh()
+            except Exception as exc: #pylint: disable=broad-except
+                _logger.warning("Failed to refresh server list: %r", exc)
+
+    def start_background_refresh(self):
+        """Starts refreshing the server list every ttl seconds"""
+        if self._refresh_task is None:
+            self._refresh_task = self._loop.create_task(self._refresh_loop())
+
+    async def stop_background_refresh(self):
+        """Stops the background refresh, if running"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+async def select_server(loop, mode=Mode.ffa, ignore_empty_servers=True, url=SERVERS_URL):
     """Picks a server given argument restrictions and returns a tuple (address, port)"""
-    server_list = await _fetch_servers_json(loop)
-    for server_sub_list in server_list:
-        for server in server_sub_list:
-            if not server["version"] == CLIENT_VERSION:
-                raise Exception("Unsupported server version: " + server["version"])
-            if not server["mode"] == mode.value:
-                continue
-            if ignore_empty_servers and not server["players"] > 0:
-                continue
-            return tuple(server["address"].split(":"))
+    directory = ServerDirectory(loop, url=url)
+    return (await directory.place(mode, 1, ignore_empty_servers))[0]
+
+async def place_instances(loop, address, port, instance_count, url=SERVERS_URL):
+    """
+    Returns a tuple (list of (address, port) per instance, ServerDirectory)
+
+    If address and port are not given, the instances are spread across the servers listed
+    at url and the directory used to place them is returned. Otherwise, the directory is None.
+    """
+    if address and port:
+        return [(address, port)] * instance_count, None
+    _logger.info("No address and port combination specified. Finding servers...")
+    directory = ServerDirectory(loop, url=url)
+    return await directory.place(Mode.ffa, instance_count), directory
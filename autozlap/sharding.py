@@ -0,0 +1,278 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs Session instances across multiple worker processes.
+
+Each worker has its own event loop and set of Sessions, and periodically sends its stats
+to the parent process, which prints them aggregated.
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os.path
+import queue
+import signal
+import time
+
+from . import fleet, game_client, instrumentation, server_selector, transport
+
+DEFAULT_STATS_INTERVAL = 5.0 # seconds
+_STOP_POLL_INTERVAL = 0.2 # seconds
+_WORKER_JOIN_TIMEOUT = 5.0 # seconds
+
+_logger = logging.getLogger(__name__)
+
+def split_instances(instance_count, worker_count):
+    """Returns a list of instance counts per worker, omitting workers with no instances"""
+    base, remainder = divmod(instance_count, worker_count)
+    counts = [base + 1] * remainder + [base] * (worker_count - remainder)
+    return [count for count in counts if count > 0]
+
+class WorkerStats:
+    """Samples the stats of the Sessions in a worker"""
+    def __init__(self, worker_index, sessions, tasks):
+        self._worker_index = worker_index
+        self._sessions = sessions
+        self._tasks = tasks
+        self._last_time = time.monotonic()
+        self._last_totals = self._totals()
+
+    def _totals(self):
+        totals = dict(packets_received=0, bytes_received=0, packets_sent=0, bytes_sent=0,
+                      parse_seconds=0.0, handler_seconds=0.0, frames_coalesced=0, reconnects=0,
+                      downtime_seconds=0.0)
+        for session in self._sessions:
+            for key, value in session.stats.as_dict().items():
+                totals[key] += value
+            totals["reconnects"] += session.reconnects
+            totals["downtime_seconds"] += session.downtime_seconds
+        return totals
+
+    def sample(self, final=False):
+        """Returns a dict of the stats since the previous sample"""
+        now = time.monotonic()
+        totals = self._totals()
+        elapsed = max(now - self._last_time, 1e-9)
+        interval_packets = totals["packets_received"] - self._last_totals["packets_received"]
+        interval_bytes = totals["bytes_received"] - self._last_totals["bytes_received"]
+        interval_parse = totals["parse_seconds"] - self._last_totals["parse_seconds"]
+        interval_handler = totals["handler_seconds"] - self._last_totals["handler_seconds"]
+        self._last_time = now
+        self._last_totals = totals
+        report = dict(
+            worker=self._worker_index,
+            final=final,
+            instances=len(self._sessions),
+            alive=sum(1 for task in self._tasks if not task.done()),
+            interval_seconds=elapsed,
+            interval_packets=interval_packets,
+            interval_parse_seconds=interval_parse,
+            interval_handler_seconds=interval_handler,
+            packets_per_second=interval_packets / elapsed,
+            bytes_per_second=interval_bytes / elapsed
+        )
+        report.update(totals)
+        return report
+
+def _worker_metrics_options(metrics_options, worker_index):
+    options = dict(metrics_options)
+    if options.get("port") is not None:
+        options["port"] += worker_index
+    if options.get("json_path") is not None:
+        root, extension = os.path.splitext(options["json_path"])
+        options["json_path"] = "{}-worker{}{}".format(root, worker_index, extension)
+    return options
+
+async def _report_until_stopped(loop, worker_index, stats_queue, stop_event, stats_interval,
+                                sessions, tasks):
+    """Reports the stats of sessions until stop_event is set. Returns the WorkerStats"""
+    stats = WorkerStats(worker_index, sessions, tasks)
+    next_report = loop.time() + stats_interval
+    while not stop_event.is_set() and not all(task.done() for task in tasks):
+        await asyncio.sleep(_STOP_POLL_INTERVAL)
+        if loop.time() >= next_report:
+            stats_queue.put(stats.sample())
+            next_report += stats_interval
+    return stats
+
+async def _worker_routine(loop, worker_index, placements, arena_class, stats_queue, stop_event,
+                          stats_interval, transport_options, reconnect_policy, directory_url,
+                          capture_directory, metrics_options, policy_options, receive_queue):
+    transport.get_shared(loop, **transport_options)
+    directory = None
+    if directory_url is not None:
+        directory = server_selector.ServerDirectory(loop, url=directory_url)
+        # The parent placed this worker's instances, so they are released on repicks
+        directory.count_placed(placements)
+    metrics_options = dict(_worker_metrics_options(metrics_options, worker_index),
+                           labels=(("worker", worker_index),))
+    monitor = functools.partial(_report_until_stopped, loop, worker_index, stats_queue,
+                                stop_event, stats_interval)
+    try:
+        stats = await fleet.run_sessions(loop, placements, arena_class, directory,
+                                         reconnect_policy, capture_directory, metrics_options,
+                                         policy_options, receive_queue=receive_queue,
+                                         monitor=monitor)
+    finally:
+        await transport.close_shared(loop)
+    stats_queue.put(stats.sample(final=True))
+
+def _worker_main(worker_index, placements, arena_class, stats_queue, stop_event, stats_interval,
+                 transport_options, reconnect_policy, directory_url, capture_directory, log_level,
+                 metrics_options, policy_options, receive_queue):
+    """Entry-point of a worker process"""
+    if log_level is not None:
+        instrumentation.configure_logging(log_level)
+    # The parent process handles SIGINT and tells workers to stop via stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_worker_routine(
+            loop, worker_index, placements, arena_class, stats_queue, stop_event, stats_interval,
+            transport_options, reconnect_policy, directory_url, capture_directory,
+            metrics_options, policy_options, receive_queue))
+    finally:
+        loop.close()
+
+def aggregate(reports):
+    """Returns a dict of stats aggregated from the latest report of each worker"""
+    interval_packets = sum(report["interval_packets"] for report in reports)
+    interval_parse_seconds = sum(report["interval_parse_seconds"] for report in reports)
+    interval_handler_seconds = sum(report["interval_handler_seconds"] for report in reports)
+    return dict(
+        workers=len(reports),
+        instances=sum(report["instances"] for report in reports),
+        alive=sum(report["alive"] for report in reports),
+        packets_per_second=sum(report["packets_per_second"] for report in reports),
+        bytes_per_second=sum(report["bytes_per_second"] for report in reports),
+        parse_us_per_packet=(interval_parse_seconds / interval_packets * 1e6
+                             if interval_packets else 0.0),
+        handler_us_per_packet=(interval_handler_seconds / interval_packets * 1e6
+                               if interval_packets else 0.0),
+        packets_received=sum(report["packets_received"] for report in reports),
+        frames_coalesced=sum(report["frames_coalesced"] for report in reports),
+        reconnects=sum(report["reconnects"] for report in reports),
+        downtime_seconds=sum(report["downtime_seconds"] for report in reports)
+    )
+
+_STATS_FORMAT = ("{alive}/{instances} alive, {packets_per_second:.1f} packets/s, "
+                 "{parse_us_per_packet:.1f}us parse/packet, "
+                 "{handler_us_per_packet:.1f}us handler/packet, {reconnects} reconnects, "
+                 "{downtime_seconds:.1f}s downtime")
+
+def _print_stats(reports):
+    for report in reports:
+        print("worker {}: {}".format(report["worker"], _STATS_FORMAT.format(**aggregate([report]))))
+    print("total: " + _STATS_FORMAT.format(**aggregate(reports)))
+
+def _place_instances(address, port, instance_count, servers_url):
+    loop = asyncio.new_event_loop()
+    try:
+        placements, _ = loop.run_until_complete(
+            server_selector.place_instances(loop, address, port, instance_count, servers_url))
+        return placements
+    finally:
+        loop.run_until_complete(transport.close_shared(loop))
+        loop.close()
+
+def run_sharded(address, port, instance_count, worker_count, arena_class=game_client.Arena,
+                stats_interval=DEFAULT_STATS_INTERVAL, transport_options=None,
+                reconnect_policy=None, capture_directory=None, log_level=None,
+                metrics_options=None, policy_options=None,
+                servers_url=server_selector.SERVERS_URL, receive_queue=0):
+    """
+    Runs instance_count Sessions split across worker_count processes until they all finish
+    or SIGINT is received. Each worker creates its own transport.Transport with
+    transport_options, and runs its Sessions with reconnect_policy. If capture_directory is
+    given, each Session records its received frames to a capture file in it. Workers log at
+    log_level, and export metrics with metrics_options as in instrumentation.start_exporters(),
+    except that worker N serves on port + N and writes to its own JSON file. If given,
+    policy_options are passed to policy.attach_policies() in each worker. Without address
+    and port, instances are placed on the servers listed at servers_url. receive_queue is
+    passed to each game_client.Session.
+
+    Returns the aggregated stats of the final worker reports.
+    """
+    placements = _place_instances(address, port, instance_count, servers_url)
+    directory_url = None
+    if reconnect_policy and reconnect_policy.repick_server and not (address and port):
+        directory_url = servers_url
+    context = multiprocessing.get_context()
+    stop_event = context.Event()
+    stats_queue = context.Queue()
+    workers = list()
+    for worker_index, worker_instances in enumerate(split_instances(instance_count,
+                                                                    worker_count)):
+        worker_placements = placements[:worker_instances]
+        del placements[:worker_instances]
+        print("worker {}: {}".format(worker_index, ", ".join(
+            server_address + ":" + str(server_port)
+            for server_address, server_port in sorted(set(worker_placements)))))
+        workers.append(context.Process(
+            target=_worker_main,
+            name="autozlap-worker-{}".format(worker_index),
+            args=(worker_index, worker_placements, arena_class, stats_queue, stop_event,
+                  stats_interval, transport_options or dict(), reconnect_policy, directory_url,
+                  capture_directory, log_level, metrics_options or dict(), policy_options,
+                  receive_queue)
+        ))
+    previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    latest_reports = dict() # worker index -> latest report
+    try:
+        for worker in workers:
+            worker.start()
+        next_print = time.monotonic() + stats_interval
+        finished_workers = set()
+        while len(finished_workers) < len(workers):
+            try:
+                report = stats_queue.get(timeout=_STOP_POLL_INTERVAL)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+            else:
+                latest_reports[report["worker"]] = report
+                if report["final"]:
+                    finished_workers.add(report["worker"])
+            if time.monotonic() >= next_print and latest_reports:
+                _print_stats(list(latest_reports.values()))
+                next_print += stats_interval
+    finally:
+        stop_event.set()
+        # Keep draining the queue, since workers cannot exit until their reports are flushed
+        deadline = time.monotonic() + _WORKER_JOIN_TIMEOUT
+        while any(worker.is_alive() for worker in workers) and time.monotonic() < deadline:
+            try:
+                report = stats_queue.get(timeout=_STOP_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            latest_reports[report["worker"]] = report
+        for worker in workers:
+            if worker.is_alive():
+                print("Terminating unresponsive worker", worker.name)
+                worker.terminate()
+            worker.join()
+        signal.signal(signal.SIGINT, previous_handler)
+    if latest_reports:
+        _print_stats(list(latest_reports.values()))
+    return aggregate(list(latest_reports.values()))
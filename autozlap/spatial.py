@@ -0,0 +1,213 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Spatial indexing of players and maces for range and nearest-neighbour queries.
+
+The grid is hashed, so positions outside of the arena dimensions are still indexed correctly;
+the dimensions only determine the cell size.
+"""
+
+import heapq
+import math
+
+DEFAULT_CELLS_PER_SIDE = 32
+
+class GridIndex:
+    """A uniform grid of square cells over points identified by id"""
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self._cells = dict() # (cell x, cell y) -> set of ids
+        self._points = dict() # id -> (x, y, cell)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, point_id):
+        return point_id in self._points
+
+    def _cell_of(self, x, y): #pylint: disable=invalid-name
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def update(self, point_id, x, y): #pylint: disable=invalid-name
+        """Inserts or moves a point"""
+        cell = self._cell_of(x, y)
+        old_point = self._points.get(point_id)
+        if old_point is not None and old_point[2] != cell:
+            old_cell_ids = self._cells[old_point[2]]
+            old_cell_ids.discard(point_id)
+            if not old_cell_ids:
+                del self._cells[old_point[2]]
+            old_point = None
+        if old_point is None:
+            self._cells.setdefault(cell, set()).add(point_id)
+        self._points[point_id] = (x, y, cell)
+
+    def remove(self, point_id):
+        """Removes a point if it exists"""
+        point = self._points.pop(point_id, None)
+        if point is None:
+            return
+        cell_ids = self._cells[point[2]]
+        cell_ids.discard(point_id)
+        if not cell_ids:
+            del self._cells[point[2]]
+
+    def resize(self, cell_size):
+        """Changes the cell size and re-buckets every point"""
+        points = self._points
+        self.cell_size = cell_size
+        self._cells = dict()
+        self._points = dict()
+        for point_id, (x, y, _) in points.items(): #pylint: disable=invalid-name
+            self.update(point_id, x, y)
+
+    def position(self, point_id):
+        """Returns the indexed (x, y) of a point"""
+        point = self._points[point_id]
+        return point[0], point[1]
+
+    def within(self, x, y, radius, exclude=None): #pylint: disable=invalid-name
+        """Returns a list of (distance, id) within radius of (x, y), sorted by distance"""
+        min_x, min_y = self._cell_of(x - radius, y - radius)
+        max_x, max_y = self._cell_of(x + radius, y + radius)
+        radius_squared = radius * radius
+        results = list()
+        cells = self._cells
+        points = self._points
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(cells):
+            # The query covers more cells than are occupied
+            candidate_cells = [cell for cell in cells
+                               if min_x <= cell[0] <= max_x and min_y <= cell[1] <= max_y]
+        else:
+            candidate_cells = [(cell_x, cell_y) for cell_x in range(min_x, max_x + 1)
+                               for cell_y in range(min_y, max_y + 1) if (cell_x, cell_y) in cells]
+        for cell in candidate_cells:
+            for point_id in cells[cell]:
+                point_x, point_y, _ = points[point_id]
+                distance_squared = (point_x - x) ** 2 + (point_y - y) ** 2
+                if distance_squared <= radius_squared and point_id != exclude:
+                    results.append((math.sqrt(distance_squared), point_id))
+        results.sort()
+        return results
+
+    def nearest(self, x, y, k=1, exclude=None): #pylint: disable=invalid-name
+        """Returns a list of up to k (distance, id) nearest to (x, y), sorted by distance"""
+        if not self._points or k <= 0:
+            return list()
+        center_x, center_y = self._cell_of(x, y)
+        cells = self._cells
+        points = self._points
+        candidates = list() # Max-heap of (-distance squared, id) of the best k so far
+        ring = 0
+        visited_cells = 0
+        while visited_cells < len(cells):
+            if ring == 0:
+                ring_cells = [(center_x, center_y)]
+            else:
+                ring_cells = [(center_x + offset, center_y + side)
+                              for offset in range(-ring, ring + 1) for side in (-ring, ring)]
+                ring_cells.extend((center_x + side, center_y + offset)
+                                  for offset in range(-ring + 1, ring) for side in (-ring, ring))
+            for cell in ring_cells:
+                cell_ids = cells.get(cell)
+                if cell_ids is None:
+                    continue
+                visited_cells += 1
+                for point_id in cell_ids:
+                    if point_id == exclude:
+                        continue
+                    point_x, point_y, _ = points[point_id]
+                    distance_squared = (point_x - x) ** 2 + (point_y - y) ** 2
+                    if len(candidates) < k:
+                        heapq.heappush(candidates, (-distance_squared, point_id))
+                    elif -candidates[0][0] > distance_squared:
+                        heapq.heapreplace(candidates, (-distance_squared, point_id))
+            # Every unvisited cell is at least this far away from (x, y)
+            ring_distance = ring * self.cell_size
+            if len(candidates) == k and -candidates[0][0] <= ring_distance * ring_distance:
+                break
+            ring += 1
+        return sorted((math.sqrt(-distance_squared), point_id)
+                      for distance_squared, point_id in candidates)
+
+class ArenaIndex:
+    """
+    Spatial indices of player and mace positions in an Arena
+
+    Maintained by game_client.Arena once enabled with Arena.enable_spatial_index()
+    """
+    def __init__(self, dimensions=None, cells_per_side=DEFAULT_CELLS_PER_SIDE):
+        self.cells_per_side = cells_per_side
+        cell_size = self._cell_size(dimensions)
+        self.players = GridIndex(cell_size)
+        self.maces = GridIndex(cell_size)
+
+    def _cell_size(self, dimensions):
+        if dimensions is None:
+            return 1.0
+        return max(dimensions.x, dimensions.y, 1.0) / self.cells_per_side
+
+    def resize(self, dimensions):
+        """Resizes the cells for new arena dimensions"""
+        cell_size = self._cell_size(dimensions)
+        self.players.resize(cell_size)
+        self.maces.resize(cell_size)
+
+    def update(self, player_id, position, mace_position):
+        """Updates the positions of a player and its mace, given as (x, y) tuples"""
+        self.players.update(player_id, position[0], position[1])
+        self.maces.update(player_id, mace_position[0], mace_position[1])
+
+    def remove(self, player_id):
+        """Removes a player and its mace"""
+        self.players.remove(player_id)
+        self.maces.remove(player_id)
+
+    def apply_sync(self, sync_payload):
+        """Updates positions from a sync packet payload of any decoder"""
+        if "records" in sync_payload:
+            records = sync_payload.records
+            for player_id, position, mace_position in zip(records["player_id"].tolist(),
+                                                          records["position"].tolist(),
+                                                          records["mace_position"].tolist()):
+                self.update(player_id, position, mace_position)
+        else:
+            for sync_struct in sync_payload.sync_array:
+                position = sync_struct.player_state.position
+                mace_position = sync_struct.mace_state.position
+                self.update(sync_struct.player_id, (position.x, position.y),
+                            (mace_position.x, mace_position.y))
+
+    def players_within(self, x, y, radius, exclude=None): #pylint: disable=invalid-name
+        """Returns a list of (distance, player id) of players within radius of (x, y)"""
+        return self.players.within(x, y, radius, exclude)
+
+    def maces_within(self, x, y, radius, exclude=None): #pylint: disable=invalid-name
+        """Returns a list of (distance, player id) of maces within radius of (x, y)"""
+        return self.maces.within(x, y, radius, exclude)
+
+    def nearest_players(self, x, y, k=1, exclude=None): #pylint: disable=invalid-name
+        """Returns a list of (distance, player id) of the k players nearest to (x, y)"""
+        return self.players.nearest(x, y, k, exclude)
+
+    def nearest_maces(self, x, y, k=1, exclude=None): #pylint: disable=invalid-name
+        """Returns a list of (distance, player id) of the k maces nearest to (x, y)"""
+        return self.maces.nearest(x, y, k, exclude)
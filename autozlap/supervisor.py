@@ -0,0 +1,239 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fleet view of all the Sessions of a process.
+
+A Supervisor samples the counters of every Session at a fixed interval, and computes rates
+and latency percentiles over a rolling window of samples. Nothing is added to the packet
+handling path: latencies come from differences of the ConnectionStats histograms.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import sys
+import time
+
+from .instrumentation import LATENCY_BUCKETS, percentile
+
+DEFAULT_INTERVAL = 2.0 # seconds
+DEFAULT_WINDOW = 10 # samples
+OVERHEAD_BUDGET = 0.01 # Maximum fraction of the interval spent sampling and reporting
+TERMINAL_ROWS = 20 # Sessions listed in the terminal summary
+
+_logger = logging.getLogger(__name__)
+
+_Sample = collections.namedtuple("_Sample", (
+    "time", "packets", "bytes", "parse_counts", "handler_counts"))
+
+def _sample_session(session, now):
+    stats = session.stats
+    return _Sample(now, stats.packets_received, stats.bytes_received,
+                   list(stats.parse_latency.counts), list(stats.handler_latency.counts))
+
+def _difference(newer, older):
+    return [new_count - old_count for new_count, old_count in zip(newer, older)]
+
+def _microseconds(seconds):
+    return seconds * 1e6 if seconds is not None else None
+
+def _window_metrics(oldest, latest):
+    """Returns a dict of the rates and latency percentiles between two samples"""
+    elapsed = latest.time - oldest.time
+    parse_counts = _difference(latest.parse_counts, oldest.parse_counts)
+    handler_counts = _difference(latest.handler_counts, oldest.handler_counts)
+    return dict(
+        packets_per_second=(latest.packets - oldest.packets) / elapsed if elapsed else 0.0,
+        bytes_per_second=(latest.bytes - oldest.bytes) / elapsed if elapsed else 0.0,
+        parse_us_p50=_microseconds(percentile(LATENCY_BUCKETS, parse_counts, 0.5)),
+        parse_us_p99=_microseconds(percentile(LATENCY_BUCKETS, parse_counts, 0.99)),
+        handler_us_p50=_microseconds(percentile(LATENCY_BUCKETS, handler_counts, 0.5)),
+        handler_us_p99=_microseconds(percentile(LATENCY_BUCKETS, handler_counts, 0.99))
+    ), parse_counts, handler_counts
+
+def _format_us(value):
+    return "{:8.1f}".format(value) if value is not None else "       -"
+
+class Supervisor:
+    """
+    Samples sessions every interval seconds and reports the fleet
+
+    The report is printed to stream as a terminal summary if stream is given, and written
+    as JSON to json_path, replacing it atomically, if json_path is given. Rates and
+    percentiles cover the last window samples. The time spent sampling and reporting is
+    measured, and a warning is logged if it exceeds OVERHEAD_BUDGET of the interval.
+    """
+    def __init__(self, loop, sessions, interval=DEFAULT_INTERVAL, window=DEFAULT_WINDOW,
+                 json_path=None, stream=None):
+        self._loop = loop
+        self._sessions = sessions
+        self.interval = interval
+        self.json_path = json_path
+        self.stream = stream
+        self._samples = [collections.deque(maxlen=window + 1) for _ in sessions]
+        self._costs = collections.deque(maxlen=window) # seconds per report
+        self._over_budget = False
+        self._task = None
+
+    def sample(self):
+        """Takes a sample of every session now"""
+        now = self._loop.time()
+        for session, samples in zip(self._sessions, self._samples):
+            samples.append(_sample_session(session, now))
+
+    def snapshot(self):
+        """Returns the fleet report as a JSON-serializable dict"""
+        sessions = list()
+        all_parse_counts = list()
+        all_handler_counts = list()
+        for index, (session, samples) in enumerate(zip(self._sessions, self._samples)):
+            if not samples:
+                continue
+            metrics, parse_counts, handler_counts = _window_metrics(samples[0], samples[-1])
+            all_parse_counts.append(parse_counts)
+            all_handler_counts.append(handler_counts)
+            metrics.update(
+                instance=index,
+                alive=session.in_game,
+                players=len(session.arena.players),
+                kills=session.kills,
+                deaths=session.deaths,
+                reconnects=session.reconnects
+            )
+            sessions.append(metrics)
+        window_seconds = (self._samples[0][-1].time - self._samples[0][0].time
+                          if self._samples and self._samples[0] else 0.0)
+        cost = sum(self._costs) / len(self._costs) if self._costs else 0.0
+        fleet_parse = [sum(counts) for counts in zip(*all_parse_counts)]
+        fleet_handler = [sum(counts) for counts in zip(*all_handler_counts)]
+        return dict(
+            time=time.time(),
+            window_seconds=window_seconds,
+            fleet=dict(
+                instances=len(sessions),
+                alive=sum(1 for metrics in sessions if metrics["alive"]),
+                packets_per_second=sum(metrics["packets_per_second"] for metrics in sessions),
+                bytes_per_second=sum(metrics["bytes_per_second"] for metrics in sessions),
+                parse_us_p50=_microseconds(percentile(LATENCY_BUCKETS, fleet_parse, 0.5)),
+                parse_us_p99=_microseconds(percentile(LATENCY_BUCKETS, fleet_parse, 0.99)),
+                handler_us_p50=_microseconds(percentile(LATENCY_BUCKETS, fleet_handler, 0.5)),
+                handler_us_p99=_microseconds(percentile(LATENCY_BUCKETS, fleet_handler, 0.99)),
+                players=sum(metrics["players"] for metrics in sessions),
+                kills=sum(metrics["kills"] for metrics in sessions),
+                deaths=sum(metrics["deaths"] for metrics in sessions),
+                reconnects=sum(metrics["reconnects"] for metrics in sessions)
+            ),
+            overhead=dict(seconds_per_report=cost, fraction=cost / self.interval,
+                          budget=OVERHEAD_BUDGET),
+            sessions=sessions
+        )
+
+    @staticmethod
+    def render(snapshot):
+        """Returns a terminal summary of a snapshot"""
+        fleet = snapshot["fleet"]
+        lines = [
+            "{alive}/{instances} alive, {packets_per_second:.1f} packets/s, "
+            "{kills} kills, {deaths} deaths, {reconnects} reconnects over "
+            "{window:.0f}s".format(window=snapshot["window_seconds"], **fleet),
+            "parse p50/p99 {}/{}us, handler p50/p99 {}/{}us, overhead {:.2%}".format(
+                _format_us(fleet["parse_us_p50"]).strip(),
+                _format_us(fleet["parse_us_p99"]).strip(),
+                _format_us(fleet["handler_us_p50"]).strip(),
+                _format_us(fleet["handler_us_p99"]).strip(),
+                snapshot["overhead"]["fraction"]),
+            "{:>8} {:>5} {:>9} {:>8} {:>8} {:>8} {:>8} {:>7} {:>6} {:>6}".format(
+                "instance", "alive", "packets/s", "parse50", "parse99", "hand50", "hand99",
+                "players", "kills", "deaths")
+        ]
+        # The slowest sessions first
+        sessions = sorted(snapshot["sessions"],
+                          key=lambda metrics: -(metrics["handler_us_p99"] or 0.0))
+        for metrics in sessions[:TERMINAL_ROWS]:
+            lines.append("{:>8} {:>5} {:>9.1f} {} {} {} {} {:>7} {:>6} {:>6}".format(
+                metrics["instance"], "yes" if metrics["alive"] else "no",
+                metrics["packets_per_second"], _format_us(metrics["parse_us_p50"]),
+                _format_us(metrics["parse_us_p99"]), _format_us(metrics["handler_us_p50"]),
+                _format_us(metrics["handler_us_p99"]), metrics["players"], metrics["kills"],
+                metrics["deaths"]))
+        if len(sessions) > TERMINAL_ROWS:
+            lines.append("... {} more".format(len(sessions) - TERMINAL_ROWS))
+        return "\n".join(lines)
+
+    def _dump(self, snapshot):
+        temporary_path = "{}.{}.tmp".format(self.json_path, os.getpid())
+        with open(temporary_path, "w", encoding="utf-8") as snapshot_file:
+            # json.dumps() uses the C encoder, unlike json.dump()
+            snapshot_file.write(json.dumps(snapshot))
+        os.replace(temporary_path, self.json_path)
+
+    def report(self):
+        """Samples the sessions, then prints and writes the report"""
+        start = time.perf_counter()
+        self.sample()
+        snapshot = self.snapshot()
+        if self.stream is not None:
+            if self.stream.isatty():
+                self.stream.write("\x1b[H\x1b[2J") # Redraw in place
+            print(self.render(snapshot), file=self.stream, flush=True)
+        if self.json_path is not None:
+            self._dump(snapshot)
+        self._costs.append(time.perf_counter() - start)
+        over_budget = self._costs[-1] > OVERHEAD_BUDGET * self.interval
+        if over_budget and not self._over_budget:
+            _logger.warning("Supervisor report took %.1fms, over its budget of %.1fms",
+                            self._costs[-1] * 1e3, OVERHEAD_BUDGET * self.interval * 1e3)
+        self._over_budget = over_budget
+        return snapshot
+
+    async def _report_loop(self):
+        self.sample()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    def start(self):
+        """Starts reporting every interval seconds"""
+        if self._task is None:
+            self._task = self._loop.create_task(self._report_loop())
+
+    async def stop(self):
+        """Stops reporting, and writes the final report"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.report()
+
+def create_supervisor(loop, sessions, terminal=False, json_path=None,
+                      interval=DEFAULT_INTERVAL, window=DEFAULT_WINDOW):
+    """Returns a started Supervisor printing to stdout if terminal, or None if not needed"""
+    if not terminal and json_path is None:
+        return None
+    supervisor = Supervisor(loop, sessions, interval, window, json_path,
+                            sys.stdout if terminal else None)
+    supervisor.start()
+    return supervisor
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Batched decoding of sync packets into NumPy structured arrays.
+
+Apart from the attributes of new players, every sync_array entry is a fixed 40-byte record.
+These are read with numpy.frombuffer; only new-player entries take the per-record path.
+Requires NumPy.
+"""
+
+import struct
+
+import numpy
+
+from .decoder import InboundDecoder, Record, _physical_state
+
+# Wire layout of a sync_array entry for a known player.
+# "state" overlaps the other float fields, so it can be written into a columnar.PlayerStore.
+SYNC_RECORD_DTYPE = numpy.dtype({
+    "names": ["player_id", "position", "velocity", "mace_position", "mace_velocity",
+              "mace_radius", "state"],
+    "formats": ["<u4", ("<f4", (2,)), ("<f4", (2,)), ("<f4", (2,)), ("<f4", (2,)), "<f4",
+                ("<f4", (9,))],
+    "offsets": [0, 4, 12, 20, 28, 36, 4],
+    "itemsize": 40
+})
+
+_UINT32 = struct.Struct("<I")
+_STATE = numpy.dtype(("<f4", (9,)))
+_STATE_SIZE = _STATE.itemsize
+
+class ArraySyncDecoder(InboundDecoder):
+    """
+    An InboundDecoder that decodes sync payloads into structured arrays
+
+    The sync payload has these fields instead of sync_array:
+    * records: an array of SYNC_RECORD_DTYPE with an entry for every player, in packet order.
+      When the packet has no new players, it is a read-only view of the packet data.
+    * new_players: a list of Records for new players, as produced by InboundDecoder.
+    """
+
+    def _decode_sync(self, data, offset):
+        timestamp, removal_array, sync_count, offset = self._decode_sync_header(data, offset)
+        end = offset + sync_count * SYNC_RECORD_DTYPE.itemsize
+        if end == len(data):
+            # New-player entries carry at least 5 extra bytes, so there are none
+            records = numpy.frombuffer(data, dtype=SYNC_RECORD_DTYPE, count=sync_count,
+                                       offset=offset)
+            new_players = list()
+        else:
+            records, new_players, end = self._decode_mixed_records(data, offset, sync_count)
+        return Record(
+            timestamp=timestamp,
+            remove_count=len(removal_array),
+            removal_array=removal_array,
+            sync_count=sync_count,
+            records=records,
+            new_players=new_players
+        ), end
+
+    def _decode_mixed_records(self, data, offset, sync_count):
+        """Decodes entries when some may belong to new players"""
+        records = numpy.empty(sync_count, dtype=SYNC_RECORD_DTYPE)
+        new_players = list()
+        run_start = offset # Start of the current run of fixed-size records
+        run_index = 0
+        known_ids = self._context.known_ids
+        for index in range(sync_count):
+            player_id, = _UINT32.unpack_from(data, offset)
+            if player_id in known_ids:
+                offset += SYNC_RECORD_DTYPE.itemsize
+                continue
+            if index > run_index:
+                records[run_index:index] = numpy.frombuffer(
+                    data, dtype=SYNC_RECORD_DTYPE, count=index - run_index, offset=run_start)
+            player_attributes, offset = self._decode_player_attributes(data, offset + 4,
+                                                                       player_id)
+            state = numpy.frombuffer(data, dtype=_STATE, count=1, offset=offset)[0]
+            offset += _STATE_SIZE
+            records["player_id"][index] = player_id
+            records["state"][index] = state
+            values = state.tolist()
+            new_players.append(Record(
+                player_id=player_id,
+                is_new_player=True,
+                player_attributes=player_attributes,
+                player_state=_physical_state(*values[0:4]),
+                mace_state=_physical_state(*values[4:8]),
+                mace_radius=values[8]
+            ))
+            run_start = offset
+            run_index = index + 1
+        if sync_count > run_index:
+            records[run_index:] = numpy.frombuffer(
+                data, dtype=SYNC_RECORD_DTYPE, count=sync_count - run_index, offset=run_start)
+        return records, new_players, offset
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+
+# autozlap: An experimental autonomous zlap.io client
+# Copyright (C) 2018  Eloston
+#
+# This file is part of autozlap.
+#
+# autozlap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autozlap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with autozlap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared HTTP and websocket transport.
+
+All Sessions and the server selector on an event loop borrow one aiohttp.ClientSession,
+so that connectors, DNS lookups and keepalive connections are pooled. Websocket handshakes
+are ramped up to avoid a thundering herd when many instances start at once.
+"""
+
+import asyncio
+
+DEFAULT_CONNECTION_LIMIT = 0 # No limit, since every websocket holds a connection
+DEFAULT_CONNECTION_LIMIT_PER_HOST = 0
+DEFAULT_DNS_CACHE_TTL = 300 # seconds
+DEFAULT_KEEPALIVE_TIMEOUT = 30 # seconds
+DEFAULT_MAX_HANDSHAKES = 16 # Concurrent websocket handshakes
+DEFAULT_HANDSHAKE_RATE = 50.0 # Websocket handshakes started per second
+
+_shared_transports = dict() # loop -> Transport
+
+class Transport:
+    """
+    Owns an aiohttp.ClientSession with a tuned connector
+
+    At most max_handshakes websocket handshakes run concurrently, and at most handshake_rate
+    are started per second (0 for no limit).
+    """
+    def __init__(self, loop, connection_limit=DEFAULT_CONNECTION_LIMIT,
+                 connection_limit_per_host=DEFAULT_CONNECTION_LIMIT_PER_HOST,
+                 dns_cache_ttl=DEFAULT_DNS_CACHE_TTL, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 max_handshakes=DEFAULT_MAX_HANDSHAKES, handshake_rate=DEFAULT_HANDSHAKE_RATE):
+        self._loop = loop
+        self._connector_options = dict(
+            limit=connection_limit,
+            limit_per_host=connection_limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_cache_ttl,
+            keepalive_timeout=keepalive_timeout
+        )
+        self._session = None
+        self._handshake_semaphore = asyncio.Semaphore(max_handshakes)
+        self._handshake_interval = 1.0 / handshake_rate if handshake_rate > 0 else 0.0
+        self._next_handshake_time = 0.0
+        self.handshakes = 0
+
+    @property
+    def session(self):
+        """The shared aiohttp.ClientSession, created on first use"""
+        if self._session is None or self._session.closed:
+            import aiohttp # Deferred, as it is slow to import
+            connector = aiohttp.TCPConnector(loop=self._loop, **self._connector_options)
+            self._session = aiohttp.ClientSession(loop=self._loop, connector=connector)
+        return self._session
+
+    async def _wait_for_handshake_slot(self):
+        now = self._loop.time()
+        start_time = max(now, self._next_handshake_time)
+        self._next_handshake_time = start_time + self._handshake_interval
+        if start_time > now:
+            await asyncio.sleep(start_time - now)
+
+    async def ws_connect(self, url, **kwargs):
+        """Opens a websocket, subject to the handshake ramp-up. Returns the websocket"""
+        async with self._handshake_semaphore:
+            await self._wait_for_handshake_slot()
+            websocket = await self.session.ws_connect(url, **kwargs)
+            self.handshakes += 1
+            return websocket
+
+    async def get_json(self, url):
+        """Performs a GET request and returns the decoded JSON body"""
+        async with self.session.get(url) as response:
+            return await response.json()
+
+    async def close(self):
+        """Closes the ClientSession and its connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+def get_shared(loop, **kwargs):
+    """
+    Returns the Transport shared by everything on loop, creating it if needed
+
+    kwargs are passed to Transport when it is created, and must be empty otherwise.
+    """
+    transport = _shared_transports.get(loop)
+    if transport is None:
+        transport = Transport(loop, **kwargs)
+        _shared_transports[loop] = transport
+    elif kwargs:
+        raise ValueError("The shared transport for this loop is already configured")
+    return transport
+
+async def close_shared(loop):
+    """Closes and forgets the Transport shared on loop, if any"""
+    transport = _shared_transports.pop(loop, None)
+    if transport is not None:
+        await transport.close()
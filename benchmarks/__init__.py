@@ -0,0 +1,3 @@
+# -*- coding: UTF-8 -*-
+
+"""Benchmarks for autozlap. Run from the repository root with `python3 -m benchmarks.<name>`"""
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Synthetic inbound frames for benchmarks.
+
+A Scenario is a list of priming frames that bring a Session into a known state, and a cycle of
+frames that can be replayed indefinitely from that state. Sync cycles with new players
+alternate between two sets of players that are removed and re-added, so the new-player
+checks see the same state on every pass.
+"""
+
+import collections
+import random
+
+from autozlap import packet_builder
+from autozlap.constants import Mode
+
+CURRENT_PLAYER_ID = 1
+DIMENSIONS = (10000, 10000)
+SYNC_PLAYER_COUNTS = (10, 100, 500)
+NEW_PLAYER_RATIO = 0.05
+_CHURN_ID_BASES = (100000, 200000) # ids of the two alternating sets of new players
+
+Scenario = collections.namedtuple("Scenario", ("name", "mode", "priming", "cycle"))
+
+def _random_state(rng):
+    return tuple(rng.uniform(-1000, 1000) for _ in range(9))
+
+def _attributes(player_id):
+    if player_id == CURRENT_PLAYER_ID:
+        return (None, 1.0, 0)
+    return ("player{}".format(player_id), 1.0, player_id % 256)
+
+def setup_frame(mode=Mode.ffa):
+    """Returns a setup frame for CURRENT_PLAYER_ID"""
+    return packet_builder.build_setup(CURRENT_PLAYER_ID, DIMENSIONS, DIMENSIONS, mode=mode)
+
+def sync_scenario(player_count, new_player_count, rng, mode=Mode.ffa):
+    """
+    Returns a Scenario of sync frames with player_count players, of which new_player_count
+    are new in every frame
+    """
+    known_ids = list(range(CURRENT_PLAYER_ID, CURRENT_PLAYER_ID + player_count
+                           - new_player_count))
+    churn_ids = [list(range(base, base + new_player_count)) for base in _CHURN_ID_BASES]
+    priming = [setup_frame(mode), packet_builder.build_sync(0, [], [
+        (player_id, _attributes(player_id), _random_state(rng))
+        for player_id in known_ids + churn_ids[0]])]
+    cycle = list()
+    for timestamp, (removed_ids, added_ids) in enumerate(
+            ((churn_ids[0], churn_ids[1]), (churn_ids[1], churn_ids[0])), 1):
+        entries = [(player_id, None, _random_state(rng)) for player_id in known_ids]
+        entries.extend((player_id, _attributes(player_id), _random_state(rng))
+                       for player_id in added_ids)
+        cycle.append(packet_builder.build_sync(timestamp, removed_ids, entries))
+    if not new_player_count:
+        del cycle[1:]
+    state = "new" if new_player_count else "known"
+    return Scenario("sync_{}_{}".format(player_count, state), mode, priming, cycle)
+
+def _other_state(rng):
+    return (rng.uniform(-1000, 1000), rng.uniform(-1000, 1000),
+            rng.uniform(-10, 10), rng.uniform(-10, 10))
+
+def scenarios(rng=None):
+    """Returns a list of Scenarios covering every benchmarked packet type"""
+    if rng is None:
+        rng = random.Random(0)
+    result = [Scenario("setup", Mode.ffa, [], [setup_frame()])]
+    for player_count in SYNC_PLAYER_COUNTS:
+        result.append(sync_scenario(player_count, 0, rng))
+        result.append(sync_scenario(player_count,
+                                    max(1, int(player_count * NEW_PLAYER_RATIO)), rng))
+    result.append(Scenario("club_collision", Mode.ffa, [setup_frame()], [
+        packet_builder.build_club_collision(1, (1.0, 2.0), 0.5, 2, _other_state(rng), 3,
+                                            _other_state(rng))]))
+    result.append(Scenario("set_leaderboard_ffa", Mode.ffa, [setup_frame()], [
+        packet_builder.build_set_leaderboard_ffa(
+            50, 60, 1, [("player{}".format(place), 100 - place) for place in range(10)],
+            ("king", 200), 12, 40)]))
+    result.append(Scenario("set_leaderboard_tdm", Mode.tdm, [setup_frame(Mode.tdm)], [
+        packet_builder.build_set_leaderboard_tdm(
+            50, 60, [(team, team * 10, 100 - team) for team in range(3)])]))
+    return result
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Measures history.ArenaHistory recording and lookups, and its memory use compared to
+storing a full snapshot per tick.
+
+Usage: python3 -m benchmarks.history
+"""
+
+import timeit
+
+import numpy
+
+from autozlap.columnar import STATE_WIDTH
+from autozlap.history import ArenaHistory
+
+PLAYER_COUNTS = (100, 500)
+IDLE_FRACTIONS = (0.0, 0.5, 0.9) # Fraction of players whose state does not change
+CAPACITY = 256
+TICK_MILLISECONDS = 50
+
+def _fill(history, player_count, idle_fraction, rng):
+    ids = numpy.arange(1, player_count + 1)
+    rows = rng.uniform(0, 1000, (player_count, STATE_WIDTH)).astype(numpy.float32)
+    moving = rng.random_sample(player_count) >= idle_fraction
+    for tick in range(CAPACITY):
+        rows[moving, :2] += 1.0
+        history.record(tick * TICK_MILLISECONDS, ids, rows)
+    return ids, rows, moving
+
+def _time(function):
+    """Returns microseconds per call"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+def main():
+    """Entry-point"""
+    rng = numpy.random.RandomState(0)
+    print("{:>8} {:>6} {:>12} {:>12} {:>12} {:>10} {:>10}".format(
+        "players", "idle", "record", "state_at", "trajectory", "KiB", "full KiB"))
+    for player_count in PLAYER_COUNTS:
+        for idle_fraction in IDLE_FRACTIONS:
+            history = ArenaHistory(CAPACITY)
+            ids, rows, moving = _fill(history, player_count, idle_fraction, rng)
+            stored_bytes = history.nbytes
+            full_bytes = CAPACITY * player_count * (rows.itemsize * STATE_WIDTH + 4)
+            middle = (history.first_tick + history.last_tick) // 2
+            state_at_us = _time(lambda: history.state_at(middle))
+            trajectory_us = _time(lambda: history.trajectory(player_count // 2, middle - 32,
+                                                             middle))
+            # Recording last, since it moves the stored window
+            record_us = _time(lambda: history.record(0, ids[moving], rows[moving]))
+            print("{:>8} {:>6.0%} {:>10.1f}us {:>10.1f}us {:>10.1f}us {:>10.1f} {:>10.1f}".format(
+                player_count, idle_fraction, record_us, state_at_us, trajectory_us,
+                stored_bytes / 1024, full_bytes / 1024))
+
+if __name__ == "__main__":
+    main()
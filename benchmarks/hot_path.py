@@ -0,0 +1,217 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmarks the inbound hot path: Connection parsing followed by
+Session._received_packet_handler, for every scenario in benchmarks.frames.
+
+Reports frames/s, microseconds per frame, tracemalloc allocation stats per frame and
+peak RSS. Results can be written as JSON and compared against a previous run to flag
+regressions.
+
+Usage: python3 -m benchmarks.hot_path [--json OUT] [--baseline PREVIOUS_OUT]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+from autozlap import game_client
+from autozlap.networking import Connection
+
+from .frames import scenarios
+
+REPORT_VERSION = 1
+DEFAULT_THRESHOLD = 0.15
+# Frames measured with tracemalloc per scenario, within a time budget
+MIN_ALLOCATION_SAMPLES = 5
+MAX_ALLOCATION_SAMPLES = 200
+ALLOCATION_BUDGET = 0.25 # seconds, not counting tracemalloc overhead
+# Metrics compared against the baseline, where larger is worse
+COMPARED_METRICS = ("us_per_frame", "alloc_peak_bytes_per_frame")
+
+def _variants():
+    """Returns a dict of variant name -> (fast_decoding, arena class)"""
+    variants = dict(construct=(False, game_client.Arena), struct=(True, game_client.Arena))
+    try:
+        from autozlap.columnar import ColumnarArena
+    except ImportError:
+        pass
+    else:
+        variants["numpy"] = (True, ColumnarArena)
+    return variants
+
+def _make_step(loop, scenario, fast_decoding, arena_class):
+    """Returns a function that processes the next frame of the scenario's cycle"""
+    session = game_client.Session(loop, scenario.mode, arena_class)
+    #pylint: disable=protected-access
+    connection = Connection(None, scenario.mode, session.arena.parsing_context,
+                            fast_decoding=fast_decoding,
+                            sync_arrays=session.arena.accepts_sync_arrays, stats=session.stats)
+    parse = connection._parse
+    handler = session._received_packet_handler
+    #pylint: enable=protected-access
+    for frame in scenario.priming:
+        handler(parse(frame))
+    frames = itertools.cycle(scenario.cycle)
+    def _step():
+        handler(parse(next(frames)))
+    # Warm up with one pass, which leaves the cycle at its start
+    for _ in scenario.cycle:
+        _step()
+    return _step, sum(len(frame) for frame in scenario.cycle) / len(scenario.cycle)
+
+def _time_step(step):
+    """Returns seconds per call"""
+    timer = timeit.Timer(step)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+def _measure_allocations(step, samples):
+    """
+    Returns a dict of per-frame tracemalloc stats averaged over samples frames:
+    the peak bytes allocated while processing a frame, and the bytes and blocks
+    still allocated afterwards.
+    """
+    peak_bytes = retained_bytes = retained_blocks = 0
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.clear_traces()
+            step()
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            peak_bytes += peak
+            retained_bytes += current
+            retained_blocks += len(snapshot.traces)
+    finally:
+        tracemalloc.stop()
+    return dict(
+        alloc_peak_bytes_per_frame=peak_bytes / samples,
+        retained_bytes_per_frame=retained_bytes / samples,
+        retained_blocks_per_frame=retained_blocks / samples
+    )
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process in KiB, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024 # Reported in bytes instead of KiB
+    return peak
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=str(Path(__file__).resolve().parent),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(variant_names=None, name_filter=None):
+    """Runs the benchmarks and returns the report as a JSON-serializable dict"""
+    variants = _variants()
+    if variant_names:
+        unknown = set(variant_names) - set(variants)
+        if unknown:
+            raise ValueError("Unknown or unavailable variants: " + ", ".join(sorted(unknown)))
+        variants = {name: variants[name] for name in variant_names}
+    results = dict()
+    loop = asyncio.new_event_loop()
+    try:
+        for scenario in scenarios():
+            for variant_name, (fast_decoding, arena_class) in variants.items():
+                key = "{}/{}".format(scenario.name, variant_name)
+                if name_filter and name_filter not in key:
+                    continue
+                step, frame_bytes = _make_step(loop, scenario, fast_decoding, arena_class)
+                seconds = _time_step(step)
+                result = _measure_allocations(step, max(
+                    MIN_ALLOCATION_SAMPLES,
+                    min(MAX_ALLOCATION_SAMPLES, int(ALLOCATION_BUDGET / seconds))))
+                result.update(
+                    frame_bytes=frame_bytes,
+                    frames_per_second=1.0 / seconds,
+                    us_per_frame=seconds * 1e6,
+                    peak_rss_kb=peak_rss_kb()
+                )
+                results[key] = result
+                print("{:<32} {:>12.0f} frames/s {:>10.2f}us {:>10.0f}B peak alloc".format(
+                    key, result["frames_per_second"], result["us_per_frame"],
+                    result["alloc_peak_bytes_per_frame"]))
+    finally:
+        loop.close()
+    return dict(
+        version=REPORT_VERSION,
+        created=time.time(),
+        commit=_git_commit(),
+        python=platform.python_implementation() + " " + platform.python_version(),
+        platform=platform.platform(),
+        peak_rss_kb=peak_rss_kb(),
+        results=results
+    )
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns a list of (key, metric, baseline value, value) for every metric in
+    COMPARED_METRICS that is more than threshold worse than in baseline
+    """
+    regressions = list()
+    for key, result in sorted(report["results"].items()):
+        baseline_result = baseline["results"].get(key)
+        if baseline_result is None:
+            continue
+        for metric in COMPARED_METRICS:
+            baseline_value = baseline_result.get(metric)
+            if baseline_value and result[metric] > baseline_value * (1.0 + threshold):
+                regressions.append((key, metric, baseline_value, result[metric]))
+    return regressions
+
+def main():
+    """Entry-point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--json", metavar="OUT", type=Path,
+                        help="Write the report as JSON to OUT")
+    parser.add_argument("--baseline", metavar="PREVIOUS_OUT", type=Path,
+                        help="Compare against a report written by --json")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative slowdown or allocation growth flagged as a regression "
+                        "(default: %(default)s)")
+    parser.add_argument("--variant", action="append", dest="variants",
+                        help="Only run this decoder variant (construct, struct or numpy). "
+                        "May be repeated")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this")
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with args.baseline.open(encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    report = run(args.variants, args.filter)
+    print("Peak RSS: {} KiB".format(report["peak_rss_kb"]))
+    if args.json:
+        with args.json.open("w", encoding="utf-8") as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(report, baseline, args.threshold)
+        for key, metric, baseline_value, value in regressions:
+            print("REGRESSION {} {}: {:.2f} -> {:.2f} ({:+.0%})".format(
+                key, metric, baseline_value, value, value / baseline_value - 1.0))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Compares spatial.ArenaIndex queries with a linear scan over Arena.players.
+
+Usage: python3 -m benchmarks.spatial_index
+"""
+
+import math
+import random
+import timeit
+
+from autozlap.decoder import Record
+from autozlap.game_client import Arena, Player, Vector
+
+PLAYER_COUNTS = (100, 1000, 5000)
+DIMENSIONS = Record(x=10000.0, y=10000.0)
+QUERY_RADIUS = 500.0
+QUERY_K = 5
+
+def _populate(player_count, rng):
+    arena = Arena()
+    arena.set_dimensions(DIMENSIONS, DIMENSIONS)
+    arena.enable_spatial_index()
+    for player_id in range(player_count):
+        position = (rng.uniform(0, DIMENSIONS.x), rng.uniform(0, DIMENSIONS.y))
+        mace_position = (position[0] + rng.uniform(-100, 100), position[1] + rng.uniform(-100, 100))
+        arena.players[player_id] = Player(
+            player_id, Vector(coordinates=position), Vector(coordinates=(0, 0)),
+            Vector(coordinates=mace_position), Vector(coordinates=(0, 0)))
+        arena.spatial_index.update(player_id, position, mace_position)
+    return arena
+
+def _linear_within(arena, x, y, radius): #pylint: disable=invalid-name
+    results = list()
+    for player in arena.players.values():
+        distance = math.hypot(player.position.x - x, player.position.y - y)
+        if distance <= radius:
+            results.append((distance, player.id))
+    results.sort()
+    return results
+
+def _linear_nearest(arena, x, y, k): #pylint: disable=invalid-name
+    return sorted((math.hypot(player.position.x - x, player.position.y - y), player.id)
+                  for player in arena.players.values())[:k]
+
+def _ids(results):
+    return [player_id for _, player_id in results]
+
+def _time(function):
+    """Returns microseconds per call"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+def main():
+    """Entry-point"""
+    rng = random.Random(0)
+    print("{:>8} {:>14} {:>14} {:>14} {:>14}".format(
+        "players", "scan radius", "grid radius", "scan k-nn", "grid k-nn"))
+    for player_count in PLAYER_COUNTS:
+        arena = _populate(player_count, rng)
+        x, y = DIMENSIONS.x / 3, DIMENSIONS.y / 3 #pylint: disable=invalid-name
+        index = arena.spatial_index
+        assert _ids(_linear_within(arena, x, y, QUERY_RADIUS)) == _ids(index.players_within(
+            x, y, QUERY_RADIUS))
+        assert _ids(_linear_nearest(arena, x, y, QUERY_K)) == _ids(index.nearest_players(
+            x, y, QUERY_K))
+        timings = (
+            _time(lambda: _linear_within(arena, x, y, QUERY_RADIUS)),
+            _time(lambda: index.players_within(x, y, QUERY_RADIUS)),
+            _time(lambda: _linear_nearest(arena, x, y, QUERY_K)),
+            _time(lambda: index.nearest_players(x, y, QUERY_K))
+        )
+        print("{:>8} {:>12.1f}us {:>12.1f}us {:>12.1f}us {:>12.1f}us".format(
+            player_count, *timings))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Measures the startup cost of the client: the time to import autozlap.main in a fresh
+interpreter, the time from starting `python3 -m autozlap` to its first play packet arriving
+at a local_server.LocalServer, and the cost of constructing a networking.Connection.
+
+Usage: python3 -m benchmarks.startup [--runs N] [--port PORT]
+"""
+
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from pathlib import Path
+
+from autozlap.constants import Mode
+from autozlap.decoder import ParsingContext
+from autozlap.local_server import LocalServer
+from autozlap.networking import Connection
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+DEFAULT_RUNS = 5
+DEFAULT_PORT = 19090
+PLAY_TIMEOUT = 30.0 # seconds
+# Modules that are slow to import, and should only be imported once needed
+DEFERRED_MODULES = ("aiohttp", "construct", "numpy")
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import autozlap.main
+print(time.perf_counter() - start)
+print(" ".join(name for name in {!r} if name in sys.modules))
+""".format(DEFERRED_MODULES)
+
+def _import_autozlap():
+    """Returns a tuple (seconds to import autozlap.main, eagerly imported DEFERRED_MODULES)"""
+    output = subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT], cwd=str(REPOSITORY),
+                                     universal_newlines=True).splitlines()
+    return float(output[0]), output[1].split() if len(output) > 1 else []
+
+async def _time_to_first_play(server):
+    """Returns seconds from starting the client process to the server receiving play"""
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "autozlap", "--servers-url", server.url, "--log-level", "WARNING",
+        cwd=str(REPOSITORY), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not server.clients:
+            if time.perf_counter() - start > PLAY_TIMEOUT:
+                raise RuntimeError("No play packet within {}s".format(PLAY_TIMEOUT))
+            await asyncio.sleep(0.001)
+        return time.perf_counter() - start
+    finally:
+        process.kill()
+        await process.wait()
+        # Let the server notice the disconnection
+        while server.clients:
+            await asyncio.sleep(0.01)
+
+def _time_construction(**kwargs):
+    """Returns microseconds per Connection construction"""
+    context = ParsingContext()
+    timer = timeit.Timer(lambda: Connection(None, Mode.ffa, context, **kwargs))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+def _summary(seconds):
+    return "min {:.1f}ms, median {:.1f}ms".format(min(seconds) * 1e3,
+                                                  statistics.median(seconds) * 1e3)
+
+def main():
+    """Entry-point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port of the local server (default: %(default)s)")
+    args = parser.parse_args()
+
+    imports = [_import_autozlap() for _ in range(args.runs)]
+    print("import autozlap.main:", _summary([seconds for seconds, _ in imports]))
+    eager = sorted(set(name for _, names in imports for name in names))
+    print("  eagerly imported:", ", ".join(eager) if eager else "none of " + ", ".join(
+        DEFERRED_MODULES))
+
+    loop = asyncio.get_event_loop()
+    server = LocalServer(loop, port=args.port, player_count=10, seed=0)
+    loop.run_until_complete(server.start())
+    try:
+        plays = [loop.run_until_complete(_time_to_first_play(server))
+                 for _ in range(args.runs)]
+    finally:
+        loop.run_until_complete(server.stop())
+    print("time to first play:", _summary(plays))
+
+    print("Connection construction:")
+    variants = [("struct", dict()), ("construct", dict(fast_decoding=False))]
+    try:
+        import numpy #pylint: disable=unused-import
+    except ImportError:
+        pass
+    else:
+        variants.append(("sync_arrays", dict(sync_arrays=True)))
+    for name, kwargs in variants:
+        print("  {:<12} {:.2f}us".format(name, _time_construction(**kwargs)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Compares sync packet decoding with the construct schema, decoder.InboundDecoder and
+sync_arrays.ArraySyncDecoder at several player counts.
+
+Usage: python3 -m benchmarks.sync_decoding
+"""
+
+import random
+import timeit
+
+from autozlap import packet_builder
+from autozlap.constants import Mode
+from autozlap.decoder import InboundDecoder, ParsingContext
+from autozlap.networking import Connection
+from autozlap.sync_arrays import ArraySyncDecoder
+
+PLAYER_COUNTS = (10, 100, 500)
+NEW_PLAYER_RATIO = 0.05
+
+def _build_frame(player_count, new_player_count, rng):
+    entries = list()
+    for player_id in range(player_count):
+        if player_id < new_player_count:
+            attributes = ("player{}".format(player_id), 1.0, 0)
+        else:
+            attributes = None
+        entries.append((player_id, attributes,
+                        tuple(rng.uniform(-1000, 1000) for _ in range(9))))
+    return packet_builder.build_sync(0, [], entries)
+
+def _time_parse(parse, frame):
+    """Returns microseconds per parse"""
+    timer = timeit.Timer(lambda: parse(frame))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+def main():
+    """Entry-point"""
+    rng = random.Random(0)
+    print("{:>8} {:>10} {:>12} {:>12} {:>12}".format(
+        "players", "new", "construct", "struct", "numpy"))
+    for player_count in PLAYER_COUNTS:
+        for new_player_count in (0, max(1, int(player_count * NEW_PLAYER_RATIO))):
+            frame = _build_frame(player_count, new_player_count, rng)
+            context = ParsingContext(range(new_player_count, player_count))
+            parsers = (
+                Connection(None, Mode.ffa, context,
+                           fast_decoding=False)._parse, #pylint: disable=protected-access
+                InboundDecoder(Mode.ffa, context).parse,
+                ArraySyncDecoder(Mode.ffa, context).parse
+            )
+            timings = ["{:.1f}us".format(_time_parse(parse, frame)) for parse in parsers]
+            print("{:>8} {:>10} {:>12} {:>12} {:>12}".format(
+                player_count, new_player_count, *timings))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Checks that decoder.InboundDecoder produces the same objects as the construct schema
+in schema.INBOUND_PACKET, using synthetic frames and the frames of capture files.
+If NumPy is installed, sync_arrays.ArraySyncDecoder is also checked against InboundDecoder.
+encoder.encode is checked against the outbound construct schema, and
+decoder.decode_leaderboard_body against schema.LEADERBOARD_BODY and the values the
+leaderboards were built from.
+Finally, every decoder and Arena is checked to keep decoder.ParsingContext and player names
+in step through spawns, kills and removals, and to end in the same state when a backlog of
+those frames is coalesced by pipeline.SyncCoalescer.
+
+Usage: check_decoder_parity.py [CAPTURE ...]
+
+CAPTURE defaults to samples/local_server.azcap, recorded from autozlap.local_server.
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+#pylint: disable=wrong-import-position
+from autozlap import capture, encoder, game_client, packet_builder, policy
+from autozlap.constants import Mode
+from autozlap.decoder import InboundDecoder, ParsingContext, decode_leaderboard_body
+from autozlap.networking import Connection
+from autozlap.schema import LEADERBOARD_BODY, OUTBOUND_PACKET
+#pylint: enable=wrong-import-position
+
+CURRENT_PLAYER_ID = 1
+SAMPLE_CAPTURE = Path(__file__).resolve().parent / "samples" / "local_server.azcap"
+
+def _random_state(rng):
+    return tuple(rng.uniform(-1000, 1000) for _ in range(9))
+
+def _synthetic_frames(mode, rng):
+    """Yields (description, known player ids, frame)"""
+    known_ids = set(range(CURRENT_PLAYER_ID, 200))
+    yield "setup", known_ids, packet_builder.build_setup(
+        CURRENT_PLAYER_ID, (5000, 5000), (4000, 4000), mode=mode, initial_time=123)
+    yield "killed", known_ids, packet_builder.build_killed()
+    yield "kill", known_ids, packet_builder.build_kill(10, 5, (1.5, -2.5), 7, 3)
+    yield "remove", known_ids, packet_builder.build_remove(11, 9)
+    for player_count in (0, 1, 10, 100):
+        entries = list()
+        for player_id in rng.sample(range(CURRENT_PLAYER_ID, 400), player_count):
+            if player_id in known_ids:
+                attributes = None
+            elif player_id == CURRENT_PLAYER_ID:
+                attributes = (None, 1.0, 0)
+            else:
+                attributes = ("playeré{}".format(player_id), rng.random(), player_id % 256)
+            entries.append((player_id, attributes, _random_state(rng)))
+        yield "sync ({} players)".format(player_count), known_ids, packet_builder.build_sync(
+            12, rng.sample(range(400, 500), rng.randint(0, 5)), entries)
+    yield "sync (known players only)", known_ids, packet_builder.build_sync(
+        12, [], [(player_id, None, _random_state(rng)) for player_id in range(2, 50)])
+    yield "sync (new current player)", set(), packet_builder.build_sync(
+        13, [], [(CURRENT_PLAYER_ID, (None, 0.5, 1), _random_state(rng))])
+    yield "club_collision", known_ids, packet_builder.build_club_collision(
+        14, (1, 2), 0.5, 3, (4, 5, 6, 7), 8, (9, 10, 11, 12))
+    yield "wall_collision", known_ids, packet_builder.build_wall_collision(
+        15, (1, 2), 0.5, 3, (4, 5, 6, 7), 8)
+    yield "set_leaderboard", known_ids, _LEADERBOARDS[mode][0]
+    yield "set_target_dim", known_ids, packet_builder.build_set_target_dim((3000, 3000))
+    yield "extraneous bytes", known_ids, packet_builder.build_remove(16, 17) + b"\x01\x02"
+
+# mode -> (frame, expected decode_leaderboard_body() result)
+_LEADERBOARDS = {
+    Mode.ffa: (packet_builder.build_set_leaderboard_ffa(
+        50, 60, 1, [("a", 30), ("über", 20), ("", 10)], ("king", 40), 4, 5), dict(
+            first_entry_id=1, entries=[dict(name="a", score=30), dict(name="über", score=20),
+                                       dict(name="", score=10)],
+            king=dict(name="king", score=40), place=4, score=5, extraneous=b"")),
+    Mode.tdm: (packet_builder.build_set_leaderboard_tdm(
+        50, 60, [(0, 1, 2), (1, 3, 4), (2, 5, 6)]), dict(
+            teams=[dict(id=0, score=1, count=2), dict(id=1, score=3, count=4),
+                   dict(id=2, score=5, count=6)], extraneous=b""))
+}
+
+def _random_leaderboards(mode, rng):
+    """Yields (description, set_leaderboard frame)"""
+    for count in (0, 1, 10):
+        if mode == Mode.ffa:
+            entries = [("player{}é".format(rng.randrange(1000)) * rng.randint(0, 2),
+                        rng.randrange(2**32)) for _ in range(count)]
+            yield "leaderboard ({} entries)".format(count), (
+                packet_builder.build_set_leaderboard_ffa(
+                    count, count, rng.randrange(2**32), entries, ("king", rng.randrange(2**32)),
+                    rng.randrange(2**32), rng.randrange(2**32)))
+        else:
+            teams = [(team_id, rng.randrange(2**32), rng.randrange(2**32)) for team_id in range(3)]
+            yield "leaderboard ({} players)".format(count), (
+                packet_builder.build_set_leaderboard_tdm(count, count, teams))
+
+def _schema_leaderboard(mode, body):
+    """Returns the decode_leaderboard_body() result, as parsed by schema.LEADERBOARD_BODY"""
+    parsed = LEADERBOARD_BODY[mode].parse(body)
+    if mode == Mode.ffa:
+        return dict(
+            first_entry_id=parsed.first_entry_id,
+            entries=[dict(name=entry.name, score=entry.score) for entry in parsed.leaderboard],
+            king=dict(name=parsed.king_name, score=parsed.king_score), place=parsed.place,
+            score=parsed.score, extraneous=parsed.extraneous)
+    return dict(teams=[dict(id=team.id, score=team.score, count=team.count)
+                       for team in parsed.teams], extraneous=parsed.extraneous)
+
+def _parse_with(mode, known_ids, frame, fast_decoding, current_player_id=CURRENT_PLAYER_ID):
+    connection = Connection(None, mode, ParsingContext(known_ids, current_player_id),
+                            fast_decoding=fast_decoding)
+    return connection._parse(frame) #pylint: disable=protected-access
+
+def _sync_arrays_match(mode, known_ids, frame, expected, current_player_id=CURRENT_PLAYER_ID):
+    """Compares the ArraySyncDecoder output for a sync frame with InboundDecoder's"""
+    from autozlap.sync_arrays import ArraySyncDecoder
+    context = ParsingContext(known_ids, current_player_id)
+    actual = ArraySyncDecoder(mode, context).parse(frame)
+    entries = list()
+    for sync_struct in expected.payload.sync_array:
+        player_state = sync_struct.player_state
+        mace_state = sync_struct.mace_state
+        entries.append((sync_struct.player_id, [
+            player_state.position.x, player_state.position.y,
+            player_state.velocity.x, player_state.velocity.y,
+            mace_state.position.x, mace_state.position.y,
+            mace_state.velocity.x, mace_state.velocity.y,
+            sync_struct.mace_radius
+        ]))
+    records = actual.payload.records
+    new_players = [entry for entry in expected.payload.sync_array if entry.is_new_player]
+    return (actual.extraneous == expected.extraneous
+            and actual.payload.removal_array == expected.payload.removal_array
+            and records["player_id"].tolist() == [entry[0] for entry in entries]
+            and records["state"].tolist() == [entry[1] for entry in entries]
+            and actual.payload.new_players == new_players)
+
+def _update_context(context, packet):
+    """Updates a ParsingContext for a parsed packet, as game_client.Arena does"""
+    if packet.type == "setup":
+        context.current_player_id = packet.payload.current_player_id
+        context.known_ids.discard(context.current_player_id)
+    elif packet.type == "sync":
+        context.known_ids.difference_update(packet.payload.removal_array)
+        context.known_ids.update(entry.player_id for entry in packet.payload.sync_array)
+    elif packet.type == "kill":
+        context.known_ids.discard(packet.payload.killed_id)
+    elif packet.type == "remove":
+        context.known_ids.discard(packet.payload.player_id)
+
+def _check_capture(path, check_sync_arrays):
+    """Returns the number of frames of a capture file that decode differently"""
+    failures = 0
+    frame_count = 0
+    for connection_number, records in enumerate(
+            capture.split_connections(capture.read_frames(path))):
+        context = ParsingContext()
+        for frame_number, (_, frame) in enumerate(records):
+            frame_count += 1
+            args = (Mode.ffa, context.known_ids, frame)
+            expected = _parse_with(*args, False, context.current_player_id)
+            matches = expected == _parse_with(*args, True, context.current_player_id)
+            if matches and check_sync_arrays and expected.type == "sync":
+                matches = _sync_arrays_match(*args, expected, context.current_player_id)
+            if not matches:
+                failures += 1
+                print("MISMATCH capture", path, "connection", connection_number, "frame",
+                      frame_number, expected.type)
+            _update_context(context, expected)
+    if not failures:
+        print("OK capture", path, "({} frames)".format(frame_count))
+    return failures
+
+def _name_handling_steps(rng):
+    """Yields (description, frame, check), where check(arena) is whether the state is right"""
+    def _entry(player_id, attributes=None):
+        return player_id, attributes, _random_state(rng)
+    current = CURRENT_PLAYER_ID
+    yield "setup", packet_builder.build_setup(current, (5000, 5000), (5000, 5000)), (
+        lambda arena: arena.current_player.name is None
+        and arena.parsing_context.is_new_player(current))
+    yield "spawn", packet_builder.build_sync(1, [], [
+        _entry(current, (None, 1.0, 0)), _entry(2, ("bob", 1.0, 3))]), (
+            lambda arena: arena.current_player.name is True and arena.players[2].name == "bob"
+            and arena.parsing_context.known_ids == {current, 2})
+    yield "update", packet_builder.build_sync(2, [], [_entry(current), _entry(2)]), (
+        lambda arena: arena.current_player.name is True)
+    yield "killed", packet_builder.build_kill(3, current, (0, 0), 2, 1), (
+        lambda arena: arena.current_player.name is None
+        and arena.parsing_context.known_ids == {2})
+    yield "respawn", packet_builder.build_sync(4, [], [
+        _entry(current, (None, 1.0, 0)), _entry(2)]), (
+            lambda arena: arena.current_player.name is True and current in arena.players)
+    yield "remove", packet_builder.build_remove(5, 2), (
+        lambda arena: 2 not in arena.players and arena.parsing_context.is_new_player(2))
+    yield "rejoin", packet_builder.build_sync(6, [], [
+        _entry(2, ("bob2", 1.0, 3)), _entry(3, ("carol", 1.0, 4))]), (
+            lambda arena: arena.players[2].name == "bob2"
+            and arena.parsing_context.known_ids == {current, 2, 3})
+    yield "sync removal", packet_builder.build_sync(7, [3], [_entry(2)]), (
+        lambda arena: arena.parsing_context.known_ids == {current, 2})
+    # A setup with a new id while the previous current player is still alive
+    new_current = 5
+    yield "new setup", packet_builder.build_setup(new_current, (5000, 5000), (5000, 5000)), (
+        lambda arena: arena.current_player.id == new_current and current in arena.players
+        and arena.parsing_context.known_ids == {current, 2})
+    yield "new spawn", packet_builder.build_sync(8, [], [
+        _entry(new_current, (None, 1.0, 0)), _entry(current)]), (
+            lambda arena: arena.current_player.name is True
+            and arena.parsing_context.known_ids == {current, 2, new_current})
+    yield "new player", packet_builder.build_sync(9, [], [_entry(7, ("dave", 1.0, 5))]), (
+        lambda arena: arena.players[7].name == "dave")
+    yield "old remove", packet_builder.build_remove(10, current), (
+        lambda arena: sorted(arena.players) == [2, new_current, 7]
+        and arena.parsing_context.known_ids == {2, new_current, 7})
+
+def _name_handling_variants():
+    """Yields (description, arena class, Connection keyword arguments)"""
+    yield "construct", game_client.Arena, dict(fast_decoding=False)
+    yield "struct", game_client.Arena, dict()
+    try:
+        from autozlap.columnar import ColumnarArena
+    except ImportError:
+        return
+    yield "struct columnar", ColumnarArena, dict()
+    yield "sync_arrays columnar", ColumnarArena, dict(sync_arrays=True)
+
+def _check_name_handling(rng):
+    """Returns the number of failed steps"""
+    failures = 0
+    loop = asyncio.new_event_loop()
+    for description, arena_class, kwargs in _name_handling_variants():
+        session = game_client.Session(loop, Mode.ffa, arena_class)
+        connection = Connection(None, Mode.ffa, session.arena.parsing_context, **kwargs)
+        for step, frame, check in _name_handling_steps(rng):
+            packet = connection._parse(frame) #pylint: disable=protected-access
+            if not packet.extraneous:
+                session._received_packet_handler(packet) #pylint: disable=protected-access
+            if not packet.extraneous and check(session.arena):
+                print("OK names", description, step)
+            else:
+                failures += 1
+                print("MISMATCH names", description, step)
+                break
+    loop.close()
+    return failures
+
+def _replayed_state(loop, arena_class, frames, receive_queue):
+    """
+    Returns a tuple (arena snapshot, known ids, predicted states, last history state,
+    history timestamps, frames coalesced) after replaying frames
+    """
+    session = game_client.Session(loop, Mode.ffa, arena_class, receive_queue=receive_queue)
+    session.arena.enable_prediction()
+    session.enable_history(capacity=len(frames))
+    loop.run_until_complete(session.listen(capture.ReplayWebsocket(
+        loop, [(0.0, frame) for frame in frames])))
+    store = session.arena.predictor.store
+    predicted = sorted((player_id, store.timestamps[slot], store.state[slot].tolist())
+                       for player_id, slot in store.index.items())
+    history = session.history
+    history_ids, history_rows = history.state_at(history.last_tick)
+    return (policy.snapshot_arena(session.arena, 0.0), session.arena.parsing_context.known_ids,
+            predicted, (history_ids.tolist(), history_rows.tolist()),
+            [history.timestamp(tick) for tick in range(history.first_tick, history.last_tick + 1)],
+            session.stats.frames_coalesced)
+
+def _check_coalescing(rng):
+    """Returns the number of variants whose state differs once syncs are coalesced"""
+    failures = 0
+    loop = asyncio.new_event_loop()
+    reference = ParsingContext(current_player_id=CURRENT_PLAYER_ID)
+    frames = list()
+    for step_index, (_, frame, _) in enumerate(_name_handling_steps(rng)):
+        frames.append(frame)
+        packet = InboundDecoder(Mode.ffa, reference).parse(frame)
+        _update_context(reference, packet)
+        # Updates of every other known player, so that each step is followed by a sync to
+        # coalesce, and the states of the others must be carried to the last one
+        updated_ids = sorted(reference.known_ids)[step_index % 2::2]
+        frames.append(packet_builder.build_sync(len(frames), [], [
+            (player_id, None, _random_state(rng)) for player_id in updated_ids]))
+    arena_classes = [game_client.Arena]
+    try:
+        from autozlap.columnar import ColumnarArena
+        arena_classes.append(ColumnarArena)
+    except ImportError:
+        pass
+    for arena_class in arena_classes:
+        expected = _replayed_state(loop, arena_class, frames, 0)
+        actual = _replayed_state(loop, arena_class, frames, len(frames))
+        # Carried states keep their timestamps, and are recorded in ticks of their own
+        history_timestamps = actual[4]
+        if (expected[:4] == actual[:4] and actual[5] > 0
+                and history_timestamps == sorted(history_timestamps)
+                and set(history_timestamps) <= set(expected[4])):
+            print("OK coalescing", arena_class.__name__, "({} syncs coalesced)".format(actual[5]))
+        else:
+            failures += 1
+            print("MISMATCH coalescing", arena_class.__name__)
+    loop.close()
+    return failures
+
+def main():
+    """Entry-point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("captures", nargs="*", metavar="CAPTURE", default=[SAMPLE_CAPTURE],
+                        help="Capture files to check (default: the local_server sample)")
+    args = parser.parse_args()
+    rng = random.Random(0)
+    failures = 0
+    try:
+        import numpy #pylint: disable=unused-variable
+        check_sync_arrays = True
+    except ImportError:
+        print("NumPy not found; skipping sync_arrays checks")
+        check_sync_arrays = False
+    for mode in Mode:
+        for description, known_ids, frame in _synthetic_frames(mode, rng):
+            expected = _parse_with(mode, known_ids, frame, False)
+            actual = _parse_with(mode, known_ids, frame, True)
+            if expected == actual:
+                print("OK", mode.value, description)
+            else:
+                failures += 1
+                print("MISMATCH", mode.value, description)
+                print("Expected:", expected)
+                print("Actual:", actual)
+            if check_sync_arrays and expected.type == "sync":
+                if _sync_arrays_match(mode, known_ids, frame, expected):
+                    print("OK", mode.value, description, "(sync_arrays)")
+                else:
+                    failures += 1
+                    print("MISMATCH", mode.value, description, "(sync_arrays)")
+    for mode, (frame, expected) in _LEADERBOARDS.items():
+        body = _parse_with(mode, set(), frame, True).payload.body
+        if decode_leaderboard_body(mode, body) == expected == _schema_leaderboard(mode, body):
+            print("OK", mode.value, "leaderboard body")
+        else:
+            failures += 1
+            print("MISMATCH", mode.value, "leaderboard body")
+        for description, frame in _random_leaderboards(mode, rng):
+            body = _parse_with(mode, set(), frame, True).payload.body + b"\x01"
+            if decode_leaderboard_body(mode, body) == _schema_leaderboard(mode, body):
+                print("OK", mode.value, description)
+            else:
+                failures += 1
+                print("MISMATCH", mode.value, description)
+    for packet_type in encoder.OUTBOUND_TYPES:
+        packet = dict(type=packet_type, payload=None)
+        if packet_type == "direction":
+            packet["payload"] = dict(angle=rng.uniform(-3.14, 3.14))
+        expected = OUTBOUND_PACKET.build(packet)
+        if encoder.encode(packet) == expected:
+            print("OK outbound", packet_type)
+        else:
+            failures += 1
+            print("MISMATCH outbound", packet_type)
+    for path in args.captures:
+        failures += _check_capture(path, check_sync_arrays)
+    failures += _check_name_handling(rng)
+    failures += _check_coalescing(rng)
+    if failures:
+        print(failures, "mismatches")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
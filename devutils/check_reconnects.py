@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Checks game_client.Session.run() against a local_server.LocalServer that drops every
+connection after a few frames, and is down for a while in between.
+
+The backoff must grow while reconnects fail, and reset once a setup packet is received.
+Downtime must count from the first disconnect, and a session whose server could not be
+repicked must still count towards the load of its old server.
+
+Usage: check_reconnects.py [--port PORT]
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+#pylint: disable=wrong-import-position
+from autozlap import transport
+from autozlap.constants import CLIENT_VERSION, Mode
+from autozlap.game_client import ReconnectPolicy, Session
+from autozlap.local_server import LocalServer
+from autozlap.server_selector import ServerDirectory, ServerInfo
+#pylint: enable=wrong-import-position
+
+DEFAULT_PORT = 19091
+DROP_AFTER = 5 # frames
+RECONNECTS = 4
+TIMEOUT = 30.0 # seconds
+
+class _RecordingPolicy(ReconnectPolicy):
+    """A ReconnectPolicy that records its attempts and calls on_delay(number of calls)"""
+    def __init__(self, on_delay, **kwargs):
+        super().__init__(**kwargs)
+        self._on_delay = on_delay
+        self.attempts = list()
+        self.delays = list()
+
+    def delay(self, attempt):
+        self.attempts.append(attempt)
+        self._on_delay(len(self.attempts))
+        delay = super().delay(attempt)
+        self.delays.append(delay)
+        return delay
+
+async def _run(loop, port):
+    """Returns a list of (description, passed)"""
+    server = LocalServer(loop, port=port, player_count=5, seed=0, drop_after=DROP_AFTER)
+    await server.start()
+    directory = ServerDirectory(loop, ttl=0, url=server.url)
+    (address, server_port), = await directory.place(Mode.ffa)
+    server_info = ServerInfo(address, server_port, Mode.ffa, CLIENT_VERSION, 0)
+    placed_counts = list()
+    pending = list()
+
+    def _on_delay(calls):
+        placed_counts.append(directory.load(server_info))
+        if calls == 1:
+            # Dropped while in game; the next two reconnects and repicks fail
+            pending.append(loop.create_task(server.stop()))
+        elif calls == 3:
+            pending.append(loop.create_task(server.start()))
+
+    policy = _RecordingPolicy(_on_delay, initial_delay=0.1, max_reconnects=RECONNECTS,
+                              repick_server=True)
+    session = Session(loop, Mode.ffa)
+    try:
+        await asyncio.wait_for(session.run(address, server_port, directory, policy), TIMEOUT)
+    finally:
+        await asyncio.gather(*pending)
+        await server.stop()
+        await transport.close_shared(loop)
+    return [
+        ("backoff grows while reconnects fail {}".format(policy.attempts),
+         policy.attempts == [0, 1, 2, 0]),
+        ("downtime counts from the first disconnect ({:.2f}s)".format(session.downtime_seconds),
+         session.downtime_seconds >= sum(policy.delays)),
+        ("failed repicks keep the old server's load {}".format(placed_counts),
+         placed_counts == [1] * RECONNECTS),
+        ("server dropped {} connections".format(server.stats.drops),
+         server.stats.drops == RECONNECTS - 1)
+    ]
+
+def main():
+    """Entry-point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port of the local server (default: %(default)s)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    failures = 0
+    for description, passed in loop.run_until_complete(_run(loop, args.port)):
+        print("OK" if passed else "MISMATCH", description)
+        failures += not passed
+    loop.close()
+    if failures:
+        print(failures, "mismatches")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()